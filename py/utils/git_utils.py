@@ -5,12 +5,76 @@
 
 """This module contains functions for using git."""
 
+import array
+import collections
+import contextlib
+import hashlib
+import heapq
+import json
 import os
 import re
 import shell_utils
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import types
+import urlparse
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+# If set (from the environment variable of the same name), the path of a file
+# in which GetGit() records the git executable it found, so that later
+# processes can skip checking it as long as it has not been modified.
+GIT_UTILS_CACHE_FILE = os.environ.get('GIT_UTILS_CACHE_FILE')
+
+# The git executable, once GetGit() has found it.  (Other modules may still read
+# GIT, which calls GetGit(); see _GitUtilsModule.)
+_git = None
+_git_found = False
+_git_lock = threading.Lock()
+
+
+def _Which(name):
+  """Return the full path of the executable which running name would run, or
+  None if there is none on the PATH.  (Like shutil.which() in Python 3.)"""
+  extensions = ['']
+  if os.name == 'nt' and not os.path.splitext(name)[1]:
+    extensions = os.environ.get('PATHEXT', '.EXE;.BAT').lower().split(';')
+  for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+    for extension in extensions:
+      path = os.path.join(directory, name + extension)
+      if os.path.isfile(path) and os.access(path, os.X_OK):
+        return path
+  return None
+
+
+def _ReadGitCache(path, mtime):
+  """Return True if GIT_UTILS_CACHE_FILE says that the executable at path, with
+  the given modification time, works."""
+  try:
+    with open(GIT_UTILS_CACHE_FILE) as f:
+      return json.load(f) == {'path': path, 'mtime': mtime}
+  except (IOError, ValueError):
+    return False
+
+
+def _WriteGitCache(path, mtime):
+  """Record in GIT_UTILS_CACHE_FILE that the executable at path works."""
+  temp_path = '%s.%d.tmp' % (GIT_UTILS_CACHE_FILE, os.getpid())
+  try:
+    with open(temp_path, 'w') as f:
+      json.dump({'path': path, 'mtime': mtime}, f)
+    os.rename(temp_path, GIT_UTILS_CACHE_FILE)
+  except (IOError, OSError):
+    # The cache is just an optimization.
+    pass
 
 
 def _FindGit():
@@ -19,47 +83,61 @@ def _FindGit():
   Returns:
       A string suitable for passing to subprocess functions, or None.
   """
-  def test_git_executable(git):
-    """Test the git executable.
-
-    Args:
-        git: git executable path.
-    Returns:
-        True if test is successful.
-    """
-    try:
-      shell_utils.run([git, '--version'], echo=False)
-      return True
-    except (OSError,):
-      return False
-
   for git in ('git', 'git.exe', 'git.bat'):
-    if test_git_executable(git):
+    # Don't bother trying to run anything which is not on the PATH.
+    path = _Which(git)
+    if not path:
+      continue
+    mtime = os.path.getmtime(path)
+    if GIT_UTILS_CACHE_FILE and _ReadGitCache(path, mtime):
       return git
+    try:
+      with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([git, '--version'], stdout=devnull,
+                              stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+      continue
+    if GIT_UTILS_CACHE_FILE:
+      _WriteGitCache(path, mtime)
+    return git
   return None
 
 
-GIT = _FindGit()
+def GetGit():
+  """Return the git executable (a string suitable for passing to subprocess
+  functions), or None if there is none.
+
+  We look for it the first time this is called, rather than when this module is
+  imported, so that importing it costs nothing for scripts which never use
+  git.
+  """
+  global _git, _git_found
+  if not _git_found:
+    with _git_lock:
+      if not _git_found:
+        _git = _FindGit()
+        _git_found = True
+  return _git
 
 
 def Add(addition):
   """Run 'git add <addition>'"""
-  shell_utils.run([GIT, 'add', addition])
+  shell_utils.run([GetGit(), 'add', addition])
 
 
 def AIsAncestorOfB(a, b):
   """Return true if a is an ancestor of b."""
-  return shell_utils.run([GIT, 'merge-base', a, b]).rstrip() == FullHash(a)
+  return shell_utils.run([GetGit(), 'merge-base', a, b]).rstrip() == FullHash(a)
 
 
 def FullHash(commit):
   """Return full hash of specified commit."""
-  return shell_utils.run([GIT, 'rev-parse', '--verify', commit]).rstrip()
+  return shell_utils.run([GetGit(), 'rev-parse', '--verify', commit]).rstrip()
 
 
 def IsMerge(commit):
   """Return True if the commit is a merge, False otherwise."""
-  rev_parse = shell_utils.run([GIT, 'rev-parse', commit, '--max-count=1',
+  rev_parse = shell_utils.run([GetGit(), 'rev-parse', commit, '--max-count=1',
                                '--no-merges'])
   last_non_merge = rev_parse.split('\n')[0]
   # Get full hash since that is what was returned by rev-parse.
@@ -68,29 +146,376 @@ def IsMerge(commit):
 
 def MergeAbort():
   """Abort in process merge."""
-  shell_utils.run([GIT, 'merge', '--abort'])
+  shell_utils.run([GetGit(), 'merge', '--abort'])
 
 
 def ShortHash(commit):
   """Return short hash of the specified commit."""
-  return shell_utils.run([GIT, 'show', commit, '--format=%h', '-s']).rstrip()
+  return shell_utils.run(
+      [GetGit(), 'show', commit, '--format=%h', '-s']).rstrip()
 
 
 def Fetch(remote=None):
   """Run "git fetch". """
-  cmd = [GIT, 'fetch']
+  cmd = [GetGit(), 'fetch']
   if remote:
     cmd.append(remote)
   shell_utils.run(cmd)
 
 
 def GetRemoteMasterHash(git_url):
-  return shell_utils.run([GIT, 'ls-remote', git_url, '--verify',
+  return shell_utils.run([GetGit(), 'ls-remote', git_url, '--verify',
                           'refs/heads/master']).rstrip()
 
 
 def GetCurrentBranch():
-  return shell_utils.run([GIT, 'rev-parse', '--abbrev-ref', 'HEAD']).rstrip()
+  return shell_utils.run(
+      [GetGit(), 'rev-parse', '--abbrev-ref', 'HEAD']).rstrip()
+
+
+class _CatFileBatchCheck(shell_utils.Coprocess):
+  """A 'git cat-file --batch-check' process, which resolves object names
+  (anything rev-parse accepts) to object hashes, one per line.
+
+  Its stderr is discarded: git may warn there (e.g. that a ref name is
+  ambiguous) on top of the one line it always writes to stdout per name.
+  """
+
+  # How many names to send at once.  Replies are about 50 bytes each, so this
+  # many fit within a pipe buffer; if we wrote more before reading, we and git
+  # could both block writing to each other.
+  BATCH_SIZE = 1000
+
+  def __init__(self, path):
+    shell_utils.Coprocess.__init__(
+        self, [GetGit(), '-C', path, 'cat-file',
+               '--batch-check=%(objectname) %(objecttype)'], echo=False,
+        discard_stderr=True)
+
+  def Resolve(self, names):
+    """Return the full hash of each of names, or None for those which do not
+    name an object (for which git replies '<name> missing', or e.g.
+    '<name> ambiguous')."""
+    results = []
+    for start in range(0, len(names), self.BATCH_SIZE):
+      batch = names[start:start + self.BATCH_SIZE]
+      lines = self.request(
+          ''.join('%s\n' % name for name in batch),
+          lambda deadline: [self.read_until('\n', deadline) for _ in batch])
+      for line in lines:
+        match = re.match('^([0-9a-f]{40}) \w+$', line)
+        results.append(match.group(1) if match else None)
+    return results
+
+
+class GitRepo(object):
+  """Answers queries about the commits in a local repository in bulk.
+
+  All the queries go to one long-lived 'git cat-file --batch-check' process
+  (plus, for ancestry_matrix(), one 'git rev-list' per call), rather than to a
+  process or two per query.  Answers which cannot change (those about full
+  commit hashes) are kept in an LRU cache.  This object may be shared between
+  threads.
+  """
+
+  def __init__(self, path='.', cache_size=10000):
+    """
+    Args:
+      path: path of the repository (or any directory within its checkout)
+      cache_size: maximum number of answers to cache
+    """
+    self._path = os.path.abspath(path)
+    self._cache_size = cache_size
+    self._cache = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._cat_file = None
+
+  def close(self):
+    """Stop the git process.  (Any further queries start it again.)"""
+    with self._lock:
+      if self._cat_file:
+        self._cat_file.close()
+
+  def _Resolve(self, names, commits):
+    """Return the full hash for each of names, which are commits with suffixes
+    (e.g. 'abc123^2'), or None for those which do not exist."""
+    results = [None] * len(names)
+    misses = []
+    with self._lock:
+      for (i, (name, commit)) in enumerate(zip(names, commits)):
+        if name in self._cache:
+          self._cache[name] = results[i] = self._cache.pop(name)
+        else:
+          misses.append(i)
+      if not misses:
+        return results
+      if not self._cat_file:
+        self._cat_file = _CatFileBatchCheck(self._path)
+      resolved = self._cat_file.Resolve([names[i] for i in misses])
+      for (i, full_hash) in zip(misses, resolved):
+        results[i] = full_hash
+        # Only cache answers about full hashes, which cannot change; but not
+        # that an object is missing, since it may be fetched later.
+        if full_hash and re.match('^[0-9a-f]{40}$', commits[i]):
+          self._cache[names[i]] = full_hash
+          if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+    return results
+
+  def full_hashes(self, commits):
+    """Return the full hash of each of commits (hashes, branches, tags, or any
+    other revisions).  Throws a CommandFailedException if any does not name a
+    commit."""
+    full_hashes = self._Resolve(['%s^{commit}' % c for c in commits], commits)
+    unknown = [c for (c, h) in zip(commits, full_hashes) if not h]
+    if unknown:
+      raise shell_utils.CommandFailedException(
+          '', 'Unknown commit(s) in %s: %s' % (self._path, unknown))
+    return full_hashes
+
+  def full_hash(self, commit):
+    """Return the full hash of commit."""
+    return self.full_hashes([commit])[0]
+
+  def is_merge_many(self, commits):
+    """Return whether each of commits is a merge (has more than one
+    parent)."""
+    full_hashes = self.full_hashes(commits)
+    second_parents = self._Resolve(['%s^2' % h for h in full_hashes],
+                                   full_hashes)
+    return [bool(p) for p in second_parents]
+
+  def is_merge(self, commit):
+    """Return True if commit is a merge."""
+    return self.is_merge_many([commit])[0]
+
+  def _Run(self, args):
+    return subprocess.check_output(args=args, cwd=self._path)
+
+  def ancestry_matrix(self, ancestors, descendants):
+    """Return a list of lists of booleans: whether each of ancestors is an
+    ancestor of each of descendants, like 'git merge-base --is-ancestor' (so
+    a commit counts as its own ancestor).
+
+    We walk the history between the commits and their common ancestor once,
+    in a single 'git rev-list' process, however many pairs there are.
+    """
+    ancestor_hashes = self.full_hashes(ancestors)
+    descendant_hashes = self.full_hashes(descendants)
+    # Each ancestor gets a bit in these masks.
+    ancestor_bits = collections.defaultdict(int)
+    for (i, h) in enumerate(ancestor_hashes):
+      ancestor_bits[h] |= 1 << i
+    # The commits we are given all descend from their common ancestor (if
+    # they have one), so none of them but the common ancestor itself can be
+    # reachable from it; we only need to walk the history after it.
+    base = None
+    rev_list = [GetGit(), 'rev-list', '--topo-order', '--parents']
+    rev_list.extend(sorted(set(descendant_hashes)))
+    try:
+      base = self._Run([GetGit(), 'merge-base', '--octopus'] +
+                       sorted(set(ancestor_hashes + descendant_hashes))).strip()
+      rev_list.append('^%s' % base)
+    except subprocess.CalledProcessError:
+      # Unrelated histories; walk them all.
+      pass
+    # rev-list lists children before parents, so go backwards, giving each
+    # commit the mask of ancestors reachable from it.
+    masks = {}
+    for line in reversed(self._Run(rev_list).splitlines()):
+      ids = line.split()
+      mask = ancestor_bits.get(ids[0], 0)
+      for parent in ids[1:]:
+        mask |= masks.get(parent, 0)
+      masks[ids[0]] = mask
+    # Every descendant reaches the common ancestor.
+    base_mask = ancestor_bits.get(base, 0)
+    return [[bool((masks.get(d, 0) | base_mask) & ancestor_bits[a])
+             for d in descendant_hashes]
+            for a in ancestor_hashes]
+
+  def is_ancestor(self, a, b):
+    """Return True if a is an ancestor of b (or the same commit)."""
+    return self.ancestry_matrix([a], [b])[0][0]
+
+
+class CommitGraph(object):
+  """An in-memory index of the commit history of a repository, which answers
+  ancestry, merge-base and "is merge" queries without running git.
+
+  Commits are numbered in topological order (parents first), and their parents
+  and generation numbers (1 for a root commit, else one more than the highest
+  of its parents') are kept in integer arrays.  Generation numbers let
+  queries skip any part of the history too old to matter.
+
+  Queries are fastest when given full commit hashes; other revisions are
+  resolved with a GitRepo first.  The graph is not thread-safe while update()
+  runs.
+  """
+
+  def __init__(self, path='.', revisions=('--all',)):
+    """Index the history of the given revisions.
+
+    Args:
+      path: path of the repository (or any directory within its checkout)
+      revisions: arguments for 'git rev-list' selecting the commits to index;
+          defaults to everything reachable from any ref
+    """
+    self._path = os.path.abspath(path)
+    self._revisions = list(revisions)
+    self._repo = GitRepo(self._path)
+    # Full hash of each commit, by number; and number by full hash.
+    self._hashes = []
+    self._numbers = {}
+    # The parents of commit i are _parents[_parent_starts[i]:
+    # _parent_starts[i + 1]].
+    self._parent_starts = array.array('i', [0])
+    self._parents = array.array('i')
+    self._generations = array.array('i')
+    # Tips of the history we have indexed so far.
+    self._tips = []
+    self.update()
+
+  def __len__(self):
+    return len(self._hashes)
+
+  def update(self):
+    """Index any commits which have been added (e.g. fetched) since we were
+    created or last updated, and return how many there were."""
+    tips = subprocess.check_output(
+        [GetGit(), 'rev-parse'] + self._revisions, cwd=self._path).split()
+    proc = subprocess.Popen(
+        [GetGit(), 'rev-list', '--reverse', '--topo-order', '--parents',
+         '--stdin'],
+        cwd=self._path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    (output, _) = proc.communicate(''.join(
+        '%s\n' % rev for rev in tips + ['^%s' % t for t in self._tips]))
+    if proc.returncode != 0:
+      raise shell_utils.CommandFailedException(
+          output, 'git rev-list failed in %s' % self._path)
+    count = len(self._hashes)
+    for line in output.splitlines():
+      ids = line.split()
+      if ids[0] in self._numbers:
+        continue
+      generation = 0
+      for parent in ids[1:]:
+        # Parents beyond a shallow clone's boundary are unknown.
+        number = self._numbers.get(parent)
+        if number is not None:
+          self._parents.append(number)
+          generation = max(generation, self._generations[number])
+      self._parent_starts.append(len(self._parents))
+      self._generations.append(generation + 1)
+      self._numbers[ids[0]] = len(self._hashes)
+      self._hashes.append(ids[0])
+    self._tips = [t for t in tips if not t.startswith('^')]
+    return len(self._hashes) - count
+
+  def _Number(self, commit):
+    number = self._numbers.get(commit)
+    if number is None:
+      number = self._numbers.get(self._repo.full_hash(commit))
+      if number is None:
+        raise ValueError('Commit %s is not in the graph; try update()' % commit)
+    return number
+
+  def _ParentNumbers(self, number):
+    return self._parents[self._parent_starts[number]:
+                         self._parent_starts[number + 1]]
+
+  def parents(self, commit):
+    """Return the full hashes of the parents of commit."""
+    return [self._hashes[p] for p in self._ParentNumbers(self._Number(commit))]
+
+  def is_merge(self, commit):
+    """Return True if commit has more than one parent."""
+    number = self._Number(commit)
+    return self._parent_starts[number + 1] - self._parent_starts[number] > 1
+
+  def is_ancestor(self, a, b):
+    """Return True if a is an ancestor of b (or the same commit)."""
+    a = self._Number(a)
+    b = self._Number(b)
+    min_generation = self._generations[a]
+    stack = [b]
+    seen = set(stack)
+    while stack:
+      number = stack.pop()
+      if number == a:
+        return True
+      for parent in self._ParentNumbers(number):
+        # Nothing with a generation number no higher than a's can reach a,
+        # except a itself.
+        if parent not in seen and self._generations[parent] >= min_generation:
+          seen.add(parent)
+          stack.append(parent)
+    return False
+
+  def merge_bases(self, a, b):
+    """Return the full hashes of the best common ancestors of a and b (those
+    which are not ancestors of any other common ancestor), highest generation
+    first.  Usually there is just one."""
+    # Walk down from both commits, highest generation first, painting each
+    # commit with which of them reach it; a commit reached from both is a
+    # common ancestor, and everything below it is "stale".
+    (from_a, from_b, stale) = (1, 2, 4)
+    flags = {}
+    heap = []
+    # How many commits in heap are not stale; once there are none, there is
+    # nothing more to find.  (A parent always has a lower generation than its
+    # children, so every commit in flags which we are not visiting is still in
+    # heap.)
+    live = 0
+    for (commit, flag) in ((a, from_a), (b, from_b)):
+      number = self._Number(commit)
+      if number not in flags:
+        heapq.heappush(heap, (-self._generations[number], number))
+        live += 1
+      flags[number] = flags.get(number, 0) | flag
+    bases = []
+    while live:
+      (_, number) = heapq.heappop(heap)
+      flag = flags[number]
+      if not flag & stale:
+        live -= 1
+      if flag == from_a | from_b:
+        bases.append(self._hashes[number])
+        flag |= stale
+      for parent in self._ParentNumbers(number):
+        if parent not in flags:
+          heapq.heappush(heap, (-self._generations[parent], parent))
+          flags[parent] = 0
+          if not flag & stale:
+            live += 1
+        elif flag & stale and not flags[parent] & stale:
+          live -= 1
+        flags[parent] |= flag
+    return bases
+
+  def merge_base(self, a, b):
+    """Return the full hash of a best common ancestor of a and b, or None if
+    they have none."""
+    bases = self.merge_bases(a, b)
+    return bases[0] if bases else None
+
+  def close(self):
+    """Stop the git process used to resolve revisions."""
+    self._repo.close()
+
+
+def BranchExists(branch_name, cwd=None):
+  """Return True if the repository at cwd (or the current directory) has a
+  local branch named branch_name.
+
+  Args:
+    branch_name: name of the branch, e.g. 'master'
+    cwd: directory within the repository, or None for the current directory
+  """
+  with open(os.devnull, 'w') as devnull:
+    return subprocess.call(
+        [GetGit(), 'show-ref', '--verify', '--quiet',
+         'refs/heads/' + branch_name], cwd=cwd, stdout=devnull) == 0
 
 
 class GitBranch(object):
@@ -99,61 +524,323 @@ class GitBranch(object):
   This class allows one to create a new branch in a repository to make changes,
   then it commits the changes, switches to master branch, and deletes the
   created temporary branch upon exit.
+
+  If in_worktree is True, the branch is checked out in a new worktree (a
+  temporary directory, given by the path attribute) instead, leaving the
+  current checkout alone; make changes there.  The worktree is removed upon
+  exit.
   """
   def __init__(self, branch_name, commit_msg, upload=True, commit_queue=False,
-               delete_when_finished=True):
+               delete_when_finished=True, in_worktree=False):
     self._branch_name = branch_name
     self._commit_msg = commit_msg
     self._upload = upload
     self._commit_queue = commit_queue
     self._patch_set = 0
     self._delete_when_finished = delete_when_finished
+    self._in_worktree = in_worktree
+    self.path = None
+
+  def _git(self, *args):
+    """Return a git command which runs args in our checkout."""
+    if self.path:
+      return [GetGit(), '-C', self.path] + list(args)
+    return [GetGit()] + list(args)
 
   def __enter__(self):
-    shell_utils.run([GIT, 'reset', '--hard', 'HEAD'])
-    shell_utils.run([GIT, 'checkout', 'master'])
-    if self._branch_name in shell_utils.run([GIT, 'branch']):
-      shell_utils.run([GIT, 'branch', '-D', self._branch_name])
-    shell_utils.run([GIT, 'checkout', '-b', self._branch_name,
-                     '-t', 'origin/master'])
+    # 'checkout -B' (re)creates the branch at origin/master and switches to it
+    # in one step, discarding any local changes (with -f), and only rewrites
+    # the files which differ from the current checkout.
+    if self._in_worktree:
+      self.path = tempfile.mkdtemp()
+      try:
+        shell_utils.run([GetGit(), 'worktree', 'add', '-q', '-f', '--track',
+                         '-B', self._branch_name, self.path, 'origin/master'])
+      except BaseException:
+        # __exit__ won't run, so don't leave the directory behind.
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path = None
+        raise
+    else:
+      shell_utils.run([GetGit(), 'checkout', '-q', '-f', '-B',
+                       self._branch_name, '-t', 'origin/master'])
     return self
 
   def commit_and_upload(self, use_commit_queue=False):
     """Commit all changes and upload a CL, returning the issue URL."""
     try:
-      shell_utils.run([GIT, 'commit', '-a', '-m', self._commit_msg])
+      shell_utils.run(self._git('commit', '-a', '-m', self._commit_msg))
     except shell_utils.CommandFailedException as e:
       if not 'nothing to commit' in e.output:
         raise
-    upload_cmd = [GIT, 'cl', 'upload', '-f', '--bypass-hooks',
-                  '--bypass-watchlists']
+    upload_cmd = self._git('cl', 'upload', '-f', '--bypass-hooks',
+                           '--bypass-watchlists')
     self._patch_set += 1
     if self._patch_set > 1:
       upload_cmd.extend(['-t', 'Patch set %d' % self._patch_set])
     if use_commit_queue:
       upload_cmd.append('--use-commit-queue')
     shell_utils.run(upload_cmd)
-    output = shell_utils.run([GIT, 'cl', 'issue']).rstrip()
+    output = shell_utils.run(self._git('cl', 'issue')).rstrip()
     return re.match('^Issue number: (?P<issue>\d+) \((?P<issue_url>.+)\)$',
                     output).group('issue_url')
 
+  def _delete_branch(self):
+    if self._delete_when_finished and BranchExists(self._branch_name):
+      shell_utils.run([GetGit(), 'branch', '-q', '-D', self._branch_name])
+
   def __exit__(self, exc_type, _value, _traceback):
-    if self._upload:
+    try:
       # Only upload if no error occurred.
+      if self._upload and exc_type is None:
+        self.commit_and_upload(use_commit_queue=self._commit_queue)
+    finally:
+      if self._in_worktree:
+        # Removing the worktree doesn't touch the current checkout.
+        shell_utils.run([GetGit(), 'worktree', 'remove', '--force',
+                         self.path])
+        self.path = None
+        self._delete_branch()
+      elif self._upload:
+        shell_utils.run([GetGit(), 'checkout', '-q', 'master'])
+        self._delete_branch()
+
+
+@contextlib.contextmanager
+def _FileLock(path):
+  """Hold an exclusive lock on the file at path (creating it if need be), which
+  excludes other threads and processes using the same path.
+
+  Locking is not supported on Windows, where this does nothing.
+  """
+  with open(path, 'a') as f:
+    if fcntl:
+      fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def UpdateMirror(repository, mirror_dir):
+  """Create or update a local mirror of a repository, and return its path.
+
+  The mirror is a bare repository within mirror_dir, which holds all the refs
+  and objects of repository; once it exists, updating it only fetches what is
+  new.  Callers updating the same mirror at once (in any thread or process)
+  take turns.
+
+  Args:
+    repository: URL or path of the repository to mirror
+    mirror_dir: directory holding mirrors; created if need be
+  Returns:
+    Path of the mirror.
+  """
+  if not os.path.isdir(mirror_dir):
+    try:
+      os.makedirs(mirror_dir)
+    except OSError:
+      # Someone else may have just created it.
+      if not os.path.isdir(mirror_dir):
+        raise
+  # Name the mirror after the repository (e.g. 'common' for both
+  # 'https://skia.googlesource.com/common.git' and '/path/to/common/.git'),
+  # plus a hash of its URL to tell apart repositories with the same name.
+  path = re.sub(r'(/\.git)?/*$', '', repository)
+  name = '%s-%s.git' % (
+      re.sub(r'[^\w.-]', '_', re.sub(r'\.git$', '', os.path.basename(path))),
+      hashlib.sha1(repository).hexdigest()[:8])
+  mirror = os.path.join(mirror_dir, name)
+  with _FileLock(mirror + '.lock'):
+    if not os.path.isdir(mirror):
+      os.mkdir(mirror)
+      subprocess.check_output([GetGit(), 'init', '--bare', '--quiet'],
+                              cwd=mirror)
+      subprocess.check_output([GetGit(), 'remote', 'add', '--mirror=fetch',
+                               'origin', repository], cwd=mirror)
+      # Checkouts borrow objects from the mirror, so never delete any which
+      # are unreachable.
+      subprocess.check_output([GetGit(), 'config', 'gc.pruneExpire', 'never'],
+                              cwd=mirror)
+    subprocess.check_output([GetGit(), 'fetch', '--quiet', '--prune', 'origin'],
+                            cwd=mirror)
+  return mirror
+
+
+def _RemoveInBackground(path):
+  """Delete the directory tree at path on a background thread.
+
+  The tree is renamed out of the way first, so path is gone as soon as this
+  returns.
+
+  Returns:
+    The thread, which the caller may join() to wait for it to finish.
+  """
+  trash = tempfile.mkdtemp(prefix='.deleting-', dir=os.path.dirname(
+      os.path.abspath(path)))
+  os.rename(path, os.path.join(trash, 'tree'))
+  thread = threading.Thread(target=shutil.rmtree, args=(trash, True))
+  thread.start()
+  return thread
+
+
+class GitWorktreePool(object):
+  """A pool of worktrees of one repository, which NewGitCheckout can lease
+  instead of creating and deleting a checkout each time.
+
+  The worktrees share a mirror of the repository (see UpdateMirror), and have
+  detached HEADs.  A worktree is cleaned (with 'git reset --hard' and 'git
+  clean -fdx') when it is returned to the pool, and then checked out at the
+  requested commit when it is next leased; both only touch the files that
+  differ.  This object may be shared between threads.
+  """
+
+  def __init__(self, repository, pool_dir, max_idle=4, max_idle_secs=None):
+    """
+    Args:
+      repository: URL or path of the repository
+      pool_dir: directory to hold the mirror and the worktrees; created if
+          need be
+      max_idle: maximum number of idle worktrees to keep; when more are
+          returned to the pool, the least recently used ones are deleted
+      max_idle_secs: if specified, idle worktrees which have not been used for
+          this many seconds are deleted
+    """
+    self._repository = repository
+    self._pool_dir = pool_dir
+    self._max_idle = max_idle
+    self._max_idle_secs = max_idle_secs
+    self._mirror = None
+    self._lock = threading.Lock()
+    # (path, time.time() when it was returned) for each idle worktree, least
+    # recently used first.
+    self._idle = []
+    # Threads deleting evicted worktrees.
+    self._deletions = []
+
+  def _RunInMirror(self, args):
+    with self._lock:
+      mirror = self._mirror
+    return subprocess.check_output(args=args, cwd=mirror)
+
+  def Lease(self, commit='HEAD', refspec=None, update=True):
+    """Return the path of a worktree checked out at commit, creating one if
+    there are no idle worktrees.
+
+    Args:
+      commit: commit hash, branch or tag to check out; if 'HEAD', the tip of
+          refspec (if specified) or of the repository's HEAD
+      refspec: as for NewGitCheckout
+      update: whether to fetch any new commits into the mirror first
+    """
+    with self._lock:
+      need_mirror = update or not self._mirror
+    if need_mirror:
+      mirror = UpdateMirror(self._repository,
+                            os.path.join(self._pool_dir, 'mirrors'))
+      with self._lock:
+        self._mirror = mirror
+    if commit == 'HEAD' and refspec:
+      commit = refspec.split(':')[0].lstrip('+')
+    commithash = self._RunInMirror(
+        [GetGit(), 'rev-parse', '--verify', '%s^{commit}' % commit]).strip()
+    with self._lock:
+      evicted = self._EvictExpired()
+      path = self._idle.pop()[0] if self._idle else None
+    if evicted:
+      self._Prune()
+    if not path:
+      path = tempfile.mkdtemp(prefix='worktree-', dir=self._pool_dir)
       try:
-        if exc_type is None:
-          self.commit_and_upload(use_commit_queue=self._commit_queue)
-      finally:
-        shell_utils.run([GIT, 'checkout', 'master'])
-        if self._delete_when_finished:
-          shell_utils.run([GIT, 'branch', '-D', self._branch_name])
+        self._RunInMirror([GetGit(), 'worktree', 'add', '--quiet', '--detach',
+                           path, commithash])
+      except BaseException:
+        self._Discard(path)
+        raise
+      return path
+    try:
+      subprocess.check_output(
+          [GetGit(), 'checkout', '--quiet', '--detach', commithash], cwd=path)
+    except BaseException:
+      self._Discard(path)
+      raise
+    return path
+
+  def Release(self, path):
+    """Return a worktree leased by Lease() to the pool.  If it cannot be
+    cleaned, it is deleted instead (without raising an exception, so that we
+    do not hide whatever went wrong while it was leased)."""
+    try:
+      subprocess.check_output([GetGit(), 'reset', '--quiet', '--hard'],
+                              cwd=path, stderr=subprocess.STDOUT)
+      subprocess.check_output([GetGit(), 'clean', '--quiet', '-fdx'],
+                              cwd=path, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+      print 'Deleting worktree %s, which could not be cleaned: %s\n%s' % (
+          path, e, e.output)
+      self._Discard(path)
+      return
+    with self._lock:
+      self._idle.append((path, time.time()))
+      evicted = False
+      while len(self._idle) > self._max_idle:
+        self._Evict(self._idle.pop(0)[0])
+        evicted = True
+      evicted = self._EvictExpired() or evicted
+    if evicted:
+      self._Prune()
+
+  def Close(self):
+    """Delete all the idle worktrees, and wait until every worktree we have
+    evicted is deleted."""
+    with self._lock:
+      evicted = bool(self._idle)
+      while self._idle:
+        self._Evict(self._idle.pop(0)[0])
+      deletions = self._deletions
+      self._deletions = []
+    if evicted:
+      self._Prune()
+    for thread in deletions:
+      thread.join()
+
+  def _EvictExpired(self):
+    """Evict the worktrees which have been idle too long; return True if there
+    were any.  Must be called with self._lock held."""
+    if self._max_idle_secs is None:
+      return False
+    cutoff = time.time() - self._max_idle_secs
+    evicted = False
+    while self._idle and self._idle[0][1] < cutoff:
+      self._Evict(self._idle.pop(0)[0])
+      evicted = True
+    return evicted
+
+  def _Evict(self, path):
+    """Start deleting a worktree; the caller must then call _Prune() (after
+    releasing self._lock).  Must be called with self._lock held."""
+    self._deletions = [t for t in self._deletions if t.is_alive()]
+    if os.path.exists(path):
+      self._deletions.append(_RemoveInBackground(path))
+
+  def _Discard(self, path):
+    """Delete a worktree which is not (or no longer) in the pool."""
+    with self._lock:
+      self._Evict(path)
+    self._Prune()
+
+  def _Prune(self):
+    # Once a worktree has been moved away, 'git worktree prune' forgets it.
+    self._RunInMirror([GetGit(), 'worktree', 'prune'])
 
 
 class NewGitCheckout(object):
   """Creates a new local checkout of a Git repository."""
 
   def __init__(self, repository, refspec=None, commit='HEAD',
-               subdir=None, containing_dir=None):
+               subdir=None, containing_dir=None, depth=None, filter_spec=None,
+               sparse=True, mirror_dir=None, pool=None):
     """Set parameters for this local copy of a Git repository.
 
     Because this is a new checkout, rather than a reference to an existing
@@ -171,23 +858,46 @@ class NewGitCheckout(object):
           'https://skia.googlesource.com/common') or path to a local repository
           (e.g., '/path/to/repo/.git') to check out a copy of
       refspec: which refs (e.g., a branch name) to fetch from the repository;
-          if None, git-fetch will choose the default refs to fetch
+          if None, we fetch its HEAD
       commit: commit hash, branch, or tag within refspec, indicating what point
           to update the local checkout to
       subdir: if specified, the caller only wants access to files within this
-          subdir in the repository.
-          For now, we check out the entire repository regardless of this param,
-          and just hide the rest of the repository; but later on we may
-          optimize performance by only checking out this part of the repo.
+          subdir in the repository.  Unless sparse is False, we use a (cone
+          mode) sparse checkout, so only the files within subdir (and those
+          directly within its parent directories) are written to disk.
       containing_dir: if specified, the new checkout will be created somewhere
           within this directory; otherwise, a system-dependent default location
           will be used, as determined by tempfile.mkdtemp()
+      depth: if specified, only fetch this many commits of history (so commit
+          must be within that many commits of the fetched refs)
+      filter_spec: if specified, a partial clone filter (e.g. 'blob:none') for
+          git-fetch; the objects we leave out are fetched when needed.  Combined
+          with subdir, this means we only fetch the files within subdir.
+          Servers which do not support filters ignore this.
+      sparse: whether to make a sparse checkout if subdir is specified; if
+          False, we check out the entire repository, and just hide the rest of
+          it.  Sparse checkouts require git 2.25 or later.
+      mirror_dir: if specified, keep a mirror of repository within this
+          directory (see UpdateMirror), which persists after the checkout is
+          cleaned up.  We update the mirror, and the checkout then borrows its
+          objects (via git alternates) rather than fetching them, so creating
+          checkouts of the same repository after the first is nearly free.
+          depth and filter_spec are ignored, since nothing needs fetching.
+      pool: if specified, a GitWorktreePool for repository to lease a worktree
+          from (with a detached HEAD), and return it to afterwards, instead of
+          creating and deleting a checkout; containing_dir, depth,
+          filter_spec, sparse and mirror_dir are ignored.
     """
     self._repository = repository
     self._refspec = refspec
     self._commit = commit
     self._subdir = subdir
     self._containing_dir = containing_dir
+    self._depth = depth
+    self._filter_spec = filter_spec
+    self._sparse = sparse
+    self._mirror_dir = mirror_dir
+    self._pool = pool
     self._git_root = None
     self._file_root = None
 
@@ -204,7 +914,7 @@ class NewGitCheckout(object):
   def commithash(self):
     """Returns the commithash of the local checkout."""
     return self._run_in_git_root(
-        args=[GIT, 'rev-parse', 'HEAD']).strip()
+        args=[GetGit(), 'rev-parse', 'HEAD']).strip()
 
   def __enter__(self):
     """Check out a new local copy of the repository.
@@ -213,27 +923,68 @@ class NewGitCheckout(object):
     """
     # _git_root points to the tree holding the git checkout in its entirety;
     # _file_root points to the files the caller wants to look at
-    self._git_root = tempfile.mkdtemp(dir=self._containing_dir)
+    if self._pool:
+      self._git_root = self._pool.Lease(commit=self._commit,
+                                        refspec=self._refspec)
+    else:
+      self._git_root = tempfile.mkdtemp(dir=self._containing_dir)
     if self._subdir:
       self._file_root = os.path.join(self._git_root, self._subdir)
     else:
       self._file_root = self._git_root
+    if self._pool:
+      return self
 
     local_branch_name = 'local'
-    self._run_in_git_root(args=[GIT, 'init'])
-    fetch_cmd = [GIT, 'fetch', self._repository]
-    if self._refspec:
-      fetch_cmd.append(self._refspec)
+    self._run_in_git_root(args=[GetGit(), 'init'])
+    # Whatever init.defaultBranch says, the fetched commit becomes 'master'
+    # (see below).
+    self._run_in_git_root(args=[GetGit(), 'symbolic-ref', 'HEAD',
+                                'refs/heads/master'])
+    # Filtered fetches only work from a named remote, which becomes the
+    # "promisor" we fetch any missing objects from later.
+    self._run_in_git_root(args=[GetGit(), 'remote', 'add', 'origin',
+                                self._repository])
+    if self._subdir and self._sparse:
+      self._run_in_git_root(args=[GetGit(), 'sparse-checkout', 'set', '--cone',
+                                  self._subdir])
+    fetch_cmd = [GetGit(), 'fetch']
+    if self._mirror_dir:
+      # With all the objects available from the mirror, this fetch just sets
+      # FETCH_HEAD.
+      mirror = UpdateMirror(self._repository, self._mirror_dir)
+      with open(os.path.join(self._git_root, '.git', 'objects', 'info',
+                             'alternates'), 'w') as f:
+        f.write(os.path.join(os.path.abspath(mirror), 'objects') + '\n')
+      source = mirror
+    else:
+      if self._depth:
+        fetch_cmd.append('--depth=%d' % self._depth)
+      if self._filter_spec:
+        fetch_cmd.append('--filter=%s' % self._filter_spec)
+      source = 'origin'
+    # Fetching a URL with no refspec would fetch just its HEAD; do the same.
+    fetch_cmd.extend([source, self._refspec or 'HEAD'])
     self._run_in_git_root(args=fetch_cmd)
-    self._run_in_git_root(args=[GIT, 'merge', 'FETCH_HEAD'])
-    self._run_in_git_root(args=[GIT, 'branch', local_branch_name, self._commit])
-    self._run_in_git_root(args=[GIT, 'checkout', local_branch_name])
+    # Point master (and so HEAD) at what we fetched, just as merging
+    # FETCH_HEAD into the new repository would, so that commit may be e.g.
+    # 'master' or 'HEAD~1' as well as a hash, branch or tag we fetched.
+    self._run_in_git_root(args=[GetGit(), 'update-ref', 'HEAD', 'FETCH_HEAD'])
+    # Check out the commit we want directly, so that we only write its files
+    # (and only those within any sparse checkout) to disk once.  (The index is
+    # still empty, so -f is needed to write them at all.)
+    self._run_in_git_root(args=[
+        GetGit(), 'checkout', '-q', '-f', '-b', local_branch_name,
+        self._commit])
 
     return self
 
   # pylint: disable=W0622
   def __exit__(self, type, value, traceback):
-    shutil.rmtree(self._git_root)
+    if self._pool:
+      self._pool.Release(self._git_root)
+    else:
+      shutil.rmtree(self._git_root)
 
   def _run_in_git_root(self, args):
     """Run an external command with cwd set to self._git_root.
@@ -243,3 +994,507 @@ class NewGitCheckout(object):
     Raises an Exception if the command fails.
     """
     return subprocess.check_output(args=args, cwd=self._git_root)
+
+
+class RepoResult(object):
+  """The outcome of an operation on one repository, run by ForEachRepo()."""
+
+  def __init__(self, repository):
+    self.repository = repository
+    # What the operation returned, if it succeeded.
+    self.value = None
+    # The exception the operation raised, if it failed.
+    self.exception = None
+    self.elapsed_secs = None
+
+
+class RepoOperationsFailedException(Exception):
+  """Exception which gets raised when an operation fails for any of the
+  repositories passed to ForEachRepo()."""
+
+  def __init__(self, failures, *args):
+    """Initialize the RepoOperationsFailedException.
+
+    Args:
+        failures: list of RepoResult objects for the repositories for which the
+            operation failed.
+    """
+    Exception.__init__(self, *args)
+    self._failures = failures
+
+  @property
+  def failures(self):
+    """RepoResults for the repositories for which the operation failed."""
+    return self._failures
+
+
+def _Host(repository):
+  """Return the host serving a repository URL (e.g.
+  'https://skia.googlesource.com/common' or 'git@github.com:foo/bar'), or
+  'localhost' for a local path."""
+  if '://' in repository:
+    return urlparse.urlparse(repository).hostname or 'localhost'
+  match = re.match(r'^(?:[^@/]+@)?([^/:]{2,}):', repository)
+  return match.group(1) if match else 'localhost'
+
+
+def _RunGit(args, cwd=None):
+  """Run git with args in cwd, quietly, and return its output.  Throws a
+  CommandFailedException (carrying the output) if it fails."""
+  proc = subprocess.Popen([GetGit()] + args, cwd=cwd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  output = proc.communicate()[0]
+  if proc.returncode != 0:
+    raise shell_utils.CommandFailedException(
+        output, 'git %s failed with code %d in %s' % (
+            ' '.join(args), proc.returncode, cwd or os.getcwd()))
+  return output
+
+
+# Hash of the empty tree, which IterDiffTree() compares against when there is
+# no old tree.
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# One file listed by IterLsTree(): its mode (e.g. '100644'), object type
+# ('blob', or 'commit' for a submodule), object hash, and path within the
+# repository (Posix-style).
+TreeEntry = collections.namedtuple('TreeEntry', ['mode', 'type', 'hash',
+                                                 'path'])
+
+# One file changed between two trees, as yielded by IterDiffTree().  status is
+# 'A' (added), 'D' (deleted), 'M' (modified), 'T' (type changed), or 'R' or 'C'
+# (renamed or copied from old_path, which is None otherwise).  A missing side
+# has mode '000000' and hash '0' * 40.
+DiffEntry = collections.namedtuple('DiffEntry', [
+    'status', 'old_mode', 'new_mode', 'old_hash', 'new_hash', 'path',
+    'old_path'])
+
+
+def _IterNulFields(args, cwd=None, chunk_size=64 * 1024):
+  """Run git with args in cwd, and yield the NUL-terminated fields of its
+  output as they arrive, without holding the whole output in memory.  Throws a
+  CommandFailedException once the output ends, if git failed."""
+  with tempfile.TemporaryFile() as stderr:
+    proc = subprocess.Popen([GetGit()] + args, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=stderr)
+    try:
+      partial = ''
+      while True:
+        chunk = os.read(proc.stdout.fileno(), chunk_size)
+        if not chunk:
+          break
+        fields = (partial + chunk).split('\0')
+        partial = fields.pop()
+        for field in fields:
+          yield field
+      proc.stdout.close()
+      if proc.wait() != 0:
+        stderr.seek(0)
+        raise shell_utils.CommandFailedException(
+            stderr.read(), 'git %s failed with code %d in %s' % (
+                ' '.join(args), proc.returncode, cwd or os.getcwd()))
+    finally:
+      # If the caller stopped early, don't leave git running.
+      if proc.returncode is None:
+        proc.kill()
+        proc.wait()
+
+
+def IterLsTree(treeish, paths=(), cwd=None):
+  """Yield a TreeEntry for each file in a tree, recursively, in the order git
+  lists them.
+
+  Args:
+    treeish: the commit or tree to list, e.g. 'HEAD'
+    paths: if specified, list only files within these paths
+    cwd: directory within the repository, or None for the current directory
+  """
+  for field in _IterNulFields(
+      ['ls-tree', '-r', '-z', '--full-tree', treeish, '--'] + list(paths),
+      cwd=cwd):
+    (info, path) = field.split('\t', 1)
+    (mode, object_type, object_hash) = info.split(' ')
+    yield TreeEntry(mode, object_type, object_hash, path)
+
+
+def IterDiffTree(old, new, paths=(), find_renames=False, cwd=None):
+  """Yield a DiffEntry for each file which differs between two trees,
+  recursively, as git reports them.
+
+  Args:
+    old: the commit or tree to compare from, or None for the empty tree (so
+        that every file in new is 'A')
+    new: the commit or tree to compare to
+    paths: if specified, compare only files within these paths
+    find_renames: if True, report renamed files as a single 'R' entry rather
+        than a 'D' and an 'A'
+    cwd: directory within the repository, or None for the current directory
+  """
+  args = ['diff-tree', '-r', '-z', '--raw', '--no-abbrev']
+  if find_renames:
+    args.append('-M')
+  fields = _IterNulFields(
+      args + [old or EMPTY_TREE, new, '--'] + list(paths), cwd=cwd)
+  for info in fields:
+    # Each entry is ':old_mode new_mode old_hash new_hash status', then the
+    # path, then (for renames and copies) the new path.
+    (old_mode, new_mode, old_hash, new_hash, status) = info[1:].split(' ')
+    path = next(fields)
+    old_path = None
+    if status[0] in 'RC':
+      (old_path, path) = (path, next(fields))
+    yield DiffEntry(status[0], old_mode, new_mode, old_hash, new_hash, path,
+                    old_path)
+
+
+# Modes of regular files (rather than symlinks or submodules) in a git tree.
+_REGULAR_FILE_MODES = ('100644', '100755')
+
+
+def IterChangedPaths(old, new, paths=(), cwd=None):
+  """Yield the path of each regular file which exists in new but is absent or
+  different in old, e.g. to upload a checkout incrementally:
+
+    gs.upload_dir_contents(source_dir=checkout, ..., rel_paths=
+        git_utils.IterChangedPaths(old_commit, 'HEAD', cwd=checkout))
+
+  Symlinks and submodules are skipped, since they are not files whose contents
+  could be uploaded; use IterDiffTree() to see those.
+
+  Args are as for IterDiffTree().
+  """
+  for entry in IterDiffTree(old, new, paths=paths, cwd=cwd):
+    if entry.status != 'D' and entry.new_mode in _REGULAR_FILE_MODES:
+      yield entry.path
+
+
+def ForEachRepo(repositories, func, max_parallel=8, max_per_host=4,
+                host_func=_Host, name_func=str, echo=None,
+                raise_on_failure=True):
+  """Call func(repository) for each of repositories in parallel, and return a
+  list of RepoResults in the same order (Blocking).
+
+  Each call runs on its own thread, but at most max_parallel run at once, and
+  at most max_per_host for repositories served by the same host (so that we do
+  not overload any one server).
+
+  Args:
+    repositories: list of repository URLs or paths (or anything else host_func
+        accepts)
+    func: function to call for each repository; what it returns becomes the
+        RepoResult's value
+    max_parallel: maximum number of calls to run at once
+    max_per_host: maximum number of calls to run at once for each host
+    host_func: function returning the host which serves a repository
+    name_func: function returning how to refer to a repository when printing
+        timings or reporting failures
+    echo: boolean indicating whether to print how long each call took
+    raise_on_failure: if True, throw a RepoOperationsFailedException listing
+        every repository for which func raised an exception; otherwise just
+        record each exception in its RepoResult
+  Returns:
+    A list of RepoResult objects.
+  """
+  if echo is None:
+    echo = shell_utils.VERBOSE
+  results = [RepoResult(r) for r in repositories]
+  limit = threading.Semaphore(max_parallel)
+  host_limits = dict((host_func(r), threading.Semaphore(max_per_host))
+                     for r in repositories)
+
+  def run(result):
+    with host_limits[host_func(result.repository)]:
+      with limit:
+        t_0 = time.time()
+        try:
+          result.value = func(result.repository)
+        except Exception as e:
+          result.exception = e
+        result.elapsed_secs = time.time() - t_0
+
+  threads = [threading.Thread(target=run, args=(result,))
+             for result in results]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  failures = [r for r in results if r.exception]
+  if echo:
+    for result in results:
+      print '%7.2fs %s%s' % (result.elapsed_secs,
+                             name_func(result.repository),
+                             ' FAILED: %s' % result.exception
+                             if result.exception else '')
+  if failures and raise_on_failure:
+    raise RepoOperationsFailedException(
+        failures, 'Failed for %d of %d repositories: %s' % (
+            len(failures), len(results),
+            [name_func(f.repository) for f in failures]))
+  return results
+
+
+def FetchMany(checkout_dirs, remote=None, **kwargs):
+  """Run "git fetch" in each of checkout_dirs in parallel.  kwargs are passed
+  on to ForEachRepo(), which limits the fetches per host of the remote."""
+  def remote_host(checkout_dir):
+    try:
+      return _Host(_RunGit(['config', 'remote.%s.url' % (remote or 'origin')],
+                           cwd=checkout_dir).strip())
+    except shell_utils.CommandFailedException:
+      return 'localhost'
+  return ForEachRepo(
+      checkout_dirs,
+      lambda d: _RunGit(['fetch'] + ([remote] if remote else []), cwd=d),
+      host_func=remote_host, **kwargs)
+
+
+def LsRemoteMany(git_urls, refs=(), **kwargs):
+  """Run "git ls-remote" for each of git_urls in parallel.  Each RepoResult's
+  value is a dict mapping each ref (limited to refs, if given) to its hash.
+  kwargs are passed on to ForEachRepo()."""
+  def ls_remote(git_url):
+    output = _RunGit(['ls-remote', git_url] + list(refs))
+    hashes = dict(reversed(line.split('\t', 1))
+                  for line in output.splitlines() if '\t' in line)
+    if refs:
+      # ls-remote matches refs against the tails of ref names, so 'HEAD' would
+      # also give us e.g. 'refs/remotes/origin/HEAD'.
+      hashes = dict((ref, h) for (ref, h) in hashes.iteritems() if ref in refs)
+    return hashes
+  return ForEachRepo(git_urls, ls_remote, **kwargs)
+
+
+def GetRemoteMasterHashes(git_urls, **kwargs):
+  """Like GetRemoteMasterHash(), for each of git_urls in parallel.  Each
+  RepoResult's value is the hash.  kwargs are passed on to ForEachRepo()."""
+  results = LsRemoteMany(git_urls, refs=['refs/heads/master'], **kwargs)
+  for result in results:
+    if result.value is not None:
+      result.value = result.value.get('refs/heads/master')
+  return results
+
+
+@contextlib.contextmanager
+def NewGitCheckouts(checkouts, **kwargs):
+  """Check out each of checkouts (NewGitCheckout objects) in parallel, and
+  clean them all up afterwards.  kwargs are passed on to ForEachRepo().
+
+  with NewGitCheckouts([NewGitCheckout(...), NewGitCheckout(...)]) as results:
+    # use each results[i].value, the entered NewGitCheckout
+  """
+  kwargs.setdefault('host_func', lambda c: _Host(c._repository))
+  kwargs.setdefault('name_func', lambda c: c._repository)
+  cleanup_kwargs = dict(kwargs, echo=False)
+  try:
+    results = ForEachRepo(checkouts, lambda c: c.__enter__(), **kwargs)
+  except RepoOperationsFailedException:
+    # Clean up those which we did check out.
+    ForEachRepo([c for c in checkouts if c._git_root and
+                 os.path.isdir(c._git_root)],
+                lambda c: c.__exit__(None, None, None),
+                **dict(cleanup_kwargs, raise_on_failure=False))
+    raise
+  try:
+    yield results
+  except BaseException:
+    # Don't let a failure to clean up hide why we are unwinding.
+    ForEachRepo(checkouts, lambda c: c.__exit__(None, None, None),
+                **dict(cleanup_kwargs, raise_on_failure=False))
+    raise
+  ForEachRepo(checkouts, lambda c: c.__exit__(None, None, None),
+              **cleanup_kwargs)
+
+
+class _RemoteRefs(object):
+  """What a RemoteRefWatcher knows about one remote."""
+
+  def __init__(self, interval_secs):
+    # Held while fetching, so that callers share one fetch.
+    self.lock = threading.Lock()
+    # Dict mapping each ref to its hash, or None until the first fetch.
+    self.refs = None
+    # Hash of the last 'git ls-remote' output, to tell whether it changed.
+    self.digest = None
+    self.fetched_at = None
+    self.interval_secs = interval_secs
+    self.subscribers = []
+
+
+class RemoteRefWatcher(object):
+  """Keeps track of the refs of remote repositories, running 'git ls-remote'
+  at most once per interval per remote however many callers ask, and telling
+  subscribers when they change.
+
+  While a remote's refs stay the same, we check it less and less often (up to
+  max_interval_secs); as soon as they change, we go back to checking every
+  interval_secs.  So callers get refs which may be that old, unless they ask
+  for fresher ones.  This object may be shared between threads.
+  """
+
+  def __init__(self, interval_secs=10, max_interval_secs=300,
+               backoff_factor=2):
+    """
+    Args:
+      interval_secs: how long to reuse a remote's refs while they are changing
+      max_interval_secs: how long to reuse a remote's refs at most, once they
+          have stopped changing
+      backoff_factor: how much longer to wait before the next check, each time
+          a check finds no change
+    """
+    self._interval_secs = interval_secs
+    self._max_interval_secs = max_interval_secs
+    self._backoff_factor = backoff_factor
+    self._lock = threading.Lock()
+    self._remotes = {}
+    self._thread = None
+    self._stop = threading.Event()
+
+  def _Remote(self, git_url):
+    with self._lock:
+      if git_url not in self._remotes:
+        self._remotes[git_url] = _RemoteRefs(self._interval_secs)
+      return self._remotes[git_url]
+
+  def _Refresh(self, git_url, remote, max_age_secs):
+    """Fetch the refs of the remote, unless we already have some which are at
+    most max_age_secs old (or as old as its current interval, if None).
+    Return the refs, and call any subscribers if they changed."""
+    with remote.lock:
+      if max_age_secs is None:
+        max_age_secs = remote.interval_secs
+      if remote.fetched_at and time.time() - remote.fetched_at < max_age_secs:
+        return remote.refs
+      output = _RunGit(['ls-remote', git_url])
+      remote.fetched_at = time.time()
+      digest = hashlib.sha1(output).hexdigest()
+      if digest == remote.digest:
+        remote.interval_secs = min(
+            remote.interval_secs * self._backoff_factor,
+            self._max_interval_secs)
+        return remote.refs
+      old_refs = remote.refs
+      remote.refs = dict(reversed(line.split('\t', 1))
+                         for line in output.splitlines() if '\t' in line)
+      remote.digest = digest
+      remote.interval_secs = self._interval_secs
+      new_refs = remote.refs
+      subscribers = list(remote.subscribers)
+    for callback in subscribers:
+      callback(git_url, old_refs, new_refs)
+    return new_refs
+
+  def refs(self, git_url, max_age_secs=None):
+    """Return a dict mapping each ref of the remote to its hash.
+
+    Args:
+      git_url: URL of the remote repository
+      max_age_secs: if specified, fetch the refs unless we fetched them at
+          most this many seconds ago; otherwise reuse them for the remote's
+          current interval
+    """
+    return dict(self._Refresh(git_url, self._Remote(git_url), max_age_secs))
+
+  def ref_hash(self, git_url, ref='refs/heads/master', max_age_secs=None):
+    """Return the hash a ref of the remote points to, or None if there is no
+    such ref.  Like GetRemoteMasterHash(), but cached as for refs()."""
+    return self.refs(git_url, max_age_secs=max_age_secs).get(ref)
+
+  def subscribe(self, git_url, callback):
+    """Arrange for callback(git_url, old_refs, new_refs) to be called whenever
+    poll() (or any other caller) finds that the refs of the remote have
+    changed.  old_refs is None the first time they are fetched."""
+    remote = self._Remote(git_url)
+    with remote.lock:
+      remote.subscribers.append(callback)
+
+  def unsubscribe(self, git_url, callback):
+    """Undo subscribe()."""
+    remote = self._Remote(git_url)
+    with remote.lock:
+      remote.subscribers.remove(callback)
+
+  def poll(self):
+    """Check each remote with subscribers whose interval has passed, in
+    parallel (see ForEachRepo()), and return the number of seconds until the
+    next one is due.  Errors are printed, and the remote retried once its
+    (backed off) interval passes again."""
+    with self._lock:
+      remotes = [(git_url, remote)
+                 for (git_url, remote) in self._remotes.iteritems()
+                 if remote.subscribers]
+    now = time.time()
+    due = [git_url for (git_url, remote) in remotes
+           if (remote.fetched_at or 0) + remote.interval_secs <= now]
+    if due:
+      def refresh(git_url):
+        remote = self._Remote(git_url)
+        try:
+          self._Refresh(git_url, remote, max_age_secs=0)
+        except shell_utils.CommandFailedException:
+          # Don't hammer a failing remote either.
+          with remote.lock:
+            remote.fetched_at = time.time()
+            remote.interval_secs = min(
+                remote.interval_secs * self._backoff_factor,
+                self._max_interval_secs)
+          raise
+      for result in ForEachRepo(due, refresh, echo=False,
+                                raise_on_failure=False):
+        if result.exception:
+          print 'Failed to check %s: %s' % (result.repository,
+                                            result.exception)
+    now = time.time()
+    next_due = self._max_interval_secs
+    for (_, remote) in remotes:
+      next_due = min(next_due,
+                     (remote.fetched_at or 0) + remote.interval_secs - now)
+    return max(0, next_due)
+
+  def start(self):
+    """Start calling poll() on a background thread, as often as needed, until
+    stop() is called."""
+    def loop():
+      while not self._stop.is_set():
+        self._stop.wait(self.poll())
+    self._stop.clear()
+    self._thread = threading.Thread(target=loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stop the background thread started by start()."""
+    self._stop.set()
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+
+
+class _GitUtilsModule(types.ModuleType):
+  """What importers of this module get in its place: the module itself, except
+  that reading GIT calls GetGit().
+
+  GIT used to be found when this module was imported; this keeps code which
+  still uses git_utils.GIT working without making every import pay for that.
+  New code should call GetGit().
+  """
+
+  def __init__(self, module):
+    types.ModuleType.__init__(self, module.__name__, module.__doc__)
+    self.__dict__['_module'] = module
+
+  def __getattr__(self, name):
+    if name == 'GIT':
+      return GetGit()
+    return getattr(self._module, name)
+
+  def __setattr__(self, name, value):
+    setattr(self._module, name, value)
+
+  def __delattr__(self, name):
+    delattr(self._module, name)
+
+  def __dir__(self):
+    return sorted(set(dir(self._module)) | set(['GIT']))
+
+
+sys.modules[__name__] = _GitUtilsModule(sys.modules[__name__])
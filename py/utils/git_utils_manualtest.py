@@ -10,8 +10,12 @@ Test git_utils.py.
 """
 
 # System-level imports
+import glob
 import os
+import shutil
+import subprocess
 import tempfile
+import time
 import unittest
 
 # Imports from within Skia
@@ -73,6 +77,98 @@ class NewGitCheckoutTest(unittest.TestCase):
     finally:
       os.rmdir(containing_dir)
 
+  def test_commit_names(self):
+    """Test NewGitCheckout with commit given as a branch name or a relative
+    revision, rather than a hash."""
+    local_master = subprocess.check_output(
+        [git_utils.GetGit(), 'rev-parse', 'master'], cwd=LOCAL_REPO).strip()
+    for (refspec, commit, expected) in (
+        ('master', 'master', local_master),
+        ('master', 'HEAD~1', local_master + '~1'),
+        (None, 'HEAD', 'HEAD')):
+      expected = subprocess.check_output(
+          [git_utils.GetGit(), 'rev-parse', expected], cwd=LOCAL_REPO).strip()
+      with git_utils.NewGitCheckout(repository=LOCAL_REPO, refspec=refspec,
+                                    commit=commit) as checkout:
+        self.assertEquals(checkout.commithash(), expected)
+        self.assertTrue(os.path.exists(os.path.join(checkout.root,
+                                                    REPO_FILE)))
+
+  def test_shallow_sparse(self):
+    """Create NewGitCheckout of one commit of a subdirectory."""
+    subdir = os.path.dirname(REPO_FILE)
+    with git_utils.NewGitCheckout(repository=LOCAL_REPO, subdir=subdir,
+                                  depth=1, filter_spec='blob:none') as checkout:
+      filepath = os.path.join(checkout.root, os.path.basename(REPO_FILE))
+      self.assertTrue(
+          os.path.exists(filepath),
+          'file %s should exist' % filepath)
+      self.assertEquals(
+          '1', checkout._run_in_git_root(
+              args=[git_utils.GetGit(), 'rev-list', '--count', 'HEAD']).strip())
+      self.assertEquals(
+          [subdir], checkout._run_in_git_root(
+              args=[git_utils.GetGit(), 'sparse-checkout',
+                    'list']).splitlines())
+
+  def test_mirror(self):
+    """Create NewGitCheckouts which borrow objects from a local mirror."""
+    mirror_dir = tempfile.mkdtemp()
+    try:
+      for _ in range(2):
+        with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                      mirror_dir=mirror_dir) as checkout:
+          filepath = os.path.join(checkout.root, REPO_FILE)
+          self.assertTrue(
+              os.path.exists(filepath),
+              'file %s should exist' % filepath)
+          self.assertEquals(
+              '0', checkout._run_in_git_root(
+                  args=[git_utils.GetGit(), 'count-objects']).split()[0])
+      self.assertEquals(len(glob.glob(os.path.join(mirror_dir, '*.git'))), 1)
+    finally:
+      shutil.rmtree(mirror_dir)
+
+  def test_pool(self):
+    """Create NewGitCheckouts which lease worktrees from a pool."""
+    pool_dir = tempfile.mkdtemp()
+    try:
+      pool = git_utils.GitWorktreePool(repository=LOCAL_REPO,
+                                       pool_dir=pool_dir, max_idle=1)
+      with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                    pool=pool) as checkout:
+        root = checkout.root
+        with open(os.path.join(root, REPO_FILE), 'a') as f:
+          f.write('modified')
+        open(os.path.join(root, 'untracked'), 'w').close()
+        with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                      pool=pool) as other:
+          self.assertNotEquals(other.root, root)
+          other_root = other.root
+      # The idle worktree is reused, cleaned; the other one was evicted.
+      with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                    pool=pool) as checkout:
+        self.assertEquals(checkout.root, root)
+        self.assertEquals(checkout._run_in_git_root(
+            args=[git_utils.GetGit(), 'status', '--porcelain']), '')
+      self.assertFalse(os.path.exists(other_root))
+
+      # A worktree which cannot be cleaned is deleted, not returned to the
+      # pool, and the error does not mask the caller's.
+      with self.assertRaises(ValueError):
+        with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                      pool=pool) as checkout:
+          root = checkout.root
+          os.remove(os.path.join(root, '.git'))
+          raise ValueError()
+      self.assertFalse(os.path.exists(root))
+      with git_utils.NewGitCheckout(repository=LOCAL_REPO,
+                                    pool=pool) as checkout:
+        self.assertNotEquals(checkout.root, root)
+      pool.Close()
+    finally:
+      shutil.rmtree(pool_dir)
+
   def test_commit(self):
     """Create NewGitCheckout with a specific commit.
 
@@ -106,13 +202,380 @@ class NewGitCheckoutTest(unittest.TestCase):
           'file %s should exist' % filepath)
 
 
-def main(test_case_class):
-  """Run the unit tests within this class."""
-  suite = unittest.TestLoader().loadTestsFromTestCase(NewGitCheckoutTest)
+class GetGitTest(unittest.TestCase):
+
+  def test_git_constant(self):
+    """Test that git_utils.GIT still names the git executable, and that
+    setting module attributes still reaches the module's functions."""
+    self.assertEquals(git_utils.GIT, git_utils.GetGit())
+    self.assertIn('GIT', dir(git_utils))
+    self.assertTrue(subprocess.check_output(
+        [git_utils.GIT, '--version']).startswith('git version'))
+    old_cache_file = git_utils.GIT_UTILS_CACHE_FILE
+    tempdir = tempfile.mkdtemp()
+    git_utils.GIT_UTILS_CACHE_FILE = os.path.join(tempdir, 'cache')
+    try:
+      git_utils._WriteGitCache('/bin/git', 123)
+      self.assertTrue(git_utils._ReadGitCache('/bin/git', 123))
+    finally:
+      git_utils.GIT_UTILS_CACHE_FILE = old_cache_file
+      shutil.rmtree(tempdir)
+
+
+class GitRepoTest(unittest.TestCase):
+
+  def setUp(self):
+    """Create a repo with history: a - b - d (merging c) - e, a - c."""
+    self._dir = tempfile.mkdtemp()
+    self._commits = {}
+    def git(*args):
+      return subprocess.check_output([git_utils.GetGit()] + list(args),
+                                     cwd=self._dir)
+    def commit(name):
+      git('commit', '--quiet', '--allow-empty', '-m', name)
+      self._commits[name] = git('rev-parse', 'HEAD').strip()
+    git('init', '--quiet')
+    git('config', 'user.email', 'test@example.com')
+    git('config', 'user.name', 'Test')
+    commit('a')
+    git('checkout', '--quiet', '-b', 'side')
+    commit('c')
+    git('checkout', '--quiet', '-')
+    commit('b')
+    git('merge', '--quiet', '--no-ff', '-m', 'd', 'side')
+    self._commits['d'] = git('rev-parse', 'HEAD').strip()
+    commit('e')
+    self._repo = git_utils.GitRepo(self._dir)
+
+  def tearDown(self):
+    self._repo.close()
+    shutil.rmtree(self._dir)
+
+  def test_full_hashes(self):
+    """Test GitRepo.full_hashes()."""
+    c = self._commits
+    self.assertEquals(self._repo.full_hashes(['HEAD', 'side', c['a'][:10]]),
+                      [c['e'], c['c'], c['a']])
+    with self.assertRaises(git_utils.shell_utils.CommandFailedException):
+      self._repo.full_hashes(['HEAD', 'no-such-branch'])
+
+  def test_full_hashes_ambiguous_ref(self):
+    """Test that git's warning about an ambiguous ref name is not mistaken
+    for an answer, to this query or the next."""
+    c = self._commits
+    for args in (['branch', 'foo', c['b']], ['tag', 'foo', c['b']]):
+      subprocess.check_call([git_utils.GetGit()] + args, cwd=self._dir)
+    self.assertEquals(self._repo.full_hashes(['foo']), [c['b']])
+    self.assertEquals(self._repo.full_hashes(['HEAD~1', 'HEAD']),
+                      [c['d'], c['e']])
+
+  def test_is_merge_many(self):
+    """Test GitRepo.is_merge_many()."""
+    names = ['a', 'b', 'c', 'd', 'e']
+    self.assertEquals(
+        self._repo.is_merge_many([self._commits[n] for n in names]),
+        [False, False, False, True, False])
+
+  def test_ancestry_matrix(self):
+    """Test GitRepo.ancestry_matrix()."""
+    names = ['a', 'b', 'c', 'd', 'e']
+    ancestors = {'a': 'abcde', 'b': 'bde', 'c': 'cde', 'd': 'de', 'e': 'e'}
+    commits = [self._commits[n] for n in names]
+    self.assertEquals(
+        self._repo.ancestry_matrix(commits, commits),
+        [[d in ancestors[a] for d in names] for a in names])
+    self.assertFalse(self._repo.is_ancestor('side', 'HEAD~1^1'))
+
+  def test_commit_graph(self):
+    """Test CommitGraph."""
+    c = self._commits
+    graph = git_utils.CommitGraph(self._dir)
+    try:
+      self.assertEquals(len(graph), 5)
+      self.assertEquals([graph.is_merge(c[n]) for n in 'abcde'],
+                        [False, False, False, True, False])
+      self.assertEquals(graph.parents(c['d']), [c['b'], c['c']])
+      ancestors = {'a': 'abcde', 'b': 'bde', 'c': 'cde', 'd': 'de', 'e': 'e'}
+      for a in 'abcde':
+        for d in 'abcde':
+          self.assertEquals(graph.is_ancestor(c[a], c[d]), d in ancestors[a],
+                            '%s, %s' % (a, d))
+      self.assertEquals(graph.merge_bases(c['b'], c['c']), [c['a']])
+      self.assertEquals(graph.merge_base('side', 'HEAD'), c['c'])
+
+      subprocess.check_output([git_utils.GetGit(), 'commit', '--quiet',
+                               '--allow-empty', '-m', 'f'], cwd=self._dir)
+      self.assertEquals(graph.update(), 1)
+      self.assertTrue(graph.is_ancestor(c['c'], 'HEAD'))
+      self.assertEquals(graph.update(), 0)
+    finally:
+      graph.close()
+
+
+class IterTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._git('init', '--quiet')
+    self._git('config', 'user.email', 'test@example.com')
+    self._git('config', 'user.name', 'Test')
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _git(self, *args):
+    return subprocess.check_output([git_utils.GetGit()] + list(args),
+                                   cwd=self._dir)
+
+  def _write(self, path, contents):
+    path = os.path.join(self._dir, path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(contents)
+
+  def _commit(self):
+    self._git('add', '-A')
+    self._git('commit', '--quiet', '-m', 'commit')
+    return self._git('rev-parse', 'HEAD').strip()
+
+  def test_ls_tree_and_diff_tree(self):
+    """Test IterLsTree(), IterDiffTree() and IterChangedPaths()."""
+    self._write('a', 'contents of a')
+    self._write('sub/b with space', 'contents of b')
+    self._write('sub/c', 'contents of c')
+    old = self._commit()
+    self.assertEquals(
+        [(e.mode, e.type, e.path)
+         for e in git_utils.IterLsTree(old, cwd=self._dir)],
+        [('100644', 'blob', 'a'), ('100644', 'blob', 'sub/b with space'),
+         ('100644', 'blob', 'sub/c')])
+    self.assertEquals(
+        [e.path for e in git_utils.IterLsTree(old, paths=['sub'],
+                                             cwd=self._dir)],
+        ['sub/b with space', 'sub/c'])
+
+    self._write('a', 'new contents of a')
+    self._write('d', 'contents of d')
+    os.rename(os.path.join(self._dir, 'sub', 'c'),
+              os.path.join(self._dir, 'sub', 'e'))
+    os.remove(os.path.join(self._dir, 'sub', 'b with space'))
+    new = self._commit()
+    entries = list(git_utils.IterDiffTree(old, new, find_renames=True,
+                                          cwd=self._dir))
+    self.assertEquals([(e.status, e.path, e.old_path) for e in entries],
+                      [('M', 'a', None), ('A', 'd', None),
+                       ('D', 'sub/b with space', None),
+                       ('R', 'sub/e', 'sub/c')])
+    self.assertEquals(entries[0].new_hash,
+                      self._git('rev-parse', new + ':a').strip())
+    self.assertEquals(entries[1].old_hash, '0' * 40)
+    self.assertEquals(
+        list(git_utils.IterChangedPaths(old, new, cwd=self._dir)),
+        ['a', 'd', 'sub/e'])
+    self.assertEquals(
+        len(list(git_utils.IterDiffTree(None, old, cwd=self._dir))), 3)
+    with self.assertRaises(git_utils.shell_utils.CommandFailedException):
+      list(git_utils.IterDiffTree(old, 'no-such-commit', cwd=self._dir))
+
+  def test_changed_paths_skips_links(self):
+    """Test that IterChangedPaths() skips symlinks and submodules."""
+    self._write('a', 'contents of a')
+    old = self._commit()
+    self._write('b', 'contents of b')
+    os.chmod(os.path.join(self._dir, 'b'), 0755)
+    os.symlink('a', os.path.join(self._dir, 'link'))
+    self._git('add', '-A')
+    self._git('update-index', '--add', '--cacheinfo', '160000', old, 'sub')
+    self._git('commit', '--quiet', '-m', 'commit')
+    self.assertEquals(
+        sorted(e.new_mode for e in git_utils.IterDiffTree(old, 'HEAD',
+                                                          cwd=self._dir)),
+        ['100755', '120000', '160000'])
+    self.assertEquals(
+        list(git_utils.IterChangedPaths(old, 'HEAD', cwd=self._dir)), ['b'])
+
+
+class MultiRepoTest(unittest.TestCase):
+
+  def test_ls_remote_many(self):
+    """Test LsRemoteMany(), including how it reports failures."""
+    # A clone has refs/remotes/origin/HEAD, which must not match 'HEAD'.
+    clone = tempfile.mkdtemp()
+    try:
+      subprocess.check_call([git_utils.GetGit(), 'clone', '--quiet',
+                             '--shared', LOCAL_REPO, clone])
+      results = git_utils.LsRemoteMany([clone] * 3, refs=['HEAD'], echo=False)
+      head = subprocess.check_output(
+          [git_utils.GetGit(), 'rev-parse', 'HEAD'], cwd=clone).strip()
+    finally:
+      shutil.rmtree(clone)
+    self.assertEquals([r.value for r in results], [{'HEAD': head}] * 3)
+    self.assertTrue(all(r.elapsed_secs >= 0 for r in results))
+
+    missing_repo = tempfile.mkdtemp()
+    os.rmdir(missing_repo)
+    with self.assertRaises(git_utils.RepoOperationsFailedException) as cm:
+      git_utils.LsRemoteMany([LOCAL_REPO, missing_repo], echo=False)
+    self.assertEquals([f.repository for f in cm.exception.failures],
+                      [missing_repo])
+
+  def test_new_git_checkouts(self):
+    """Test NewGitCheckouts()."""
+    with git_utils.NewGitCheckouts(
+        [git_utils.NewGitCheckout(repository=LOCAL_REPO) for _ in range(3)],
+        echo=False) as results:
+      roots = [r.value.root for r in results]
+      self.assertEquals(len(set(roots)), 3)
+      for root in roots:
+        self.assertTrue(os.path.exists(os.path.join(root, REPO_FILE)))
+    for root in roots:
+      self.assertFalse(os.path.exists(root))
+
+    # An exception from the body is what the caller sees.
+    with self.assertRaises(ValueError):
+      with git_utils.NewGitCheckouts(
+          [git_utils.NewGitCheckout(repository=LOCAL_REPO)],
+          echo=False) as results:
+        root = results[0].value.root
+        raise ValueError()
+    self.assertFalse(os.path.exists(root))
+
+
+class RemoteRefWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._git('init', '--quiet')
+    self._git('config', 'user.email', 'test@example.com')
+    self._git('config', 'user.name', 'Test')
+    self._commit()
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _git(self, *args):
+    return subprocess.check_output([git_utils.GetGit()] + list(args),
+                                   cwd=self._dir)
+
+  def _commit(self):
+    self._git('commit', '--quiet', '--allow-empty', '-m', 'commit')
+    return self._git('rev-parse', 'HEAD').strip()
+
+  def test_watcher(self):
+    """Test that RemoteRefWatcher caches refs, and tells subscribers about
+    changes, checking less often while nothing changes."""
+    watcher = git_utils.RemoteRefWatcher(interval_secs=0.1,
+                                         max_interval_secs=10)
+    changes = []
+    watcher.subscribe(self._dir, lambda url, old, new: changes.append(new))
+    head = self._git('rev-parse', 'HEAD').strip()
+    watcher.poll()
+    self.assertEquals(len(changes), 1)
+    self.assertEquals(watcher.ref_hash(self._dir), head)
+
+    # The refs are cached until the interval passes.
+    head = self._commit()
+    self.assertNotEquals(watcher.ref_hash(self._dir), head)
+    time.sleep(0.1)
+    watcher.poll()
+    self.assertEquals(len(changes), 2)
+    self.assertEquals(changes[-1]['refs/heads/master'], head)
+
+    # Without changes, subscribers hear nothing, and we back off.
+    time.sleep(0.1)
+    self.assertGreater(watcher.poll(), 0.15)
+    self.assertEquals(len(changes), 2)
+    self.assertEquals(watcher.ref_hash(self._dir, max_age_secs=0), head)
+
+
+class GitBranchTest(unittest.TestCase):
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._origin = os.path.join(self._dir, 'origin')
+    self._checkout = os.path.join(self._dir, 'checkout')
+    os.mkdir(self._origin)
+    self._git(self._origin, 'init', '--quiet')
+    self._git(self._origin, 'checkout', '-q', '-b', 'master')
+    with open(os.path.join(self._origin, 'file'), 'w') as f:
+      f.write('contents')
+    self._git(self._origin, 'add', 'file')
+    self._git(self._origin, '-c', 'user.email=test@example.com',
+              '-c', 'user.name=Test', 'commit', '--quiet', '-m', 'commit')
+    self._git(self._dir, 'clone', '--quiet', self._origin, self._checkout)
+    self._old_cwd = os.getcwd()
+    os.chdir(self._checkout)
+
+  def tearDown(self):
+    os.chdir(self._old_cwd)
+    shutil.rmtree(self._dir)
+
+  def _git(self, cwd, *args):
+    return subprocess.check_output([git_utils.GetGit()] + list(args),
+                                   cwd=cwd)
+
+  def _current_branch(self):
+    return self._git(self._checkout, 'rev-parse', '--abbrev-ref',
+                     'HEAD').strip()
+
+  def test_branch(self):
+    """Test GitBranch in the current checkout, replacing a stale branch."""
+    self._git(self._checkout, 'branch', 'my-branch')
+    with open('file', 'w') as f:
+      f.write('local changes')
+    with git_utils.GitBranch('my-branch', 'message', upload=False):
+      self.assertEquals(self._current_branch(), 'my-branch')
+      self.assertEquals(
+          self._git(self._checkout, 'rev-parse', '--abbrev-ref',
+                    'my-branch@{upstream}').strip(), 'origin/master')
+      with open('file') as f:
+        self.assertEquals(f.read(), 'contents')
+
+  def test_worktree(self):
+    """Test GitBranch in a separate worktree, which leaves the current
+    checkout alone."""
+    with git_utils.GitBranch('my-branch', 'message', upload=False,
+                             in_worktree=True) as branch:
+      self.assertEquals(self._current_branch(), 'master')
+      self.assertTrue(git_utils.BranchExists('my-branch'))
+      self.assertTrue(os.path.exists(os.path.join(branch.path, 'file')))
+      self.assertEquals(
+          self._git(branch.path, 'rev-parse', '--abbrev-ref', 'HEAD').strip(),
+          'my-branch')
+      path = branch.path
+    self.assertFalse(os.path.exists(path))
+    self.assertFalse(git_utils.BranchExists('my-branch'))
+    self.assertTrue(git_utils.BranchExists('master'))
+
+  def test_worktree_failure(self):
+    """Test that GitBranch removes its directory if it can't add the
+    worktree."""
+    self._git(self._checkout, 'update-ref', '-d', 'refs/remotes/origin/master')
+    tmp = os.path.join(self._dir, 'tmp')
+    os.mkdir(tmp)
+    old_tempdir = tempfile.tempdir
+    tempfile.tempdir = tmp
+    try:
+      branch = git_utils.GitBranch('my-branch', 'message', upload=False,
+                                   in_worktree=True)
+      with self.assertRaises(git_utils.shell_utils.CommandFailedException):
+        branch.__enter__()
+    finally:
+      tempfile.tempdir = old_tempdir
+    self.assertEquals(os.listdir(tmp), [])
+    self.assertIsNone(branch.path)
+
+
+def main(test_case_classes):
+  """Run the unit tests within these classes."""
+  suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(c)
+                              for c in test_case_classes])
   results = unittest.TextTestRunner(verbosity=2).run(suite)
   if not results.wasSuccessful():
-    raise Exception('failed unittest %s' % test_case_class)
+    raise Exception('failed unittests %s' % test_case_classes)
 
 
 if __name__ == '__main__':
-  main(NewGitCheckoutTest)
+  main([NewGitCheckoutTest, GetGitTest, GitRepoTest, IterTreeTest, MultiRepoTest,
+        RemoteRefWatcherTest, GitBranchTest])
@@ -17,35 +17,54 @@ API/library references:
 # pylint: enable=C0301
 
 # System-level imports
+import base64
+import collections
+import cStringIO
+import email.utils
 import errno
+import fnmatch
 import hashlib
+import json
 import math
 import os
 import posixpath
 import Queue
 import re
+import shutil
+import stat
 import sys
+import tempfile
 import threading
 import time
+import uuid
+
+try:
+  from os import scandir as _scandir
+except ImportError:
+  try:
+    from scandir import scandir as _scandir
+  except ImportError:
+    _scandir = None
 
 # Imports from third-party code
 TRUNK_DIRECTORY = os.path.abspath(os.path.join(
     os.path.dirname(__file__), os.pardir, os.pardir))
-for import_subdir in ['boto']:
-  import_dirpath = os.path.join(
-      TRUNK_DIRECTORY, 'third_party', 'externals', import_subdir)
-  if import_dirpath not in sys.path:
-    # We need to insert at the beginning of the path, to make sure that our
-    # imported versions are favored over others that might be in the path.
-    sys.path.insert(0, import_dirpath)
-from boto.exception import BotoServerError
-from boto.gs import acl
-from boto.gs.bucket import Bucket
-from boto.gs.connection import GSConnection
-from boto.gs.key import Key
-from boto.s3.bucketlistresultset import BucketListResultSet
-from boto.s3.connection import SubdomainCallingFormat
-from boto.s3.prefix import Prefix
+
+# The boto modules we use.  Importing boto is expensive, and many callers of
+# this module (e.g. those that only call is_gs_url()) never touch the network,
+# so these are filled in by _import_boto() the first time we need them.
+acl = None
+AnonymousGSConnection = None
+BotoServerError = None
+Bucket = None
+BucketListResultSet = None
+GSConnection = None
+Key = None
+OrdinaryCallingFormat = None
+Prefix = None
+s3_acl = None
+S3Connection = None
+SubdomainCallingFormat = None
 
 # How many files to upload at once, by default.
 # TODO(epoger): Is there a way to compute this intelligently?  To some extent
@@ -56,24 +75,20 @@ DEFAULT_UPLOAD_THREADS = 10
 
 GS_PREFIX = 'gs://'
 
+_boto_import_lock = threading.Lock()
 
-class AnonymousGSConnection(GSConnection):
-  """GSConnection class that allows anonymous connections.
+# Description of a file within a bucket, as returned by StorageBackend.
+# etag is the quoted MD5 hash of the file contents (unless it is a composite
+# object), and last_modified is a freeform string.
+ObjectInfo = collections.namedtuple(
+    'ObjectInfo', ['name', 'etag', 'last_modified', 'size'])
 
-  The GSConnection class constructor in
-  https://github.com/boto/boto/blob/develop/boto/gs/connection.py doesn't allow
-  for anonymous connections (connections without credentials), so we have to
-  override it.
-  """
-  def __init__(self):
-    super(GSConnection, self).__init__(
-        # This is the important bit we need to add...
-        anon=True,
-        # ...and these are just copied in from GSConnection.__init__()
-        bucket_class=Bucket,
-        calling_format=SubdomainCallingFormat(),
-        host=GSConnection.DefaultHost,
-        provider='google')
+# Bucket handle returned by LocalBackend.
+_LocalBucket = collections.namedtuple('_LocalBucket', ['name', 'dirpath'])
+
+# Contents of each .boto file we have read, keyed by absolute path.
+_config_file_cache = {}
+_config_file_cache_lock = threading.Lock()
 
 
 class GSUtils(object):
@@ -107,12 +122,16 @@ class GSUtils(object):
     PUBLIC_READ_WRITE         = 'public-read-write'
 
   class IdType:
-    """Types of identifiers we can use to set "fine-grained" ACLs."""
-    GROUP_BY_DOMAIN = acl.GROUP_BY_DOMAIN
-    GROUP_BY_EMAIL  = acl.GROUP_BY_EMAIL
-    GROUP_BY_ID     = acl.GROUP_BY_ID
-    USER_BY_EMAIL   = acl.USER_BY_EMAIL
-    USER_BY_ID      = acl.USER_BY_ID
+    """Types of identifiers we can use to set "fine-grained" ACLs.
+
+    These are copied from boto.gs.acl, so that we don't need to import boto
+    just to define them.
+    """
+    GROUP_BY_DOMAIN = 'GroupByDomain'
+    GROUP_BY_EMAIL  = 'GroupByEmail'
+    GROUP_BY_ID     = 'GroupById'
+    USER_BY_EMAIL   = 'UserByEmail'
+    USER_BY_ID      = 'UserById'
 
   class UploadIf:
     """Cases in which we will upload a file.
@@ -129,7 +148,7 @@ class GSUtils(object):
     IF_MODIFIED = 3 # if there is an existing file with the same name and
                     # contents, leave it alone
 
-  def __init__(self, boto_file_path=None):
+  def __init__(self, boto_file_path=None, host=None, backend=None):
     """Constructor.
 
     Params:
@@ -139,12 +158,24 @@ class GSUtils(object):
           common paths for the .boto file.  If no .boto file is found, then the
           GSUtils object created will be able to access only public files in
           Google Storage.
+      host: hostname of the Google Storage endpoint to connect to, or None to
+          use boto's default
+      backend: StorageBackend to store files with, instead of Google Storage
+          (e.g. an S3Backend or LocalBackend).  If this is specified,
+          boto_file_path and host are ignored.
 
     Raises an exception if no file is found at boto_file_path, or if the file
     found there is malformed.
     """
-    self._gs_access_key_id = None
-    self._gs_secret_access_key = None
+    # Bulk operations run on these threads, so that each thread's connection
+    # (see GSBackend) is reused from one operation to the next.
+    self._pool = _ThreadPool()
+    if backend:
+      self._backend = backend
+      return
+
+    gs_access_key_id = None
+    gs_secret_access_key = None
     if not boto_file_path:
       if os.environ.get('AWS_CREDENTIAL_FILE'):
         boto_file_path = os.path.expanduser(os.environ['AWS_CREDENTIAL_FILE'])
@@ -156,20 +187,19 @@ class GSUtils(object):
 
     if boto_file_path:
       print ('Reading boto file from %s' % boto_file_path)
-      boto_dict = _config_file_as_dict(filepath=boto_file_path)
-      self._gs_access_key_id = boto_dict['gs_access_key_id']
-      self._gs_secret_access_key = boto_dict['gs_secret_access_key']
+      boto_dict = _cached_config_file_as_dict(filepath=boto_file_path)
+      gs_access_key_id = boto_dict['gs_access_key_id']
+      gs_secret_access_key = boto_dict['gs_secret_access_key']
     else:
       print >> sys.stderr, 'Warning: no .boto file found.'
+    self._backend = GSBackend(gs_access_key_id=gs_access_key_id,
+                              gs_secret_access_key=gs_secret_access_key,
+                              host=host)
 
-    # Which field we get/set in ACL entries, depending on IdType.
-    self._field_by_id_type = {
-        self.IdType.GROUP_BY_DOMAIN: 'domain',
-        self.IdType.GROUP_BY_EMAIL:  'email_address',
-        self.IdType.GROUP_BY_ID:     'id',
-        self.IdType.USER_BY_EMAIL:   'email_address',
-        self.IdType.USER_BY_ID:      'id',
-    }
+  @property
+  def backend(self):
+    """The StorageBackend this object stores files with."""
+    return self._backend
 
   def delete_file(self, bucket, path):
     """Delete a single file within a GS bucket.
@@ -182,14 +212,7 @@ class GSUtils(object):
       path: full path (Posix-style) of the file within the bucket to delete
     """
     b = self._connect_to_bucket(bucket=bucket)
-    key = Key(b)
-    key.name = path
-    try:
-      key.delete()
-    except BotoServerError, e:
-      e.body = (repr(e.body) +
-                ' while deleting gs://%s/%s' % (b.name, path))
-      raise
+    self._backend.delete(b=b, path=path)
 
   def get_last_modified_time(self, bucket, path):
     """Gets the timestamp of when this file was last modified.
@@ -202,15 +225,10 @@ class GSUtils(object):
     found, returns None.
     """
     b = self._connect_to_bucket(bucket=bucket)
-    try:
-      key = b.get_key(key_name=path)
-      if not key:
-        return None
-      return key.last_modified
-    except BotoServerError, e:
-      e.body = (repr(e.body) +
-                ' while getting attributes of gs://%s/%s' % (b.name, path))
-      raise
+    info = self._backend.get_info(b=b, path=path)
+    if not info:
+      return None
+    return info.last_modified
 
   def upload_file(self, source_path, dest_bucket, dest_path,
                   upload_if=UploadIf.ALWAYS,
@@ -238,42 +256,141 @@ class GSUtils(object):
         WorkingWithObjectMetadata#content-encoding
     """
     b = self._connect_to_bucket(bucket=dest_bucket)
-    local_md5 = None  # filled in lazily
+    (skip, local_md5) = self._check_upload_if(
+        b=b, dest_path=dest_path, upload_if=upload_if,
+        get_local_md5=lambda: _get_local_md5(path=source_path))
+    if skip:
+      return
+
+    # Upload the file using a temporary name at first, in case the transfer
+    # is interrupted partway through.
+    if not local_md5:
+      local_md5 = _get_local_md5(path=source_path)
+    initial_path = dest_path + '-uploading-' + local_md5
+    self._backend.put_filename(
+        b=b, path=initial_path, filename=source_path, md5=local_md5,
+        predefined_acl=predefined_acl)
+    self._finish_upload(b=b, initial_path=initial_path, dest_path=dest_path,
+                        local_md5=local_md5,
+                        fine_grained_acl_list=fine_grained_acl_list)
+
+  def upload_from_buffer(self, source, dest_bucket, dest_path,
+                         upload_if=UploadIf.ALWAYS,
+                         predefined_acl=None,
+                         fine_grained_acl_list=None):
+    """Upload data from memory (or from a file-like object) to Google Storage.
+
+    This behaves just like upload_file(), but saves the caller from writing the
+    data to local disk first.
+
+    params:
+      source: the data to upload; one of:
+          - a string, bytearray, memoryview, or buffer; its contents are sent
+            straight from memory, without copying the whole thing
+          - a seekable file-like object, which is read from its current
+            position to the end
+          - an iterable of strings (such as a generator), or a file-like object
+            that cannot seek; this is streamed to Google Storage as it is
+            produced, so the whole body never needs to be held in memory
+      dest_bucket: GS bucket to copy the data to
+      dest_path: full path (Posix-style) within that bucket
+      upload_if: one of the UploadIf values, describing in which cases we should
+          upload the data.  If source is streamed, the data must be transferred
+          before we can tell whether it has been modified, so IF_MODIFIED saves
+          us only the final rename, not the transfer.
+      predefined_acl: which predefined ACL to apply to the file on Google
+          Storage; must be one of the PredefinedACL values defined above.
+          If None, inherits dest_bucket's default object ACL.
+      fine_grained_acl_list: list of (id_type, id_value, permission) tuples
+          to apply to the uploaded file (on top of the predefined_acl),
+          or None if predefined_acl is sufficient
+    """
+    b = self._connect_to_bucket(bucket=dest_bucket)
+    reader = _make_reader(source)
+    if not isinstance(reader, _StreamReader):
+      (skip, local_md5) = self._check_upload_if(
+          b=b, dest_path=dest_path, upload_if=upload_if,
+          get_local_md5=reader.md5)
+      if skip:
+        return
+      if not local_md5:
+        local_md5 = reader.md5()
+      initial_path = dest_path + '-uploading-' + local_md5
+      self._backend.put_file(
+          b=b, path=initial_path, fp=reader, size=reader.size(),
+          md5=local_md5, predefined_acl=predefined_acl)
+    else:
+      # We don't know the MD5 hash of a stream until we have read all of it,
+      # so only the IF_NEW check can be done before the transfer.
+      if upload_if == self.UploadIf.IF_NEW:
+        (skip, _) = self._check_upload_if(
+            b=b, dest_path=dest_path, upload_if=upload_if, get_local_md5=None)
+        if skip:
+          return
+      elif upload_if not in (self.UploadIf.ALWAYS, self.UploadIf.IF_MODIFIED):
+        raise Exception('unknown value of upload_if: %s' % upload_if)
+      initial_path = dest_path + '-uploading-' + uuid.uuid4().hex
+      self._backend.put_file(b=b, path=initial_path, fp=reader,
+                             predefined_acl=predefined_acl)
+      local_md5 = reader.md5()
+      if upload_if == self.UploadIf.IF_MODIFIED:
+        old_info = self._backend.get_info(b=b, path=dest_path)
+        if old_info and ('"%s"' % local_md5) == old_info.etag:
+          print ('Skipping upload of unmodified file gs://%s/%s : %s' % (
+              b.name, dest_path, local_md5))
+          self._backend.delete(b=b, path=initial_path)
+          return
+    self._finish_upload(b=b, initial_path=initial_path, dest_path=dest_path,
+                        local_md5=local_md5,
+                        fine_grained_acl_list=fine_grained_acl_list)
 
+  def _check_upload_if(self, b, dest_path, upload_if, get_local_md5):
+    """Checks whether upload_if tells us to skip uploading to dest_path.
+
+    Params:
+      b: bucket handle (as returned by _connect_to_bucket()) we are uploading
+          into
+      dest_path: full path (Posix-style) within that bucket
+      upload_if: one of the UploadIf values
+      get_local_md5: function returning the MD5 hash (as a hex string) of the
+          data we would upload; only called if it is needed
+
+    Returns a (skip, local_md5) tuple: skip is True if we should not upload,
+    and local_md5 is the hash returned by get_local_md5, or None if we did not
+    need to call it.
+    """
     if upload_if == self.UploadIf.IF_NEW:
-      old_key = b.get_key(key_name=dest_path)
-      if old_key:
+      if self._backend.get_info(b=b, path=dest_path):
         print ('Skipping upload of existing file gs://%s/%s' % (
             b.name, dest_path))
-        return
+        return (True, None)
     elif upload_if == self.UploadIf.IF_MODIFIED:
-      old_key = b.get_key(key_name=dest_path)
-      if old_key:
-        if not local_md5:
-          local_md5 = _get_local_md5(path=source_path)
-        if ('"%s"' % local_md5) == old_key.etag:
+      old_info = self._backend.get_info(b=b, path=dest_path)
+      if old_info:
+        local_md5 = get_local_md5()
+        if ('"%s"' % local_md5) == old_info.etag:
           print (
               'Skipping upload of unmodified file gs://%s/%s : %s' % (
                   b.name, dest_path, local_md5))
-          return
+          return (True, local_md5)
+        return (False, local_md5)
     elif upload_if != self.UploadIf.ALWAYS:
       raise Exception('unknown value of upload_if: %s' % upload_if)
+    return (False, None)
 
-    # Upload the file using a temporary name at first, in case the transfer
-    # is interrupted partway through.
-    if not local_md5:
-      local_md5 = _get_local_md5(path=source_path)
-    initial_key = Key(b)
-    initial_key.name = dest_path + '-uploading-' + local_md5
-    try:
-      initial_key.set_contents_from_filename(filename=source_path,
-                                             policy=predefined_acl)
-    except BotoServerError, e:
-      e.body = (repr(e.body) +
-                ' while uploading source_path=%s to gs://%s/%s' % (
-                    source_path, b.name, initial_key.name))
-      raise
+  def _finish_upload(self, b, initial_path, dest_path, local_md5,
+                     fine_grained_acl_list):
+    """Moves a file we have uploaded under a temporary name into place.
 
+    Params:
+      b: bucket handle (as returned by _connect_to_bucket()) we uploaded into
+      initial_path: full path (Posix-style) within that bucket we uploaded the
+          file to
+      dest_path: full path (Posix-style) within that bucket to move the file to
+      local_md5: MD5 hash (as a hex string) of the data we uploaded
+      fine_grained_acl_list: list of (id_type, id_value, permission) tuples
+          to apply to the file, or None
+    """
     # Verify that the file contents were uploaded successfully.
     #
     # TODO(epoger): Check whether the boto library or XML API already do this...
@@ -283,10 +400,10 @@ class GSUtils(object):
     # TODO(epoger): Confirm that the etag is set on the server side...
     # otherwise, we may just be validating another MD5 hash that was generated
     # on the client side before the file was uploaded!
-    validate_key = b.get_key(key_name=initial_key.name)
-    if validate_key.etag != ('"%s"' % local_md5):
+    validate_info = self._backend.get_info(b=b, path=initial_path)
+    if validate_info.etag != ('"%s"' % local_md5):
       raise Exception('found wrong MD5 after uploading gs://%s/%s' % (
-          b.name, validate_key.name))
+          b.name, initial_path))
 
     # Rename the file to its real name.
     #
@@ -295,22 +412,22 @@ class GSUtils(object):
     # Perhaps we could use Key.compose() to create a composite object pointing
     # at the original key?
     # See https://developers.google.com/storage/docs/composite-objects
-    final_key = b.copy_key(
-        new_key_name=dest_path, src_key_name=initial_key.name,
-        src_bucket_name=b.name, preserve_acl=False)
-    initial_key.delete()
+    self._backend.copy(src_b=b, src_path=initial_path,
+                       dst_b=b, dst_path=dest_path)
+    self._backend.delete(b=b, path=initial_path)
 
     # Set ACLs on the file.
-    # We do this *after* copy_key(), because copy_key's preserve_acl
-    # functionality would incur a performance hit.
+    # We do this *after* copy(), because preserving ACLs while copying would
+    # incur a performance hit.
     for (id_type, id_value, permission) in fine_grained_acl_list or []:
       self.set_acl(
-          bucket=b, path=final_key.name,
+          bucket=b, path=dest_path,
           id_type=id_type, id_value=id_value, permission=permission)
 
   def upload_dir_contents(self, source_dir, dest_bucket, dest_dir,
                           num_threads=DEFAULT_UPLOAD_THREADS,
-                          upload_if=UploadIf.ALWAYS, **kwargs):
+                          upload_if=UploadIf.ALWAYS, rel_paths=None,
+                          **kwargs):
     """Recursively upload contents of a local directory to Google Storage.
 
     params:
@@ -322,6 +439,10 @@ class GSUtils(object):
       num_threads: how many files to upload at once
       upload_if: one of the UploadIf values, describing in which cases we should
           upload the file
+      rel_paths: if specified, an iterable of paths (Posix-style, relative to
+          source_dir) of the files to consider uploading, instead of every file
+          within source_dir; e.g. git_utils.IterChangedPaths() since the last
+          upload of a checkout
       kwargs: any additional keyword arguments "inherited" from upload_file()
 
     The copy operates as a merge: any files in source_dir will be "overlaid" on
@@ -334,13 +455,16 @@ class GSUtils(object):
     if not dest_dir:
       dest_dir = ''
 
-    # Create a set of all files within source_dir.
-    source_fileset = set()
-    prefix_length = len(source_dir)+1
-    for dirpath, _, filenames in os.walk(source_dir):
-      relative_dirpath = dirpath[prefix_length:]
-      for filename in filenames:
-        source_fileset.add(os.path.join(relative_dirpath, filename))
+    # Create a set of all files within source_dir (or of rel_paths).
+    if rel_paths is not None:
+      source_fileset = set(rel_paths)
+    else:
+      source_fileset = set()
+      prefix_length = len(source_dir)+1
+      for dirpath, _, filenames in os.walk(source_dir):
+        relative_dirpath = dirpath[prefix_length:]
+        for filename in filenames:
+          source_fileset.add(os.path.join(relative_dirpath, filename))
     num_files_total = len(source_fileset)
 
     # If we are only uploading files conditionally, remove any unnecessary
@@ -349,15 +473,7 @@ class GSUtils(object):
       pass  # there are no shortcuts... upload them all
     else:
       # Create a mapping of filename to Key for existing files within dest_dir
-      existing_dest_filemap = {}
-      prefix = dest_dir
-      if prefix and not prefix.endswith('/'):
-        prefix += '/'
-      prefix_length = len(prefix)
-      items = BucketListResultSet(bucket=b, prefix=prefix)
-      for item in items:
-        if type(item) is Key:
-          existing_dest_filemap[item.name[prefix_length:]] = item
+      existing_dest_filemap = self._list_files_in_dir(b=b, dirpath=dest_dir)
 
       # Now, depending on upload_if, trim files we should skip uploading.
       files_in_common = source_fileset.intersection(
@@ -368,8 +484,8 @@ class GSUtils(object):
         for rel_path in files_in_common:
           local_md5 = '"%s"' % _get_local_md5(path=os.path.join(
               source_dir, rel_path))
-          key = existing_dest_filemap[rel_path]
-          if local_md5 == key.etag:
+          info = existing_dest_filemap[rel_path]
+          if local_md5 == info.etag:
             source_fileset.remove(rel_path)
       else:
         raise Exception('unknown value of upload_if: %s' % upload_if)
@@ -380,57 +496,205 @@ class GSUtils(object):
         num_files_to_upload, num_files_total - num_files_to_upload))
     if num_files_to_upload == 0:
       return
-    if num_threads > num_files_to_upload:
-      num_threads = num_files_to_upload
 
-    # Create a work queue with all files that need to be uploaded.
-    q = Queue.Queue(maxsize=num_files_to_upload)
-    for rel_path in source_fileset:
-      q.put(rel_path)
+    def upload(rel_path):
+      self.upload_file(
+          source_path=os.path.join(source_dir, rel_path),
+          dest_bucket=b,
+          dest_path=posixpath.join(dest_dir, rel_path),
+          upload_if=self.UploadIf.ALWAYS,
+          **kwargs)
+    err = _run_in_parallel(
+        func=upload, items=source_fileset, num_threads=num_threads,
+        progress_format=' Uploading file %d/%d: %s', retry_description='upload',
+        pool=self._pool)
 
-    err = {}
+    if err:
+      errMsg = 'Failed to upload the following: \n\n'
+      for rel_path, e in err.iteritems():
+        errMsg += '%s: %s\n' % (rel_path, e)
+      raise Exception(errMsg)
 
-    # Spin up worker threads to read from the task queue.
-    def worker():
-      while True:
-        try:
-          rel_path = q.get(block=False)
-        except Queue.Empty:
-          return  # no more tasks in the queue, so exit
-        print (' Uploading file %d/%d: %s' % (
-            num_files_to_upload - q.qsize(), num_files_to_upload, rel_path))
-
-        retries = 5
-        for retry in range(retries):
-          try:
-            self.upload_file(
-                source_path=os.path.join(source_dir, rel_path),
-                dest_bucket=b,
-                dest_path=posixpath.join(dest_dir, rel_path),
-                upload_if=self.UploadIf.ALWAYS,
-                **kwargs)
-            q.task_done()
-            break
-          except Exception as error:
-            if retry < retries - 1:
-              print '  Retrying upload, attempt #%d' % (retry + 1)
-              time.sleep(2 ** retry)
-            else:
-              err[rel_path] = error
+  def copy_prefix(self, src_bucket, src_prefix, dst_bucket, dst_prefix,
+                  num_threads=DEFAULT_UPLOAD_THREADS,
+                  upload_if=UploadIf.ALWAYS, predefined_acl=None,
+                  fine_grained_acl_list=None, cross_location=False):
+    """Recursively copy files from one Google Storage directory to another.
 
-    for _ in range(num_threads):
-      t = threading.Thread(target=worker)
-      t.daemon = True
-      t.start()
+    The copies are made on the server side, so the file contents do not pass
+    through this machine (unless cross_location is True).
 
-    # Block until all files have been uploaded and all workers have exited.
-    q.join()
+    params:
+      src_bucket: GS bucket to copy the files from
+      src_prefix: full path (Posix-style) within src_bucket of the directory to
+          copy the contents of.  If None, copy the whole bucket.
+      dst_bucket: GS bucket to copy the files into (may be src_bucket)
+      dst_prefix: full path (Posix-style) within dst_bucket; write the files
+          into this directory.  If None, write into the root directory of the
+          bucket.
+      num_threads: how many files to copy at once
+      upload_if: one of the UploadIf values, describing in which cases we should
+          copy each file.  IF_MODIFIED compares the etags from the source and
+          destination listings, so it costs no extra round trips.
+      predefined_acl: which predefined ACL to apply to the copied files; must
+          be one of the PredefinedACL values defined above.  If None, inherits
+          dst_bucket's default object ACL.
+      fine_grained_acl_list: list of (id_type, id_value, permission) tuples
+          to apply to each copied file (on top of the predefined_acl),
+          or None if predefined_acl is sufficient
+      cross_location: if True, relay each file through this machine (streaming
+          it from memory, without touching local disk) rather than asking
+          Google Storage to copy it.  The XML API has no equivalent of the JSON
+          API's resumable "rewrite" call, so use this if server-side copies of
+          large files between buckets in different locations time out.
+
+    The copy operates as a merge, just like upload_dir_contents().
+    """
+    self._copy_prefix(
+        src_bucket=src_bucket, src_prefix=src_prefix, dst_bucket=dst_bucket,
+        dst_prefix=dst_prefix, num_threads=num_threads, upload_if=upload_if,
+        predefined_acl=predefined_acl,
+        fine_grained_acl_list=fine_grained_acl_list,
+        cross_location=cross_location)
+
+  def move_prefix(self, src_bucket, src_prefix, dst_bucket, dst_prefix,
+                  num_threads=DEFAULT_UPLOAD_THREADS, **kwargs):
+    """Recursively move files from one Google Storage directory to another.
+
+    This is copy_prefix(), followed by deleting each source file that now
+    exists at the destination.  If upload_if is IF_NEW, source files that were
+    not copied because a different file of that name already existed at the
+    destination are left where they are.
 
+    params:
+      src_bucket: GS bucket to move the files from
+      src_prefix: full path (Posix-style) within src_bucket of the directory to
+          move the contents of.  If None, move the whole bucket.
+      dst_bucket: GS bucket to move the files into (may be src_bucket)
+      dst_prefix: full path (Posix-style) within dst_bucket; write the files
+          into this directory.  If None, write into the root directory of the
+          bucket.
+      num_threads: how many files to copy or delete at once
+      kwargs: any additional keyword arguments "inherited" from copy_prefix()
+
+    If any file fails to copy, no source files are deleted.  Raises an
+    Exception (without moving anything) if the source and destination
+    directories are the same, or one is within the other.
+    """
+    src_name = _bucket_name(src_bucket)
+    dst_name = _bucket_name(dst_bucket)
+    src_dir = (src_prefix or '').strip('/')
+    dst_dir = (dst_prefix or '').strip('/')
+    if src_name == dst_name and (
+        not src_dir or not dst_dir or src_dir == dst_dir or
+        dst_dir.startswith(src_dir + '/') or
+        src_dir.startswith(dst_dir + '/')):
+      raise Exception('cannot move gs://%s/%s to overlapping gs://%s/%s' % (
+          src_name, src_dir, dst_name, dst_dir))
+    (src_b, rel_paths) = self._copy_prefix(
+        src_bucket=src_bucket, src_prefix=src_prefix, dst_bucket=dst_bucket,
+        dst_prefix=dst_prefix, num_threads=num_threads, **kwargs)
+
+    def delete(rel_path):
+      self.delete_file(bucket=src_b,
+                       path=posixpath.join(src_prefix or '', rel_path))
+    err = _run_in_parallel(
+        func=delete, items=rel_paths, num_threads=num_threads,
+        progress_format=' Deleting source file %d/%d: %s',
+        retry_description='delete', pool=self._pool)
     if err:
-      errMsg = 'Failed to upload the following: \n\n'
+      errMsg = 'Failed to delete the following: \n\n'
+      for rel_path, e in err.iteritems():
+        errMsg += '%s: %s\n' % (rel_path, e)
+      raise Exception(errMsg)
+
+  def _copy_prefix(self, src_bucket, src_prefix, dst_bucket, dst_prefix,
+                   num_threads, upload_if=UploadIf.ALWAYS, predefined_acl=None,
+                   fine_grained_acl_list=None, cross_location=False):
+    """Implements copy_prefix().
+
+    Returns a (src_b, rel_paths) tuple: src_b is the Bucket object for
+    src_bucket, and rel_paths is the set of paths (relative to src_prefix) of
+    all source files that now exist at the destination with the same contents,
+    whether or not we had to copy them.
+    """
+    src_b = self._connect_to_bucket(bucket=src_bucket)
+    dst_b = self._connect_to_bucket(bucket=dst_bucket)
+    src_prefix = src_prefix or ''
+    dst_prefix = dst_prefix or ''
+    src_filemap = self._list_files_in_dir(b=src_b, dirpath=src_prefix)
+    rel_paths = set(src_filemap.keys())
+
+    # Depending on upload_if, trim files we should skip copying.
+    to_copy = set(rel_paths)
+    if upload_if == self.UploadIf.ALWAYS:
+      pass  # there are no shortcuts... copy them all
+    else:
+      dst_filemap = self._list_files_in_dir(b=dst_b, dirpath=dst_prefix)
+      files_in_common = to_copy.intersection(dst_filemap.keys())
+      if upload_if == self.UploadIf.IF_NEW:
+        to_copy -= files_in_common
+        # Leave out any files we did not copy over different ones.
+        rel_paths = to_copy.union(
+            rel_path for rel_path in files_in_common
+            if src_filemap[rel_path].etag == dst_filemap[rel_path].etag)
+      elif upload_if == self.UploadIf.IF_MODIFIED:
+        for rel_path in files_in_common:
+          if src_filemap[rel_path].etag == dst_filemap[rel_path].etag:
+            to_copy.remove(rel_path)
+      else:
+        raise Exception('unknown value of upload_if: %s' % upload_if)
+
+    num_files_to_copy = len(to_copy)
+    print ('Copying %d files, skipping %d ...' % (
+        num_files_to_copy, len(src_filemap) - num_files_to_copy))
+
+    def copy(rel_path):
+      src_info = src_filemap[rel_path]
+      dst_path = posixpath.join(dst_prefix, rel_path)
+      if cross_location:
+        self._relay_file(src_b=src_b, src_info=src_info, dst_b=dst_b,
+                         dst_path=dst_path, predefined_acl=predefined_acl)
+      else:
+        self._backend.copy(src_b=src_b, src_path=src_info.name,
+                           dst_b=dst_b, dst_path=dst_path,
+                           predefined_acl=predefined_acl)
+      for (id_type, id_value, permission) in fine_grained_acl_list or []:
+        self.set_acl(
+            bucket=dst_b, path=dst_path,
+            id_type=id_type, id_value=id_value, permission=permission)
+    err = _run_in_parallel(
+        func=copy, items=to_copy, num_threads=num_threads,
+        progress_format=' Copying file %d/%d: %s', retry_description='copy',
+        pool=self._pool)
+    if err:
+      errMsg = 'Failed to copy the following: \n\n'
       for rel_path, e in err.iteritems():
         errMsg += '%s: %s\n' % (rel_path, e)
       raise Exception(errMsg)
+    return (src_b, rel_paths)
+
+  def _relay_file(self, src_b, src_info, dst_b, dst_path, predefined_acl):
+    """Copies a file by streaming it from one bucket to another via this
+    machine.
+
+    Params:
+      src_b: bucket handle to copy the file from
+      src_info: ObjectInfo describing the file to copy
+      dst_b: bucket handle to copy the file into
+      dst_path: full path (Posix-style) within dst_b to copy the file to
+      predefined_acl: predefined ACL to apply to the copy, or None
+    """
+    reader = _StreamReader(
+        self._backend.iter_contents(b=src_b, path=src_info.name))
+    self._backend.put_file(b=dst_b, path=dst_path, fp=reader,
+                           predefined_acl=predefined_acl)
+    # Composite objects have etags that are not MD5 hashes, so we can only
+    # validate the ones that look like MD5 hashes.
+    if (len(src_info.etag) == 34 and
+        src_info.etag != ('"%s"' % reader.md5())):
+      raise Exception('found wrong MD5 after relaying gs://%s/%s' % (
+          dst_b.name, dst_path))
 
   def download_file(self, source_bucket, source_path, dest_path,
                     create_subdirs_if_needed=False, source_generation=None):
@@ -445,20 +709,41 @@ class GSUtils(object):
       source_generation: the generation version of the source
     """
     b = self._connect_to_bucket(bucket=source_bucket)
-    key = Key(b)
-    key.name = source_path
-    if source_generation:
-      key.generation = source_generation
     if create_subdirs_if_needed:
       _makedirs_if_needed(os.path.dirname(dest_path))
-    with open(dest_path, 'w') as f:
-      try:
-        key.get_contents_to_file(fp=f)
-      except BotoServerError, e:
-        e.body = (repr(e.body) +
-                  ' while downloading gs://%s/%s to local_path=%s' % (
-                      b.name, source_path, dest_path))
-        raise
+    self._backend.get_filename(b=b, path=source_path, filename=dest_path,
+                               generation=source_generation)
+
+  def download_to_buffer(self, source_bucket, source_path, dest=None,
+                         source_generation=None):
+    """Downloads a single file from Google Cloud Storage into memory.
+
+    Args:
+      source_bucket: GS bucket to download the file from
+      source_path: full path (Posix-style) within that bucket
+      dest: where to put the file contents; one of:
+          - None, in which case the contents are returned as a string
+          - a writable bytearray or memoryview, which the contents are written
+            into (starting at its beginning) as they arrive; raises an
+            Exception if the file is too big to fit
+          - a file-like object with a write() method
+      source_generation: the generation version of the source
+
+    Returns: the file contents as a string if dest is None; otherwise, the
+        number of bytes written into dest.
+    """
+    b = self._connect_to_bucket(bucket=source_bucket)
+    if dest is None:
+      fp = cStringIO.StringIO()
+    elif hasattr(dest, 'write'):
+      fp = dest
+    else:
+      fp = _BufferWriter(dest)
+    num_bytes = self._backend.get_file(b=b, path=source_path, fp=fp,
+                                       generation=source_generation)
+    if dest is None:
+      return fp.getvalue()
+    return num_bytes
 
   def download_dir_contents(self, source_bucket, source_dir, dest_dir):
     """Recursively download contents of a Google Storage directory to local disk
@@ -482,17 +767,9 @@ class GSUtils(object):
         bucket=source_bucket, subdir=source_dir)
 
     for filename in files:
-      key = Key(b)
-      key.name = posixpath.join(source_dir, filename)
-      dest_path = os.path.join(dest_dir, filename)
-      with open(dest_path, 'w') as f:
-        try:
-          key.get_contents_to_file(fp=f)
-        except BotoServerError, e:
-          e.body = (repr(e.body) +
-                    ' while downloading gs://%s/%s to local_path=%s' % (
-                        b.name, key.name, dest_path))
-          raise
+      self._backend.get_filename(
+          b=b, path=posixpath.join(source_dir, filename),
+          filename=os.path.join(dest_dir, filename))
 
     for dirname in dirs:
       self.download_dir_contents(  # recurse
@@ -522,17 +799,9 @@ class GSUtils(object):
         this id_type/id_value, on this file; or Permission.EMPTY if no such
         permissions have been set.
     """
-    field = self._field_by_id_type[id_type]
     b = self._connect_to_bucket(bucket=bucket)
-    acls = b.get_acl(key_name=path)
-    matching_entries = [entry for entry in acls.entries.entry_list
-                        if (entry.scope.type == id_type) and
-                        (getattr(entry.scope, field) == id_value)]
-    if matching_entries:
-      assert len(matching_entries) == 1, '%d == 1' % len(matching_entries)
-      return matching_entries[0].permission
-    else:
-      return self.Permission.EMPTY
+    return self._backend.get_acl_entry(b=b, path=path, id_type=id_type,
+                                       id_value=id_value)
 
   def set_acl(self, bucket, path, id_type, id_value, permission):
     """Set partial access permissions on a single file in Google Storage.
@@ -571,28 +840,9 @@ class GSUtils(object):
       set_acl(bucket, path, id_type, id_value, Permission.WRITE)
       assert Permission.WRITE == get_acl(bucket, path, id_type, id_value)
     """
-    field = self._field_by_id_type[id_type]
     b = self._connect_to_bucket(bucket=bucket)
-    acls = b.get_acl(key_name=path)
-
-    # Remove any existing entries that refer to the same id_type/id_value,
-    # because the API will fail if we try to set more than one.
-    matching_entries = [entry for entry in acls.entries.entry_list
-                        if (entry.scope.type == id_type) and
-                        (getattr(entry.scope, field) == id_value)]
-    if matching_entries:
-      assert len(matching_entries) == 1, '%d == 1' % len(matching_entries)
-      acls.entries.entry_list.remove(matching_entries[0])
-
-    # Add a new entry to the ACLs.
-    if permission != self.Permission.EMPTY:
-      args = {'type': id_type, 'permission': permission}
-      args[field] = id_value
-      new_entry = acl.Entry(**args)
-      acls.entries.entry_list.append(new_entry)
-
-    # Finally, write back the modified ACLs.
-    b.set_acl(acl_or_str=acls, key_name=path)
+    self._backend.set_acl_entry(b=b, path=path, id_type=id_type,
+                                id_value=id_value, permission=permission)
 
   def list_bucket_contents(self, bucket, subdir=None):
     """Returns files in the Google Storage bucket as a (dirs, files) tuple.
@@ -611,15 +861,13 @@ class GSUtils(object):
     prefix_length = len(prefix) if prefix else 0
 
     b = self._connect_to_bucket(bucket=bucket)
-    items = BucketListResultSet(bucket=b, prefix=prefix, delimiter='/')
     dirs = []
     files = []
-    for item in items:
-      t = type(item)
-      if t is Key:
+    for item in self._backend.list(b=b, prefix=prefix, delimiter='/'):
+      if isinstance(item, ObjectInfo):
         files.append(item.name[prefix_length:])
-      elif t is Prefix:
-        dirs.append(item.name[prefix_length:-1])
+      else:
+        dirs.append(item[prefix_length:-1])
     return (dirs, files)
 
   def does_storage_object_exist(self, bucket, object_name):
@@ -628,7 +876,7 @@ class GSUtils(object):
     Returns True if it exists else returns False.
     """
     b = self._connect_to_bucket(bucket=bucket)
-    if object_name in b:
+    if self._backend.get_info(b=b, path=object_name):
       return True
     dirs, files = self.list_bucket_contents(bucket, object_name)
     return bool(dirs or files)
@@ -662,28 +910,1007 @@ class GSUtils(object):
               prefix_removed[pathsep_index+1:].strip('/'))
 
   def _connect_to_bucket(self, bucket):
-    """Returns a Bucket object we can use to access a particular bucket in GS.
+    """Returns a handle we can use to access a particular bucket in GS.
+
+    Params:
+      bucket: name of the bucket (e.g., 'chromium-skia-gm'), or a handle
+          previously returned by this method (in which case this param is just
+          returned as-is)
+    """
+    return self._backend.get_bucket(bucket=bucket)
+
+  def _list_files_in_dir(self, b, dirpath):
+    """Returns a dict mapping relative path to ObjectInfo for every file within
+    dirpath.
 
     Params:
-      bucket: name of the bucket (e.g., 'chromium-skia-gm'), or a Bucket
-          object (in which case this param is just returned as-is)
+      b: bucket handle (as returned by _connect_to_bucket()) to list
+      dirpath: full path (Posix-style) of a directory within the bucket, or None
+          or '' for the root directory of the bucket
     """
-    if type(bucket) is Bucket:
+    prefix = dirpath or ''
+    if prefix and not prefix.endswith('/'):
+      prefix += '/'
+    prefix_length = len(prefix)
+    filemap = {}
+    for info in self._backend.list(b=b, prefix=prefix):
+      filemap[info.name[prefix_length:]] = info
+    return filemap
+
+
+class StorageBackend(object):
+  """Interface through which GSUtils reads and writes files.
+
+  GSUtils implements all of its higher-level logic (conditional uploads,
+  parallelism, ACL lists, etc.) in terms of these methods, so the same code
+  can work with Google Storage, with an S3-compatible service, or with the
+  local filesystem.
+
+  Bucket handles returned by get_bucket() may be of any type, as long as they
+  have a name attribute.  Paths are always Posix-style, relative to the root of
+  the bucket.
+  """
+
+  def get_bucket(self, bucket):
+    """Returns a handle for the named bucket.
+
+    Params:
+      bucket: name of the bucket, or a handle previously returned by this
+          method (in which case this param is just returned as-is)
+    """
+    raise NotImplementedError()
+
+  def get_info(self, b, path):
+    """Returns an ObjectInfo describing the file at path, or None if there is
+    no such file."""
+    raise NotImplementedError()
+
+  def list(self, b, prefix, delimiter=None):
+    """Yields an ObjectInfo for each file whose path starts with prefix, in
+    lexicographic order.
+
+    If delimiter is set, files whose paths contain delimiter after the prefix
+    are not returned individually; instead, we yield (as a string) each
+    distinct path prefix up to and including the delimiter.
+    """
+    raise NotImplementedError()
+
+  def put_file(self, b, path, fp, predefined_acl=None, size=None, md5=None):
+    """Writes the contents of file-like object fp to path.
+
+    If size is None, fp cannot seek and must be read to its end; otherwise, fp
+    contains size bytes whose MD5 hash (as a hex string) is md5.
+    """
+    raise NotImplementedError()
+
+  def put_filename(self, b, path, filename, md5=None, predefined_acl=None):
+    """Writes the contents of local file filename (whose MD5 hash is md5, if
+    known) to path."""
+    raise NotImplementedError()
+
+  def get_file(self, b, path, fp, generation=None):
+    """Writes the contents of the file at path into file-like object fp.
+
+    Returns the number of bytes written.
+    """
+    raise NotImplementedError()
+
+  def get_filename(self, b, path, filename, generation=None):
+    """Writes the contents of the file at path into local file filename."""
+    raise NotImplementedError()
+
+  def iter_contents(self, b, path):
+    """Returns an iterator over the contents of the file at path, in chunks."""
+    raise NotImplementedError()
+
+  def copy(self, src_b, src_path, dst_b, dst_path, predefined_acl=None):
+    """Copies a file, without preserving its fine-grained ACLs."""
+    raise NotImplementedError()
+
+  def delete(self, b, path):
+    """Deletes the file at path."""
+    raise NotImplementedError()
+
+  def get_acl_entry(self, b, path, id_type, id_value):
+    """Implements GSUtils.get_acl()."""
+    raise NotImplementedError()
+
+  def set_acl_entry(self, b, path, id_type, id_value, permission):
+    """Implements GSUtils.set_acl()."""
+    raise NotImplementedError()
+
+
+class GSBackend(StorageBackend):
+  """StorageBackend that stores files in Google Storage, using boto."""
+
+  # Which field we get/set in ACL entries, depending on IdType.
+  _field_by_id_type = {
+      GSUtils.IdType.GROUP_BY_DOMAIN: 'domain',
+      GSUtils.IdType.GROUP_BY_EMAIL:  'email_address',
+      GSUtils.IdType.GROUP_BY_ID:     'id',
+      GSUtils.IdType.USER_BY_EMAIL:   'email_address',
+      GSUtils.IdType.USER_BY_ID:      'id',
+  }
+
+  # Prefix of URLs for this service, used in error messages.
+  _url_prefix = GS_PREFIX
+
+  def __init__(self, gs_access_key_id=None, gs_secret_access_key=None,
+               host=None):
+    """Constructor.
+
+    Params:
+      gs_access_key_id: access key to connect with, or None to connect
+          anonymously (in which case only public files are accessible)
+      gs_secret_access_key: secret for gs_access_key_id
+      host: hostname of the endpoint to connect to, or None to use boto's
+          default
+    """
+    self._access_key_id = gs_access_key_id
+    self._secret_access_key = gs_secret_access_key
+    self._host = host
+    # Each thread keeps its own connection (which pools HTTP connections to
+    # self._host), and its own cache of Bucket objects.  GSUtils runs bulk
+    # operations on persistent threads, so these are reused across calls.
+    self._thread_local = threading.local()
+
+  def get_bucket(self, bucket):
+    _import_boto()
+    if not isinstance(bucket, basestring):
       return bucket
+    buckets = getattr(self._thread_local, 'buckets', None)
+    if buckets is None:
+      buckets = self._thread_local.buckets = {}
+    if bucket not in buckets:
+      try:
+        buckets[bucket] = self._get_connection().get_bucket(bucket_name=bucket)
+      except BotoServerError, e:
+        e.body = repr(e.body) + ' while connecting to bucket=%s' % bucket
+        raise
+    return buckets[bucket]
+
+  def _get_connection(self):
+    """Returns this thread's connection object, creating it if needed."""
+    connection = getattr(self._thread_local, 'connection', None)
+    if not connection:
+      connection = self._thread_local.connection = self._create_connection()
+    return connection
+
+  def _create_connection(self):
+    """Returns a GSConnection object we can use to access Google Storage."""
+    _import_boto()
+    kwargs = {}
+    if self._host:
+      kwargs['host'] = self._host
+    if self._access_key_id:
+      return GSConnection(
+          gs_access_key_id=self._access_key_id,
+          gs_secret_access_key=self._secret_access_key, **kwargs)
+    else:
+      return AnonymousGSConnection(**kwargs)
+
+  def _url(self, b, path):
+    """Returns the URL of a file, for use in error messages."""
+    return '%s%s/%s' % (self._url_prefix, b.name, path)
+
+  def _new_key(self, b, path, generation=None):
+    """Returns a Key object referring to the given version of a file."""
+    key = b.new_key(key_name=path)
+    if generation:
+      key.generation = generation
+    return key
+
+  def get_info(self, b, path):
     try:
-      return self._create_connection().get_bucket(bucket_name=bucket)
+      key = b.get_key(key_name=path)
     except BotoServerError, e:
-      e.body = repr(e.body) + ' while connecting to bucket=%s' % bucket
+      e.body = (repr(e.body) +
+                ' while getting attributes of %s' % self._url(b, path))
       raise
+    if not key:
+      return None
+    return _object_info(key)
+
+  def list(self, b, prefix, delimiter=None):
+    for item in BucketListResultSet(bucket=b, prefix=prefix,
+                                    delimiter=delimiter or ''):
+      if isinstance(item, Prefix):
+        yield item.name
+      else:
+        yield _object_info(item)
+
+  def put_file(self, b, path, fp, predefined_acl=None, size=None, md5=None):
+    key = self._new_key(b, path)
+    try:
+      if size is None:
+        key.set_contents_from_stream(fp=fp, policy=predefined_acl)
+      else:
+        key.set_contents_from_file(fp=fp, policy=predefined_acl, size=size,
+                                   md5=_md5_tuple(md5) if md5 else None)
+    except BotoServerError, e:
+      e.body = (repr(e.body) +
+                ' while uploading to %s' % self._url(b, path))
+      raise
+
+  def put_filename(self, b, path, filename, md5=None, predefined_acl=None):
+    key = self._new_key(b, path)
+    try:
+      # If we pass in the MD5 hash, boto doesn't read the file an extra time
+      # to compute it.
+      key.set_contents_from_filename(filename=filename, policy=predefined_acl,
+                                     md5=_md5_tuple(md5) if md5 else None)
+    except BotoServerError, e:
+      e.body = (repr(e.body) +
+                ' while uploading source_path=%s to %s' % (
+                    filename, self._url(b, path)))
+      raise
+
+  def get_file(self, b, path, fp, generation=None):
+    key = self._new_key(b, path, generation=generation)
+    try:
+      key.get_contents_to_file(fp=fp)
+    except BotoServerError, e:
+      e.body = (repr(e.body) +
+                ' while downloading %s' % self._url(b, path))
+      raise
+    return key.size
+
+  def get_filename(self, b, path, filename, generation=None):
+    key = self._new_key(b, path, generation=generation)
+    with open(filename, 'wb') as f:
+      try:
+        key.get_contents_to_file(fp=f)
+      except BotoServerError, e:
+        e.body = (repr(e.body) +
+                  ' while downloading %s to local_path=%s' % (
+                      self._url(b, path), filename))
+        raise
+
+  def iter_contents(self, b, path):
+    # Iterating over a Key reads its contents in chunks.
+    return iter(self._new_key(b, path))
+
+  def copy(self, src_b, src_path, dst_b, dst_path, predefined_acl=None):
+    headers = {}
+    if predefined_acl:
+      headers[dst_b.connection.provider.acl_header] = predefined_acl
+    try:
+      dst_b.copy_key(
+          new_key_name=dst_path, src_bucket_name=src_b.name,
+          src_key_name=src_path, preserve_acl=False, headers=headers)
+    except BotoServerError, e:
+      e.body = (repr(e.body) +
+                ' while copying %s to %s' % (
+                    self._url(src_b, src_path), self._url(dst_b, dst_path)))
+      raise
+
+  def delete(self, b, path):
+    try:
+      b.delete_key(key_name=path)
+    except BotoServerError, e:
+      e.body = (repr(e.body) +
+                ' while deleting %s' % self._url(b, path))
+      raise
+
+  def _matching_acl_entries(self, acls, id_type, id_value):
+    """Returns the entries within acls that refer to id_type/id_value."""
+    field = self._field_by_id_type[id_type]
+    matching_entries = [entry for entry in acls.entries.entry_list
+                        if (entry.scope.type == id_type) and
+                        (getattr(entry.scope, field) == id_value)]
+    assert len(matching_entries) <= 1, '%d <= 1' % len(matching_entries)
+    return matching_entries
+
+  def get_acl_entry(self, b, path, id_type, id_value):
+    acls = b.get_acl(key_name=path)
+    matching_entries = self._matching_acl_entries(
+        acls=acls, id_type=id_type, id_value=id_value)
+    if matching_entries:
+      return matching_entries[0].permission
+    else:
+      return GSUtils.Permission.EMPTY
+
+  def set_acl_entry(self, b, path, id_type, id_value, permission):
+    acls = b.get_acl(key_name=path)
+
+    # Remove any existing entries that refer to the same id_type/id_value,
+    # because the API will fail if we try to set more than one.
+    for entry in self._matching_acl_entries(
+        acls=acls, id_type=id_type, id_value=id_value):
+      acls.entries.entry_list.remove(entry)
+
+    # Add a new entry to the ACLs.
+    if permission != GSUtils.Permission.EMPTY:
+      args = {'type': id_type, 'permission': permission}
+      args[self._field_by_id_type[id_type]] = id_value
+      acls.entries.entry_list.append(acl.Entry(**args))
+
+    # Finally, write back the modified ACLs.
+    b.set_acl(acl_or_str=acls, key_name=path)
+
+
+class S3Backend(GSBackend):
+  """StorageBackend that stores files in Amazon S3, or in any other service
+  that is compatible with its API, using boto.
+
+  S3 ACLs cannot grant permissions to groups by domain, email or ID, so only
+  the USER_BY_EMAIL and USER_BY_ID IdTypes are supported.  (S3 reports grants
+  made by email as grants to the user's ID, so get_acl() will only find those
+  by USER_BY_ID.)  S3 calls the generation of a file its version ID.
+  """
+
+  _field_by_id_type = {
+      GSUtils.IdType.USER_BY_EMAIL: 'email_address',
+      GSUtils.IdType.USER_BY_ID:    'id',
+  }
+
+  # How S3 names the IdTypes we support.
+  _s3_type_by_id_type = {
+      GSUtils.IdType.USER_BY_EMAIL: 'AmazonCustomerByEmail',
+      GSUtils.IdType.USER_BY_ID:    'CanonicalUser',
+  }
+
+  _url_prefix = 's3://'
+
+  def __init__(self, aws_access_key_id=None, aws_secret_access_key=None,
+               host=None, region=None):
+    """Constructor.
+
+    Params:
+      aws_access_key_id: access key to connect with, or None to let boto find
+          credentials in its usual places (environment variables, .boto file,
+          etc.)
+      aws_secret_access_key: secret for aws_access_key_id
+      host: hostname of the endpoint to connect to (e.g. that of an
+          S3-compatible service), or None to use Amazon S3
+      region: Amazon S3 region (e.g. 'eu-west-1') whose endpoint to connect
+          to, if host is None; or None for the default endpoint
+    """
+    if region and not host:
+      host = 's3.%s.amazonaws.com' % region
+    super(S3Backend, self).__init__(
+        gs_access_key_id=aws_access_key_id,
+        gs_secret_access_key=aws_secret_access_key, host=host)
 
   def _create_connection(self):
-    """Returns a GSConnection object we can use to access Google Storage."""
-    if self._gs_access_key_id:
-      return GSConnection(
-          gs_access_key_id=self._gs_access_key_id,
-          gs_secret_access_key=self._gs_secret_access_key)
+    """Returns an S3Connection object we can use to access S3."""
+    _import_boto()
+    kwargs = {}
+    if self._host:
+      # Bucket names are not necessarily valid hostnames on other services.
+      kwargs['host'] = self._host
+      kwargs['calling_format'] = OrdinaryCallingFormat()
+    return S3Connection(
+        aws_access_key_id=self._access_key_id,
+        aws_secret_access_key=self._secret_access_key, **kwargs)
+
+  def _new_key(self, b, path, generation=None):
+    key = b.new_key(key_name=path)
+    if generation:
+      key.version_id = generation
+    return key
+
+  def put_file(self, b, path, fp, predefined_acl=None, size=None, md5=None):
+    if size is not None:
+      return super(S3Backend, self).put_file(
+          b=b, path=path, fp=fp, predefined_acl=predefined_acl, size=size,
+          md5=md5)
+    # S3 does not accept chunked transfer encoding, so we need to know the
+    # size of a stream before we send it.  Spool it (to memory if it is small,
+    # to local disk if not) first.
+    hasher = hashlib.md5()
+    with tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE) as spool:
+      while True:
+        data = fp.read(_CHUNK_SIZE)
+        if not data:
+          break
+        hasher.update(data)
+        spool.write(data)
+      size = spool.tell()
+      spool.seek(0)
+      super(S3Backend, self).put_file(
+          b=b, path=path, fp=spool, predefined_acl=predefined_acl, size=size,
+          md5=hasher.hexdigest())
+
+  def _matching_acl_entries(self, acls, id_type, id_value):
+    field = self._field_by_id_type[id_type]
+    s3_type = self._s3_type_by_id_type[id_type]
+    return [grant for grant in acls.acl.grants
+            if (grant.type == s3_type) and
+            (getattr(grant, field) == id_value)]
+
+  def get_acl_entry(self, b, path, id_type, id_value):
+    policy = b.get_acl(key_name=path)
+    matching_entries = self._matching_acl_entries(
+        acls=policy, id_type=id_type, id_value=id_value)
+    if matching_entries:
+      return matching_entries[0].permission
     else:
-      return AnonymousGSConnection()
+      return GSUtils.Permission.EMPTY
+
+  def set_acl_entry(self, b, path, id_type, id_value, permission):
+    policy = b.get_acl(key_name=path)
+    for grant in self._matching_acl_entries(
+        acls=policy, id_type=id_type, id_value=id_value):
+      policy.acl.grants.remove(grant)
+    if permission != GSUtils.Permission.EMPTY:
+      args = {'type': self._s3_type_by_id_type[id_type],
+              'permission': permission}
+      args[self._field_by_id_type[id_type]] = id_value
+      policy.acl.add_grant(s3_acl.Grant(**args))
+    b.set_acl(acl_or_str=policy, key_name=path)
+
+
+class LocalBackend(StorageBackend):
+  """StorageBackend that stores files on the local filesystem, so that code
+  using GSUtils can be run (and tested) hermetically, at disk speed.
+
+  Each bucket is a directory within root, and each file within it is stored
+  at its path within that directory.  Writes go to a temporary file that is
+  then renamed into place, so files are never seen partially written and are
+  never modified in place; that lets copy() just make a hard link.
+
+  Buckets must be created with create_bucket() before use.  Fine-grained ACLs
+  are recorded (so that get_acl() returns what set_acl() set) but not
+  enforced, and predefined ACLs are ignored.  Generations are not supported.
+
+  Example Code:
+    backend = gs_utils.LocalBackend(root='/tmp/fake-gs')
+    backend.create_bucket('chromium-skia-gm')
+    gs = gs_utils.GSUtils(backend=backend)
+  """
+
+  def __init__(self, root, link_files=False):
+    """Constructor.
+
+    Params:
+      root: full path (local-OS-style) of the directory to store buckets in
+      link_files: if True, "upload" and "download" files by hard-linking them
+          into and out of root instead of copying them, where possible.  This
+          is much faster for large files, but then modifying a local file in
+          place also modifies the "stored" file linked to it.
+    """
+    self._root = os.path.abspath(root)
+    self._link_files = link_files
+    self._tmp_dir = os.path.join(self._root, '.tmp')
+    self._acl_dir = os.path.join(self._root, '.acls')
+    _makedirs_if_needed(self._tmp_dir)
+    # MD5 hashes of the files we have seen, keyed by full local path; each
+    # value is a ((st_ino, st_size, st_mtime), md5) tuple, so that we notice
+    # if the file has been replaced since.
+    self._md5_cache = {}
+    self._md5_cache_lock = threading.Lock()
+
+  def _bucket_dir(self, bucket):
+    """Returns the full local path of a bucket's directory.
+
+    Raises an Exception if the bucket name is not a single path component, or
+    would collide with our own .tmp or .acls directories.
+    """
+    if (not bucket or bucket.startswith('.') or '/' in bucket or
+        os.sep in bucket):
+      raise Exception('invalid bucket name %r' % bucket)
+    return os.path.join(self._root, bucket)
+
+  def create_bucket(self, bucket):
+    """Creates an empty bucket, if it does not exist yet."""
+    _makedirs_if_needed(self._bucket_dir(bucket))
+
+  def get_bucket(self, bucket):
+    if not isinstance(bucket, basestring):
+      return bucket
+    dirpath = self._bucket_dir(bucket)
+    if not os.path.isdir(dirpath):
+      raise Exception('no such bucket %s in %s' % (bucket, self._root))
+    return _LocalBucket(name=bucket, dirpath=dirpath)
+
+  def _local_path(self, b, path):
+    """Returns the full local path at which to store a file.
+
+    Raises an Exception if path cannot be stored verbatim within the bucket.
+    """
+    return _path_within(b.dirpath, path)
+
+  def _acl_path(self, b, path):
+    """Returns the full local path at which to record a file's ACLs."""
+    return _path_within(os.path.join(self._acl_dir, b.name), path) + '.json'
+
+  def _md5(self, local_path, st):
+    """Returns the MD5 hash of a local file, whose os.stat() result is st."""
+    signature = (st.st_ino, st.st_size, st.st_mtime)
+    with self._md5_cache_lock:
+      cached = self._md5_cache.get(local_path)
+    if cached and cached[0] == signature:
+      return cached[1]
+    md5 = _get_local_md5(path=local_path)
+    self._remember_md5(local_path=local_path, st=st, md5=md5)
+    return md5
+
+  def _remember_md5(self, local_path, st, md5):
+    """Records the MD5 hash of a local file, whose os.stat() result is st."""
+    with self._md5_cache_lock:
+      self._md5_cache[local_path] = ((st.st_ino, st.st_size, st.st_mtime), md5)
+
+  def _object_info(self, b, path, st):
+    """Returns the ObjectInfo for a file, whose os.stat() result is st."""
+    return ObjectInfo(
+        name=path,
+        etag='"%s"' % self._md5(local_path=self._local_path(b, path), st=st),
+        last_modified=email.utils.formatdate(st.st_mtime, usegmt=True),
+        size=st.st_size)
+
+  def get_info(self, b, path):
+    try:
+      st = os.stat(self._local_path(b, path))
+    except OSError as e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return None
+      raise
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    return self._object_info(b, path, st)
+
+  def list(self, b, prefix, delimiter=None):
+    # Start from the deepest directory that contains everything under prefix.
+    (dir_prefix, _, _) = prefix.rpartition('/')
+    if dir_prefix:
+      dir_prefix += '/'
+    results = []
+    self._list_dir(b=b, dir_prefix=dir_prefix, prefix=prefix,
+                   delimiter=delimiter, results=results)
+    # Files in different directories may share a prefix, if the delimiter is
+    # not '/'.
+    unique_results = {}
+    for item in results:
+      unique_results[getattr(item, 'name', item)] = item
+    return [unique_results[name] for name in sorted(unique_results)]
+
+  def _list_dir(self, b, dir_prefix, prefix, delimiter, results):
+    """Appends to results what list() should return from within one local
+    directory.
+
+    Params:
+      b: bucket handle to list
+      dir_prefix: path prefix (empty, or ending in '/') of the directory
+      prefix, delimiter: as passed to list()
+      results: list to append each ObjectInfo or prefix to
+    """
+    for (name, is_dir) in _scan_dir(self._local_path(b, dir_prefix)):
+      path = dir_prefix + name
+      if is_dir:
+        path += '/'
+        if not (path.startswith(prefix) or prefix.startswith(path)):
+          continue
+        if delimiter and path.startswith(prefix) and (
+            delimiter in path[len(prefix):]):
+          results.append(
+              path[:path.index(delimiter, len(prefix)) + len(delimiter)])
+        else:
+          self._list_dir(b=b, dir_prefix=path, prefix=prefix,
+                         delimiter=delimiter, results=results)
+      elif path.startswith(prefix):
+        if delimiter and delimiter in path[len(prefix):]:
+          results.append(
+              path[:path.index(delimiter, len(prefix)) + len(delimiter)])
+        else:
+          st = os.stat(self._local_path(b, path))
+          results.append(self._object_info(b, path, st))
+
+  def _put_local(self, b, path, write_tmp, md5=None):
+    """Writes a file via a temporary file that is then renamed into place.
+
+    Params:
+      b: bucket handle to write into
+      path: path of the file within b
+      write_tmp: function that writes the contents into the local path passed
+          to it, and returns their MD5 hash (if known)
+      md5: MD5 hash of the contents, if known
+    """
+    local_path = self._local_path(b, path)
+    tmp_path = os.path.join(self._tmp_dir, uuid.uuid4().hex)
+    try:
+      md5 = write_tmp(tmp_path) or md5
+      _makedirs_if_needed(os.path.dirname(local_path))
+      os.rename(tmp_path, local_path)
+    finally:
+      # The rename leaves tmp_path behind if local_path was already a link to
+      # the same file.
+      if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    # Any ACLs set on a file of the same name are for the old file.
+    self._remove_acls(b, path)
+    if md5:
+      self._remember_md5(local_path=local_path, st=os.stat(local_path),
+                         md5=md5)
+
+  def put_file(self, b, path, fp, predefined_acl=None, size=None, md5=None):
+    def write_tmp(tmp_path):
+      hasher = hashlib.md5()
+      with open(tmp_path, 'wb') as f:
+        while True:
+          data = fp.read(_CHUNK_SIZE)
+          if not data:
+            break
+          hasher.update(data)
+          f.write(data)
+      return hasher.hexdigest()
+    self._put_local(b=b, path=path, write_tmp=write_tmp)
+
+  def put_filename(self, b, path, filename, md5=None, predefined_acl=None):
+    def write_tmp(tmp_path):
+      if not (self._link_files and _link_if_possible(filename, tmp_path)):
+        shutil.copyfile(filename, tmp_path)
+    self._put_local(b=b, path=path, write_tmp=write_tmp, md5=md5)
+
+  def _check_generation(self, generation):
+    if generation:
+      raise Exception('LocalBackend does not support generations')
+
+  def get_file(self, b, path, fp, generation=None):
+    self._check_generation(generation)
+    num_bytes = 0
+    with open(self._local_path(b, path), 'rb') as f:
+      while True:
+        data = f.read(_CHUNK_SIZE)
+        if not data:
+          return num_bytes
+        fp.write(data)
+        num_bytes += len(data)
+
+  def get_filename(self, b, path, filename, generation=None):
+    self._check_generation(generation)
+    local_path = self._local_path(b, path)
+    if self._link_files:
+      if os.path.lexists(filename):
+        os.remove(filename)
+      if _link_if_possible(local_path, filename):
+        return
+    shutil.copyfile(local_path, filename)
+
+  def iter_contents(self, b, path):
+    with open(self._local_path(b, path), 'rb') as f:
+      while True:
+        data = f.read(_CHUNK_SIZE)
+        if not data:
+          return
+        yield data
+
+  def copy(self, src_b, src_path, dst_b, dst_path, predefined_acl=None):
+    src_local_path = self._local_path(src_b, src_path)
+    def write_tmp(tmp_path):
+      if not _link_if_possible(src_local_path, tmp_path):
+        shutil.copyfile(src_local_path, tmp_path)
+    self._put_local(b=dst_b, path=dst_path, write_tmp=write_tmp)
+
+  def delete(self, b, path):
+    os.remove(self._local_path(b, path))
+    self._remove_acls(b, path)
+    # Like Google Storage, we have no empty directories.
+    dirpath = os.path.dirname(self._local_path(b, path))
+    while dirpath != b.dirpath:
+      try:
+        os.rmdir(dirpath)
+      except OSError:
+        break
+      dirpath = os.path.dirname(dirpath)
+
+  def _read_acls(self, b, path):
+    """Returns a dict mapping 'id_type:id_value' to permission, for each
+    fine-grained ACL set on a file."""
+    if not os.path.exists(self._local_path(b, path)):
+      raise Exception('no such file %s%s/%s' % (GS_PREFIX, b.name, path))
+    try:
+      with open(self._acl_path(b, path)) as f:
+        return json.load(f)
+    except IOError as e:
+      if e.errno == errno.ENOENT:
+        return {}
+      raise
+
+  def _remove_acls(self, b, path):
+    """Forgets all fine-grained ACLs set on a file."""
+    try:
+      os.remove(self._acl_path(b, path))
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def get_acl_entry(self, b, path, id_type, id_value):
+    return self._read_acls(b, path).get('%s:%s' % (id_type, id_value),
+                                        GSUtils.Permission.EMPTY)
+
+  def set_acl_entry(self, b, path, id_type, id_value, permission):
+    acls = self._read_acls(b, path)
+    acls.pop('%s:%s' % (id_type, id_value), None)
+    if permission != GSUtils.Permission.EMPTY:
+      acls['%s:%s' % (id_type, id_value)] = permission
+    acl_path = self._acl_path(b, path)
+    _makedirs_if_needed(os.path.dirname(acl_path))
+    with open(acl_path, 'w') as f:
+      json.dump(acls, f)
+
+
+class MultiBucketGSUtils(object):
+  """Routes operations on each Google Storage bucket to the GSUtils object
+  (credentials and endpoint) responsible for that bucket.
+
+  Each GSUtils object acts as a separate shard, with its own connections, so
+  one client can work across buckets belonging to different projects.  The
+  bulk methods interleave work on different buckets, so that a bucket with a
+  lot of work to do cannot starve the others.
+
+  Example Code:
+    gs = MultiBucketGSUtils(
+        routes=[('chromium-skia-*', GSUtils(boto_file_path=skia_boto_path)),
+                ('other-project-bucket', GSUtils(boto_file_path=other_path))],
+        default=GSUtils())
+    gs.upload_files([(local_path1, 'chromium-skia-gm', 'path/file1'),
+                     (local_path2, 'other-project-bucket', 'path/file2')])
+  """
+
+  def __init__(self, routes, default=None):
+    """Constructor.
+
+    Params:
+      routes: list of (bucket_pattern, gs_utils) tuples; operations on a bucket
+          whose name matches bucket_pattern (a shell-style wildcard, as used
+          by fnmatch) are sent to that GSUtils object.  The first matching
+          pattern wins.
+      default: GSUtils object to use for buckets matching none of the routes,
+          or None to raise an exception for such buckets
+    """
+    self._routes = list(routes)
+    self._default = default
+    self._shard_by_bucket = {}
+    self._lock = threading.Lock()
+    # Bulk operations run on these threads, which keep their connections to
+    # each shard (see GSBackend) from one operation to the next.
+    self._pool = _ThreadPool()
+
+  def for_bucket(self, bucket):
+    """Returns the GSUtils object responsible for a bucket.
+
+    Params:
+      bucket: name of the bucket, or a Bucket object
+    """
+    bucket_name = _bucket_name(bucket)
+    with self._lock:
+      if bucket_name not in self._shard_by_bucket:
+        shard = self._default
+        for (pattern, gs_utils) in self._routes:
+          if fnmatch.fnmatchcase(bucket_name, pattern):
+            shard = gs_utils
+            break
+        if not shard:
+          raise Exception('no GSUtils configured for bucket %s' % bucket_name)
+        self._shard_by_bucket[bucket_name] = shard
+      return self._shard_by_bucket[bucket_name]
+
+  def delete_file(self, bucket, path):
+    """GSUtils.delete_file(), using the shard for bucket."""
+    return self.for_bucket(bucket).delete_file(bucket=bucket, path=path)
+
+  def get_last_modified_time(self, bucket, path):
+    """GSUtils.get_last_modified_time(), using the shard for bucket."""
+    return self.for_bucket(bucket).get_last_modified_time(
+        bucket=bucket, path=path)
+
+  def upload_file(self, source_path, dest_bucket, dest_path, **kwargs):
+    """GSUtils.upload_file(), using the shard for dest_bucket."""
+    return self.for_bucket(dest_bucket).upload_file(
+        source_path=source_path, dest_bucket=dest_bucket, dest_path=dest_path,
+        **kwargs)
+
+  def upload_from_buffer(self, source, dest_bucket, dest_path, **kwargs):
+    """GSUtils.upload_from_buffer(), using the shard for dest_bucket."""
+    return self.for_bucket(dest_bucket).upload_from_buffer(
+        source=source, dest_bucket=dest_bucket, dest_path=dest_path, **kwargs)
+
+  def upload_dir_contents(self, source_dir, dest_bucket, dest_dir, **kwargs):
+    """GSUtils.upload_dir_contents(), using the shard for dest_bucket."""
+    return self.for_bucket(dest_bucket).upload_dir_contents(
+        source_dir=source_dir, dest_bucket=dest_bucket, dest_dir=dest_dir,
+        **kwargs)
+
+  def copy_prefix(self, src_bucket, src_prefix, dst_bucket, dst_prefix,
+                  **kwargs):
+    """GSUtils.copy_prefix(), using the shard for dst_bucket.
+
+    That shard's credentials must also be able to read from src_bucket.
+    """
+    return self.for_bucket(dst_bucket).copy_prefix(
+        src_bucket=src_bucket, src_prefix=src_prefix, dst_bucket=dst_bucket,
+        dst_prefix=dst_prefix, **kwargs)
+
+  def move_prefix(self, src_bucket, src_prefix, dst_bucket, dst_prefix,
+                  **kwargs):
+    """GSUtils.move_prefix(), using the shard for dst_bucket.
+
+    That shard's credentials must also be able to delete from src_bucket.
+    """
+    return self.for_bucket(dst_bucket).move_prefix(
+        src_bucket=src_bucket, src_prefix=src_prefix, dst_bucket=dst_bucket,
+        dst_prefix=dst_prefix, **kwargs)
+
+  def download_file(self, source_bucket, source_path, dest_path, **kwargs):
+    """GSUtils.download_file(), using the shard for source_bucket."""
+    return self.for_bucket(source_bucket).download_file(
+        source_bucket=source_bucket, source_path=source_path,
+        dest_path=dest_path, **kwargs)
+
+  def download_to_buffer(self, source_bucket, source_path, **kwargs):
+    """GSUtils.download_to_buffer(), using the shard for source_bucket."""
+    return self.for_bucket(source_bucket).download_to_buffer(
+        source_bucket=source_bucket, source_path=source_path, **kwargs)
+
+  def download_dir_contents(self, source_bucket, source_dir, dest_dir):
+    """GSUtils.download_dir_contents(), using the shard for source_bucket."""
+    return self.for_bucket(source_bucket).download_dir_contents(
+        source_bucket=source_bucket, source_dir=source_dir, dest_dir=dest_dir)
+
+  def get_acl(self, bucket, path, id_type, id_value):
+    """GSUtils.get_acl(), using the shard for bucket."""
+    return self.for_bucket(bucket).get_acl(
+        bucket=bucket, path=path, id_type=id_type, id_value=id_value)
+
+  def set_acl(self, bucket, path, id_type, id_value, permission):
+    """GSUtils.set_acl(), using the shard for bucket."""
+    return self.for_bucket(bucket).set_acl(
+        bucket=bucket, path=path, id_type=id_type, id_value=id_value,
+        permission=permission)
+
+  def list_bucket_contents(self, bucket, subdir=None):
+    """GSUtils.list_bucket_contents(), using the shard for bucket."""
+    return self.for_bucket(bucket).list_bucket_contents(
+        bucket=bucket, subdir=subdir)
+
+  def does_storage_object_exist(self, bucket, object_name):
+    """GSUtils.does_storage_object_exist(), using the shard for bucket."""
+    return self.for_bucket(bucket).does_storage_object_exist(
+        bucket=bucket, object_name=object_name)
+
+  def upload_files(self, uploads, num_threads=DEFAULT_UPLOAD_THREADS,
+                   **kwargs):
+    """Upload many local files, which may be bound for different buckets.
+
+    params:
+      uploads: iterable of (source_path, dest_bucket, dest_path) tuples, with
+          the same meanings as in GSUtils.upload_file()
+      num_threads: how many files to upload at once, across all buckets
+      kwargs: any additional keyword arguments "inherited" from upload_file()
+    """
+    def upload(item):
+      (source_path, dest_bucket, dest_path) = item
+      self.upload_file(source_path=source_path, dest_bucket=dest_bucket,
+                       dest_path=dest_path, **kwargs)
+    self._run_bulk(func=upload, items=uploads, bucket_index=1,
+                   num_threads=num_threads, description='upload')
+
+  def download_files(self, downloads, num_threads=DEFAULT_UPLOAD_THREADS,
+                     **kwargs):
+    """Download many files, which may come from different buckets.
+
+    params:
+      downloads: iterable of (source_bucket, source_path, dest_path) tuples,
+          with the same meanings as in GSUtils.download_file()
+      num_threads: how many files to download at once, across all buckets
+      kwargs: any additional keyword arguments "inherited" from download_file()
+    """
+    def download(item):
+      (source_bucket, source_path, dest_path) = item
+      self.download_file(source_bucket=source_bucket, source_path=source_path,
+                         dest_path=dest_path, **kwargs)
+    self._run_bulk(func=download, items=downloads, bucket_index=0,
+                   num_threads=num_threads, description='download')
+
+  def delete_files(self, deletes, num_threads=DEFAULT_UPLOAD_THREADS):
+    """Delete many files, which may be in different buckets.
+
+    params:
+      deletes: iterable of (bucket, path) tuples, with the same meanings as in
+          GSUtils.delete_file()
+      num_threads: how many files to delete at once, across all buckets
+    """
+    def delete(item):
+      (bucket, path) = item
+      self.delete_file(bucket=bucket, path=path)
+    self._run_bulk(func=delete, items=deletes, bucket_index=0,
+                   num_threads=num_threads, description='delete')
+
+  def _run_bulk(self, func, items, bucket_index, num_threads, description):
+    """Runs func on each item in parallel, taking turns between buckets.
+
+    Params:
+      func: function to call with each item
+      items: iterable of tuples to pass to func
+      bucket_index: index within each tuple of the bucket it refers to
+      num_threads: how many items to process at once
+      description: noun describing each call, for logging
+
+    Raises an Exception listing all the items that failed, if any did.
+    """
+    items = _interleave(items=items,
+                        key=lambda item: _bucket_name(item[bucket_index]))
+    err = _run_in_parallel(
+        func=func, items=items, num_threads=num_threads,
+        progress_format=' Processing file %d/%d: %s',
+        retry_description=description, pool=self._pool)
+    if err:
+      errMsg = 'Failed to %s the following: \n\n' % description
+      for item, e in err.iteritems():
+        errMsg += '%s: %s\n' % (item, e)
+      raise Exception(errMsg)
+
+
+def _import_boto():
+  """Imports the boto modules we use into this module's namespace.
+
+  This is cheap to call once the modules have been imported, so call it before
+  any use of boto.  We defer this work until the first network operation, so
+  that importing gs_utils does not pay for importing boto.
+  """
+  # pylint: disable=W0603,W0621
+  global acl, AnonymousGSConnection, BotoServerError, Bucket
+  global BucketListResultSet, GSConnection, Key, OrdinaryCallingFormat, Prefix
+  global s3_acl, S3Connection, SubdomainCallingFormat
+  if GSConnection:
+    return
+  with _boto_import_lock:
+    if GSConnection:
+      return
+    for import_subdir in ['boto']:
+      import_dirpath = os.path.join(
+          TRUNK_DIRECTORY, 'third_party', 'externals', import_subdir)
+      if import_dirpath not in sys.path:
+        # We need to insert at the beginning of the path, to make sure that our
+        # imported versions are favored over others that might be in the path.
+        sys.path.insert(0, import_dirpath)
+    from boto.exception import BotoServerError
+    from boto.gs import acl
+    from boto.gs.bucket import Bucket
+    from boto.gs.key import Key
+    from boto.s3 import acl as s3_acl
+    from boto.s3.bucketlistresultset import BucketListResultSet
+    from boto.s3.connection import OrdinaryCallingFormat
+    from boto.s3.connection import S3Connection
+    from boto.s3.connection import SubdomainCallingFormat
+    from boto.s3.prefix import Prefix
+    from boto.gs.connection import GSConnection as _GSConnection
+
+    class _AnonymousGSConnection(_GSConnection):
+      """GSConnection class that allows anonymous connections.
+
+      The GSConnection class constructor in
+      https://github.com/boto/boto/blob/develop/boto/gs/connection.py doesn't
+      allow for anonymous connections (connections without credentials), so we
+      have to override it.
+      """
+      def __init__(self, host=_GSConnection.DefaultHost):
+        super(_GSConnection, self).__init__(
+            # This is the important bit we need to add...
+            anon=True,
+            # ...and these are just copied in from GSConnection.__init__()
+            bucket_class=Bucket,
+            calling_format=SubdomainCallingFormat(),
+            host=host,
+            provider='google')
+
+    AnonymousGSConnection = _AnonymousGSConnection
+    # Set this last, since the fast path above checks it without the lock.
+    GSConnection = _GSConnection
+
+
+def _cached_config_file_as_dict(filepath):
+  """Same as _config_file_as_dict(), but only reads each file once per process.
+
+  Params:
+    filepath: path to config file on local disk
+  """
+  filepath = os.path.abspath(filepath)
+  with _config_file_cache_lock:
+    if filepath not in _config_file_cache:
+      _config_file_cache[filepath] = _config_file_as_dict(filepath=filepath)
+    return _config_file_cache[filepath]
 
 
 def _config_file_as_dict(filepath):
@@ -733,3 +1960,404 @@ def _get_local_md5(path):
       if not data:
         return hasher.hexdigest()
       hasher.update(data)
+
+
+def _bucket_name(bucket):
+  """Returns the name of a bucket, given its name or a Bucket object."""
+  return bucket if isinstance(bucket, basestring) else bucket.name
+
+
+def _path_within(dirpath, path):
+  """Returns the local path of path (Posix-style, optionally ending in '/')
+  within dirpath.
+
+  Object names are used verbatim, never normalized: Google Storage would treat
+  'a/../b' and 'b' as different files, so a LocalBackend must not alias them.
+  Raises an Exception if path contains a component that we cannot store that
+  way ('', '.' or '..', or one containing a local path separator).
+  """
+  parts = path.split('/')
+  if parts[-1] == '':
+    parts.pop()
+  for part in parts:
+    if part in ('', '.', '..') or os.sep in part or (
+        os.altsep and os.altsep in part):
+      raise Exception('LocalBackend cannot store path %r' % path)
+  return os.path.join(dirpath, *parts)
+
+
+def _object_info(key):
+  """Returns an ObjectInfo describing a boto Key."""
+  return ObjectInfo(name=key.name, etag=key.etag,
+                    last_modified=key.last_modified, size=key.size)
+
+
+def _scan_dir(dirpath):
+  """Yields a (name, is_dir) tuple for each entry within a local directory, or
+  nothing if the directory does not exist.
+
+  Uses scandir (built into Python 3.5 and later, and available as a separate
+  package before that) if we can, so that we can tell files from directories
+  without calling os.stat() on each one.
+  """
+  try:
+    if _scandir:
+      for entry in _scandir(dirpath):
+        yield (entry.name, entry.is_dir())
+      return
+    names = os.listdir(dirpath)
+  except OSError as e:
+    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+      return
+    raise
+  for name in names:
+    yield (name, os.path.isdir(os.path.join(dirpath, name)))
+
+
+def _link_if_possible(src, dst):
+  """Creates dst as a hard link to src, if possible.
+
+  Returns True if we created the link, or False if the OS or filesystem does
+  not support it (e.g., if src and dst are on different devices).
+  """
+  if not hasattr(os, 'link'):
+    return False
+  try:
+    os.link(src, dst)
+    return True
+  except OSError as e:
+    if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+      return False
+    raise
+
+
+def _interleave(items, key):
+  """Returns a list of items, reordered so that items with different keys take
+  turns (round-robin), while items with the same key stay in order.
+
+  Params:
+    items: iterable of items to reorder
+    key: function returning the key of each item
+  """
+  groups = collections.OrderedDict()
+  for item in items:
+    groups.setdefault(key(item), []).append(item)
+  interleaved = []
+  for i in range(max([len(group) for group in groups.values()] or [0])):
+    for group in groups.values():
+      if i < len(group):
+        interleaved.append(group[i])
+  return interleaved
+
+
+class _ThreadPool(object):
+  """Daemon threads which persist from one _run_in_parallel() call to the
+  next, so that what they keep in threading.local objects (such as
+  GSBackend's connections and Bucket objects) is reused across calls.
+
+  The pool grows to the largest number of functions ever run at once.
+  """
+
+  def __init__(self):
+    self._tasks = Queue.Queue()
+    self._lock = threading.Lock()
+    self._num_idle = 0
+
+  def spawn(self, func):
+    """Calls func() on one of the threads (starting a new one if none is
+    idle), and returns a threading.Event which is set once func returns."""
+    done = threading.Event()
+    with self._lock:
+      if self._num_idle:
+        self._num_idle -= 1
+      else:
+        t = threading.Thread(target=self._worker)
+        t.daemon = True
+        t.start()
+    self._tasks.put((func, done))
+    return done
+
+  def _worker(self):
+    while True:
+      (func, done) = self._tasks.get()
+      try:
+        func()
+      finally:
+        with self._lock:
+          self._num_idle += 1
+        done.set()
+
+
+def _run_in_parallel(func, items, num_threads, progress_format,
+                     retry_description, retries=5, pool=None):
+  """Calls func(item) for each item, using a pool of worker threads.
+
+  Each failed call is retried, with exponential backoff, up to retries times
+  in total.
+
+  Params:
+    func: function to call with each item
+    items: iterable of items to pass to func
+    num_threads: maximum number of calls to make at once
+    progress_format: format string, into which we substitute (number of items
+        started, total number of items, item), to print as we start each item
+    retry_description: noun describing each call, for logging of retries
+    retries: how many times to try each item before giving up
+    pool: _ThreadPool to run the workers on, or None to start new threads for
+        this call alone
+
+  Returns a dict mapping each item for which all attempts failed, to the
+  exception raised by its final attempt.
+  """
+  items = list(items)
+  if not items:
+    return {}
+  num_threads = min(num_threads, len(items))
+
+  # Create a work queue with all items that need to be processed.
+  q = Queue.Queue(maxsize=len(items))
+  for item in items:
+    q.put(item)
+
+  err = {}
+
+  # Spin up worker threads to read from the task queue.
+  def worker():
+    while True:
+      try:
+        item = q.get(block=False)
+      except Queue.Empty:
+        return  # no more tasks in the queue, so exit
+      print (progress_format % (len(items) - q.qsize(), len(items), item))
+
+      try:
+        for retry in range(retries):
+          try:
+            func(item)
+            break
+          except Exception as error:
+            if retry < retries - 1:
+              print '  Retrying %s, attempt #%d' % (
+                  retry_description, retry + 1)
+              time.sleep(2 ** retry)
+            else:
+              err[item] = error
+      finally:
+        q.task_done()
+
+  if pool:
+    done_events = [pool.spawn(worker) for _ in range(num_threads)]
+    # Block until all items have been processed, and the workers have
+    # returned.
+    q.join()
+    for done in done_events:
+      done.wait()
+    return err
+
+  threads = []
+  for _ in range(num_threads):
+    t = threading.Thread(target=worker)
+    t.daemon = True
+    t.start()
+    threads.append(t)
+
+  # Block until all items have been processed, and the workers have exited
+  # (so that none of them is still running at interpreter shutdown).
+  q.join()
+  for t in threads:
+    t.join()
+  return err
+
+
+def _md5_tuple(hexdigest):
+  """Returns the (hexdigest, base64digest) tuple that boto wants for an MD5."""
+  return (hexdigest, base64.b64encode(hexdigest.decode('hex')))
+
+
+def _make_reader(source):
+  """Returns a file-like object that reads the data in source, as passed to
+  GSUtils.upload_from_buffer().
+
+  The object returned is a _StreamReader if we cannot know the size and MD5
+  hash of source without consuming it.
+  """
+  if hasattr(source, 'read'):
+    try:
+      return _FileReader(source)
+    except (AttributeError, IOError, OSError):
+      # Pipes, sockets etc. cannot seek.
+      return _StreamReader(iter(lambda: source.read(_CHUNK_SIZE), ''))
+  try:
+    return _BufferReader(memoryview(source))
+  except TypeError:
+    return _StreamReader(iter(source))
+
+
+# How many bytes to process at a time when hashing or streaming data.
+_CHUNK_SIZE = 64*1024
+
+# How many bytes of a stream S3Backend will hold in memory, before spooling the
+# rest to local disk.
+_SPOOL_SIZE = 16*1024*1024
+
+
+class _BufferReader(object):
+  """Read-only, seekable file-like view of an in-memory buffer.
+
+  read() copies out only the bytes it returns; the buffer itself is never
+  copied as a whole.
+  """
+
+  def __init__(self, view):
+    self._view = view
+    self._pos = 0
+
+  def md5(self):
+    """Returns the MD5 hash of the entire buffer, as a hex string."""
+    return hashlib.md5(self._view).hexdigest()
+
+  def size(self):
+    """Returns the size of the entire buffer, in bytes."""
+    return len(self._view)
+
+  def read(self, size=-1):
+    end = len(self._view) if size < 0 else min(self._pos + size,
+                                                len(self._view))
+    data = self._view[self._pos:end].tobytes()
+    self._pos = max(self._pos, end)
+    return data
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._pos
+    elif whence == os.SEEK_END:
+      offset += len(self._view)
+    self._pos = offset
+
+  def tell(self):
+    return self._pos
+
+
+class _FileReader(object):
+  """Seekable file-like object, which can report the size and MD5 hash of the
+  data between its initial position and its end."""
+
+  def __init__(self, fp):
+    self._fp = fp
+    self._start = fp.tell()
+    fp.seek(self._start)
+    self._md5 = None
+    self._size = None
+
+  def _scan(self):
+    """Reads through the file once to compute its size and MD5 hash."""
+    hasher = hashlib.md5()
+    self._fp.seek(self._start)
+    while True:
+      data = self._fp.read(_CHUNK_SIZE)
+      if not data:
+        break
+      hasher.update(data)
+    self._size = self._fp.tell() - self._start
+    self._md5 = hasher.hexdigest()
+    self._fp.seek(self._start)
+
+  def md5(self):
+    """Returns the MD5 hash of the data, as a hex string."""
+    if self._md5 is None:
+      self._scan()
+    return self._md5
+
+  def size(self):
+    """Returns the size of the data, in bytes."""
+    if self._size is None:
+      self._scan()
+    return self._size
+
+  def read(self, size=-1):
+    return self._fp.read(size)
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_SET:
+      offset += self._start
+    self._fp.seek(offset, whence)
+
+  def tell(self):
+    return self._fp.tell() - self._start
+
+
+class _StreamReader(object):
+  """File-like object that reads from an iterable of strings, computing the MD5
+  hash of the data as it goes.
+
+  Because it cannot seek, boto must send it using chunked transfer encoding.
+  """
+
+  def __init__(self, chunks):
+    self._chunks = chunks
+    # Chunks read from self._chunks but not yet returned, of which the first
+    # self._offset bytes of the first have been returned.
+    self._pending = collections.deque()
+    self._offset = 0
+    self._pending_len = 0
+    self._hasher = hashlib.md5()
+
+  def md5(self):
+    """Returns the MD5 hash of all data read so far, as a hex string."""
+    return self._hasher.hexdigest()
+
+  def read(self, size=-1):
+    while size < 0 or self._pending_len < size:
+      try:
+        chunk = next(self._chunks)
+      except StopIteration:
+        break
+      if chunk:
+        self._pending.append(chunk)
+        self._pending_len += len(chunk)
+    if size < 0 or size > self._pending_len:
+      size = self._pending_len
+    # Only slice the chunks we return data from, so that each byte is copied
+    # at most once (and whole chunks not at all).
+    pieces = []
+    remaining = size
+    while remaining:
+      chunk = self._pending[0]
+      end = min(len(chunk), self._offset + remaining)
+      if self._offset == 0 and end == len(chunk):
+        pieces.append(chunk)
+      else:
+        pieces.append(chunk[self._offset:end])
+      remaining -= end - self._offset
+      if end == len(chunk):
+        self._pending.popleft()
+        self._offset = 0
+      else:
+        self._offset = end
+    self._pending_len -= size
+    data = pieces[0] if len(pieces) == 1 else ''.join(pieces)
+    self._hasher.update(data)
+    return data
+
+  def tell(self):
+    # This is how boto recognizes a stream that it cannot rewind.
+    raise IOError('cannot tell() within a stream')
+
+
+class _BufferWriter(object):
+  """Write-only file-like object that fills in a writable buffer in place."""
+
+  def __init__(self, buf):
+    self._view = memoryview(buf)
+    self._pos = 0
+
+  def write(self, data):
+    end = self._pos + len(data)
+    if end > len(self._view):
+      raise Exception('download does not fit within a %d-byte buffer' %
+                      len(self._view))
+    self._view[self._pos:end] = data
+    self._pos = end
+
+  def tell(self):
+    return self._pos
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+"""
+Copyright 2014 Google Inc.
+
+Use of this source code is governed by a BSD-style license that can be
+found in the LICENSE file.
+
+Measures how long common GSUtils operations take with each StorageBackend.
+
+Usage:
+  python gs_utils_benchmark.py [--num-files N] [--file-size BYTES]
+
+Always measures LocalBackend (with and without link_files); also measures
+Google Storage and/or S3 if the environment variables described in
+gs_utils_test.py are set.  We write only within a randomly named directory in
+each bucket, and delete it afterwards.
+"""
+
+# System-level imports
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+# Imports from within Skia
+import gs_utils
+
+
+def _timed(description, func):
+  """Calls func(), and prints how long it took."""
+  t_0 = time.time()
+  func()
+  print('  %-24s %8.1f ms' % (description, (time.time() - t_0) * 1000))
+
+
+def _benchmark(name, gs, bucket, num_files, file_size):
+  """Times a series of GSUtils operations on num_files files of file_size
+  bytes each, within bucket."""
+  print('%s:' % name)
+  local_dir = tempfile.mkdtemp()
+  remote_dir = 'gs_utils_benchmark/%s' % uuid.uuid4().hex
+  try:
+    source_dir = os.path.join(local_dir, 'source')
+    os.makedirs(source_dir)
+    for i in range(num_files):
+      with open(os.path.join(source_dir, 'file%d' % i), 'wb') as f:
+        f.write(os.urandom(file_size))
+
+    _timed('upload_dir_contents', lambda: gs.upload_dir_contents(
+        source_dir=source_dir, dest_bucket=bucket,
+        dest_dir=remote_dir + '/a'))
+    _timed('upload (IF_MODIFIED)', lambda: gs.upload_dir_contents(
+        source_dir=source_dir, dest_bucket=bucket,
+        dest_dir=remote_dir + '/a', upload_if=gs.UploadIf.IF_MODIFIED))
+    _timed('list_bucket_contents', lambda: gs.list_bucket_contents(
+        bucket=bucket, subdir=remote_dir + '/a'))
+    _timed('download_dir_contents', lambda: gs.download_dir_contents(
+        source_bucket=bucket, source_dir=remote_dir + '/a',
+        dest_dir=os.path.join(local_dir, 'dest')))
+    _timed('copy_prefix', lambda: gs.copy_prefix(
+        src_bucket=bucket, src_prefix=remote_dir + '/a', dst_bucket=bucket,
+        dst_prefix=remote_dir + '/b'))
+    _timed('move_prefix', lambda: gs.move_prefix(
+        src_bucket=bucket, src_prefix=remote_dir + '/b', dst_bucket=bucket,
+        dst_prefix=remote_dir + '/c'))
+  finally:
+    shutil.rmtree(local_dir)
+    b = gs.backend.get_bucket(bucket)
+    for info in list(gs.backend.list(b=b, prefix=remote_dir)):
+      gs.backend.delete(b=b, path=info.name)
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--num-files', type='int', default=100,
+                    help='how many files to work with')
+  parser.add_option('--file-size', type='int', default=64*1024,
+                    help='size of each file, in bytes')
+  (options, _) = parser.parse_args()
+
+  root_dir = tempfile.mkdtemp()
+  try:
+    for link_files in (False, True):
+      backend = gs_utils.LocalBackend(root=root_dir, link_files=link_files)
+      backend.create_bucket('benchmark')
+      _benchmark(name='LocalBackend(link_files=%s)' % link_files,
+                 gs=gs_utils.GSUtils(backend=backend), bucket='benchmark',
+                 num_files=options.num_files, file_size=options.file_size)
+  finally:
+    shutil.rmtree(root_dir)
+
+  if os.environ.get('GS_UTILS_TEST_GS_BUCKET'):
+    _benchmark(name='GSBackend', gs=gs_utils.GSUtils(),
+               bucket=os.environ['GS_UTILS_TEST_GS_BUCKET'],
+               num_files=options.num_files, file_size=options.file_size)
+  if os.environ.get('GS_UTILS_TEST_S3_BUCKET'):
+    _benchmark(name='S3Backend',
+               gs=gs_utils.GSUtils(backend=gs_utils.S3Backend(
+                   host=os.environ.get('GS_UTILS_TEST_S3_HOST'))),
+               bucket=os.environ['GS_UTILS_TEST_S3_BUCKET'],
+               num_files=options.num_files, file_size=options.file_size)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -399,6 +399,103 @@ def _test_does_storage_object_exist():
     assert gs.does_storage_object_exist(TEST_BUCKET, obj) == expect, msg
 
 
+def _test_buffer_round_trip():
+  """Test upload_from_buffer() and download_to_buffer()."""
+  gs = _get_authenticated_gs_handle()
+  remote_dir = _get_unique_posix_dir()
+  contents = 'contents of an in-memory file\n'
+  sources = [
+      ('from_string', contents),
+      ('from_bytearray', bytearray(contents)),
+      ('from_generator', (line + '\n' for line in contents.splitlines())),
+  ]
+  try:
+    for (filename, source) in sources:
+      dest_path = posixpath.join(remote_dir, filename)
+      gs.upload_from_buffer(source=source, dest_bucket=TEST_BUCKET,
+                            dest_path=dest_path)
+      got_contents = gs.download_to_buffer(source_bucket=TEST_BUCKET,
+                                           source_path=dest_path)
+      assert got_contents == contents, '%s == %s' % (got_contents, contents)
+      buf = bytearray(len(contents))
+      num_bytes = gs.download_to_buffer(source_bucket=TEST_BUCKET,
+                                        source_path=dest_path, dest=buf)
+      assert num_bytes == len(contents), '%d == %d' % (
+          num_bytes, len(contents))
+      assert buf == contents, '%s == %s' % (buf, contents)
+
+    # Re-uploading the same contents with IF_MODIFIED should not change the
+    # timestamp, whether or not we were able to hash the source up front.
+    for (filename, source) in [
+        ('from_string', contents),
+        ('from_generator', iter([contents]))]:
+      dest_path = posixpath.join(remote_dir, filename)
+      old_timestamp = gs.get_last_modified_time(
+          bucket=TEST_BUCKET, path=dest_path)
+      time.sleep(2)
+      gs.upload_from_buffer(source=source, dest_bucket=TEST_BUCKET,
+                            dest_path=dest_path,
+                            upload_if=gs.UploadIf.IF_MODIFIED)
+      new_timestamp = gs.get_last_modified_time(
+          bucket=TEST_BUCKET, path=dest_path)
+      assert old_timestamp == new_timestamp, '%s == %s' % (
+          old_timestamp, new_timestamp)
+  finally:
+    for (filename, _) in sources:
+      gs.delete_file(bucket=TEST_BUCKET,
+                     path=posixpath.join(remote_dir, filename))
+
+
+def _test_copy_and_move_prefix():
+  """Test copy_prefix() and move_prefix()."""
+  gs = _get_authenticated_gs_handle()
+  src_dir = _get_unique_posix_dir()
+  copy_dir = _get_unique_posix_dir()
+  move_dir = _get_unique_posix_dir()
+  rel_paths = ['file1', posixpath.join('subdir', 'file2')]
+  try:
+    for rel_path in rel_paths:
+      gs.upload_from_buffer(source='contents of %s\n' % rel_path,
+                            dest_bucket=TEST_BUCKET,
+                            dest_path=posixpath.join(src_dir, rel_path))
+    gs.copy_prefix(src_bucket=TEST_BUCKET, src_prefix=src_dir,
+                   dst_bucket=TEST_BUCKET, dst_prefix=copy_dir)
+    for rel_path in rel_paths:
+      got_contents = gs.download_to_buffer(
+          source_bucket=TEST_BUCKET,
+          source_path=posixpath.join(copy_dir, rel_path))
+      assert got_contents == 'contents of %s\n' % rel_path, got_contents
+
+    # Copying again with IF_MODIFIED should skip every file.
+    sample_path = posixpath.join(copy_dir, rel_paths[0])
+    old_timestamp = gs.get_last_modified_time(
+        bucket=TEST_BUCKET, path=sample_path)
+    time.sleep(2)
+    gs.copy_prefix(src_bucket=TEST_BUCKET, src_prefix=src_dir,
+                   dst_bucket=TEST_BUCKET, dst_prefix=copy_dir,
+                   upload_if=gs.UploadIf.IF_MODIFIED)
+    new_timestamp = gs.get_last_modified_time(
+        bucket=TEST_BUCKET, path=sample_path)
+    assert old_timestamp == new_timestamp, '%s == %s' % (
+        old_timestamp, new_timestamp)
+
+    # Moving should leave nothing behind in src_dir.
+    gs.move_prefix(src_bucket=TEST_BUCKET, src_prefix=src_dir,
+                   dst_bucket=TEST_BUCKET, dst_prefix=move_dir)
+    (dirs, files) = gs.list_bucket_contents(bucket=TEST_BUCKET, subdir=src_dir)
+    assert dirs == [], '%s == []' % dirs
+    assert files == [], '%s == []' % files
+    for rel_path in rel_paths:
+      assert gs.does_storage_object_exist(
+          TEST_BUCKET, posixpath.join(move_dir, rel_path)), rel_path
+  finally:
+    for remote_dir in (copy_dir, move_dir):
+      for rel_path in rel_paths:
+        path = posixpath.join(remote_dir, rel_path)
+        if gs.does_storage_object_exist(TEST_BUCKET, path):
+          gs.delete_file(bucket=TEST_BUCKET, path=path)
+
+
 if __name__ == '__main__':
   _test_static_methods()
   _test_upload_if_multiple_files()
@@ -407,5 +504,7 @@ if __name__ == '__main__':
   _test_authenticated_round_trip()
   _test_dir_upload_and_download()
   _test_does_storage_object_exist()
+  _test_buffer_round_trip()
+  _test_copy_and_move_prefix()
   # TODO(epoger): Add _test_unauthenticated_access() to make sure we raise
   # an exception when we try to access without needed credentials.
@@ -0,0 +1,472 @@
+#!/usr/bin/python
+
+"""
+Copyright 2014 Google Inc.
+
+Use of this source code is governed by a BSD-style license that can be
+found in the LICENSE file.
+
+Test gs_utils.py.
+
+Most of these tests do not touch the network; see gs_utils_manualtest.py for
+tests that exercise a real Google Storage bucket.
+
+BackendConformanceTest runs the same GSUtils tests against each
+StorageBackend.  It always runs against LocalBackend; to also run it against
+Google Storage and/or S3, set these environment variables:
+
+  GS_UTILS_TEST_GS_BUCKET: writable Google Storage bucket (we use the
+      credentials in ~/.boto)
+  GS_UTILS_TEST_S3_BUCKET: writable S3 bucket (we let boto find credentials)
+  GS_UTILS_TEST_S3_HOST: hostname of an S3-compatible service to use instead
+      of Amazon S3
+
+The tests write only within a randomly named directory in each bucket.
+"""
+
+# System-level imports
+import cStringIO
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+# Imports from within Skia
+import gs_utils
+
+
+class GsUtilsTest(unittest.TestCase):
+
+  def test_import_does_not_import_boto(self):
+    """Importing gs_utils should not import boto until it is needed."""
+    script = ('import sys; import gs_utils; '
+              'gs_utils.GSUtils.split_gs_url("gs://bucket/path"); '
+              'sys.exit(1 if [m for m in sys.modules '
+              'if m.startswith("boto")] else 0)')
+    self.assertEquals(
+        subprocess.call([sys.executable, '-c', script],
+                        cwd=os.path.dirname(os.path.abspath(__file__))),
+        0, 'importing gs_utils should not import boto')
+
+  def test_cached_config_file_as_dict(self):
+    """Tests _cached_config_file_as_dict()."""
+    tempdir_path = tempfile.mkdtemp()
+    try:
+      boto_path = os.path.join(tempdir_path, '.boto')
+      with open(boto_path, 'w') as f:
+        f.write('[Credentials]\n'
+                'gs_access_key_id = my_key_id\n'
+                'gs_secret_access_key = my_secret\n')
+      self.assertEquals(
+          gs_utils._cached_config_file_as_dict(filepath=boto_path),
+          {'gs_access_key_id': 'my_key_id',
+           'gs_secret_access_key': 'my_secret'})
+      # The file is only parsed once; later calls return the cached contents.
+      os.remove(boto_path)
+      self.assertEquals(
+          gs_utils._cached_config_file_as_dict(
+              filepath=boto_path)['gs_access_key_id'],
+          'my_key_id')
+    finally:
+      shutil.rmtree(tempdir_path)
+
+  def test_make_reader(self):
+    """Tests _make_reader() with each kind of source upload_from_buffer()
+    accepts."""
+    contents = 'these are the contents'
+    expected_md5 = hashlib.md5(contents).hexdigest()
+    for source in (contents, bytearray(contents), memoryview(contents),
+                   cStringIO.StringIO(contents)):
+      reader = gs_utils._make_reader(source)
+      self.assertEquals(reader.md5(), expected_md5)
+      self.assertEquals(reader.size(), len(contents))
+      self.assertEquals(reader.read(5), contents[:5])
+      self.assertEquals(reader.read(), contents[5:])
+      reader.seek(0)
+      self.assertEquals(reader.read(), contents)
+
+    # Iterables are streamed, and hashed as they are read.
+    reader = gs_utils._make_reader(iter(['these ', 'are ', 'the contents']))
+    self.assertTrue(isinstance(reader, gs_utils._StreamReader))
+    self.assertEquals(reader.read(3), contents[:3])
+    self.assertEquals(reader.read(), contents[3:])
+    self.assertEquals(reader.read(), '')
+    self.assertEquals(reader.md5(), expected_md5)
+
+    # Reads may span, or stop within, chunks.
+    reader = gs_utils._make_reader(iter(['these ', 'are ', 'the contents']))
+    self.assertEquals([reader.read(4) for _ in range(6)],
+                      ['thes', 'e ar', 'e th', 'e co', 'nten', 'ts'])
+    self.assertEquals(reader.md5(), expected_md5)
+
+  def test_buffer_writer(self):
+    """Tests _BufferWriter()."""
+    buf = bytearray(8)
+    writer = gs_utils._BufferWriter(buf)
+    writer.write('abc')
+    writer.write('de')
+    self.assertEquals(writer.tell(), 5)
+    self.assertEquals(buf[:5], 'abcde')
+    with self.assertRaises(Exception):
+      writer.write('fghi')
+
+  def test_run_in_parallel(self):
+    """Tests _run_in_parallel()."""
+    processed = []
+    def func(item):
+      if item % 2:
+        raise ValueError('odd item %d' % item)
+      processed.append(item)
+    err = gs_utils._run_in_parallel(
+        func=func, items=range(10), num_threads=3,
+        progress_format='%d/%d: %s', retry_description='test', retries=1)
+    self.assertEquals(sorted(processed), [0, 2, 4, 6, 8])
+    self.assertEquals(sorted(err.keys()), [1, 3, 5, 7, 9])
+    self.assertTrue(isinstance(err[1], ValueError))
+
+  def test_thread_pool(self):
+    """Tests that _run_in_parallel() reuses a _ThreadPool's threads (and so
+    their thread-local state) from one call to the next."""
+    pool = gs_utils._ThreadPool()
+    local = threading.local()
+    created = []
+    def func(_):
+      if not getattr(local, 'connection', None):
+        local.connection = object()
+        created.append(local.connection)
+      time.sleep(0.01)
+    for _ in range(3):
+      self.assertEquals(gs_utils._run_in_parallel(
+          func=func, items=range(8), num_threads=4, progress_format='%d/%d: %s',
+          retry_description='test', pool=pool), {})
+    self.assertTrue(len(created) <= 4, created)
+
+  def test_interleave(self):
+    """Tests _interleave()."""
+    items = [('big', 1), ('big', 2), ('big', 3), ('small', 1), ('other', 1),
+             ('small', 2)]
+    self.assertEquals(
+        gs_utils._interleave(items=items, key=lambda item: item[0]),
+        [('big', 1), ('small', 1), ('other', 1), ('big', 2), ('small', 2),
+         ('big', 3)])
+    self.assertEquals(gs_utils._interleave(items=[], key=None), [])
+
+  def test_multi_bucket_routing(self):
+    """Tests MultiBucketGSUtils.for_bucket()."""
+    skia_shard = object()
+    exact_shard = object()
+    default_shard = object()
+    gs = gs_utils.MultiBucketGSUtils(
+        routes=[('chromium-skia-gm', exact_shard),
+                ('chromium-skia-*', skia_shard)],
+        default=default_shard)
+    self.assertIs(gs.for_bucket('chromium-skia-gm'), exact_shard)
+    self.assertIs(gs.for_bucket('chromium-skia-testing'), skia_shard)
+    self.assertIs(gs.for_bucket('some-other-bucket'), default_shard)
+
+    gs = gs_utils.MultiBucketGSUtils(routes=[('chromium-skia-*', skia_shard)])
+    with self.assertRaises(Exception):
+      gs.for_bucket('some-other-bucket')
+
+
+class BackendConformanceTest(object):
+  """Tests that GSUtils behaves the same way, whichever StorageBackend it uses.
+
+  Subclasses must also inherit from unittest.TestCase, and set self.gs (a
+  GSUtils object) and self.bucket in setUp().
+  """
+
+  # Fine-grained ACL entry we can set (and check) on a file.
+  ACL_ID = (gs_utils.GSUtils.IdType.GROUP_BY_DOMAIN, 'chromium.org')
+
+  def setUp(self):
+    self.local_dir = tempfile.mkdtemp()
+    self.remote_dir = 'gs_utils_test/%s' % uuid.uuid4().hex
+
+  def tearDown(self):
+    shutil.rmtree(self.local_dir)
+    b = self.gs.backend.get_bucket(self.bucket)
+    for info in list(self.gs.backend.list(b=b, prefix=self.remote_dir)):
+      self.gs.backend.delete(b=b, path=info.name)
+
+  def _remote_path(self, rel_path):
+    return '%s/%s' % (self.remote_dir, rel_path)
+
+  def _write_local_file(self, rel_path, contents):
+    path = os.path.join(self.local_dir, *rel_path.split('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+      f.write(contents)
+    return path
+
+  def test_file_round_trip(self):
+    """Tests upload_file(), download_file() and delete_file()."""
+    source_path = self._write_local_file('source', 'file contents')
+    dest_path = os.path.join(self.local_dir, 'subdir', 'dest')
+    remote_path = self._remote_path('file')
+    self.gs.upload_file(source_path=source_path, dest_bucket=self.bucket,
+                        dest_path=remote_path)
+    self.assertTrue(self.gs.get_last_modified_time(
+        bucket=self.bucket, path=remote_path))
+    self.gs.download_file(source_bucket=self.bucket, source_path=remote_path,
+                          dest_path=dest_path, create_subdirs_if_needed=True)
+    with open(dest_path, 'rb') as f:
+      self.assertEquals(f.read(), 'file contents')
+
+    self.gs.delete_file(bucket=self.bucket, path=remote_path)
+    self.assertEquals(self.gs.get_last_modified_time(
+        bucket=self.bucket, path=remote_path), None)
+    self.assertFalse(self.gs.does_storage_object_exist(
+        bucket=self.bucket, object_name=remote_path))
+
+  def test_buffer_round_trip(self):
+    """Tests upload_from_buffer() and download_to_buffer()."""
+    remote_path = self._remote_path('buffer')
+    for source in ('buffer contents', iter(['buffer ', 'contents'])):
+      self.gs.upload_from_buffer(source=source, dest_bucket=self.bucket,
+                                 dest_path=remote_path)
+      self.assertEquals(
+          self.gs.download_to_buffer(source_bucket=self.bucket,
+                                     source_path=remote_path),
+          'buffer contents')
+    buf = bytearray(20)
+    self.assertEquals(
+        self.gs.download_to_buffer(source_bucket=self.bucket,
+                                   source_path=remote_path, dest=buf),
+        len('buffer contents'))
+    self.assertEquals(buf[:len('buffer contents')], 'buffer contents')
+
+  def test_upload_if(self):
+    """Tests each UploadIf value."""
+    remote_path = self._remote_path('upload_if')
+    self.gs.upload_from_buffer(source='old contents', dest_bucket=self.bucket,
+                               dest_path=remote_path)
+    self.gs.upload_from_buffer(source='new contents', dest_bucket=self.bucket,
+                               dest_path=remote_path,
+                               upload_if=self.gs.UploadIf.IF_NEW)
+    self.assertEquals(self.gs.download_to_buffer(
+        source_bucket=self.bucket, source_path=remote_path), 'old contents')
+    self.gs.upload_from_buffer(source='new contents', dest_bucket=self.bucket,
+                               dest_path=remote_path,
+                               upload_if=self.gs.UploadIf.IF_MODIFIED)
+    self.assertEquals(self.gs.download_to_buffer(
+        source_bucket=self.bucket, source_path=remote_path), 'new contents')
+    # No temporary files should be left behind.
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self.remote_dir),
+        ([], ['upload_if']))
+
+  def test_dir_round_trip(self):
+    """Tests upload_dir_contents(), list_bucket_contents() and
+    download_dir_contents()."""
+    source_dir = os.path.join(self.local_dir, 'source')
+    self._write_local_file('source/a', 'contents of a')
+    self._write_local_file('source/sub/b', 'contents of b')
+    self._write_local_file('source/sub/c', 'contents of c')
+    self.gs.upload_dir_contents(source_dir=source_dir,
+                                dest_bucket=self.bucket,
+                                dest_dir=self.remote_dir,
+                                upload_if=self.gs.UploadIf.IF_MODIFIED)
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self.remote_dir),
+        (['sub'], ['a']))
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self._remote_path('sub')),
+        ([], ['b', 'c']))
+    self.assertTrue(self.gs.does_storage_object_exist(
+        bucket=self.bucket, object_name=self._remote_path('sub')))
+
+    dest_dir = os.path.join(self.local_dir, 'dest')
+    self.gs.download_dir_contents(source_bucket=self.bucket,
+                                  source_dir=self.remote_dir,
+                                  dest_dir=dest_dir)
+    with open(os.path.join(dest_dir, 'sub', 'c'), 'rb') as f:
+      self.assertEquals(f.read(), 'contents of c')
+
+  def test_upload_rel_paths(self):
+    """Tests upload_dir_contents() with rel_paths."""
+    source_dir = os.path.join(self.local_dir, 'source')
+    self._write_local_file('source/a', 'contents of a')
+    self._write_local_file('source/sub/b', 'contents of b')
+    self.gs.upload_dir_contents(source_dir=source_dir,
+                                dest_bucket=self.bucket,
+                                dest_dir=self.remote_dir,
+                                rel_paths=['sub/b'])
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self.remote_dir),
+        (['sub'], []))
+
+  def test_copy_and_move_prefix(self):
+    """Tests copy_prefix() and move_prefix()."""
+    for rel_path in ('src/a', 'src/sub/b'):
+      self.gs.upload_from_buffer(source='contents of %s' % rel_path,
+                                 dest_bucket=self.bucket,
+                                 dest_path=self._remote_path(rel_path))
+    self.gs.copy_prefix(src_bucket=self.bucket,
+                        src_prefix=self._remote_path('src'),
+                        dst_bucket=self.bucket,
+                        dst_prefix=self._remote_path('copy'))
+    self.gs.move_prefix(src_bucket=self.bucket,
+                        src_prefix=self._remote_path('src'),
+                        dst_bucket=self.bucket,
+                        dst_prefix=self._remote_path('move'),
+                        upload_if=self.gs.UploadIf.IF_MODIFIED)
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self.remote_dir),
+        (['copy', 'move'], []))
+    for rel_path in ('copy/sub/b', 'move/sub/b'):
+      self.assertEquals(
+          self.gs.download_to_buffer(source_bucket=self.bucket,
+                                     source_path=self._remote_path(rel_path)),
+          'contents of src/sub/b')
+
+    # Moving a directory onto itself, or into or out of itself, would delete
+    # the files it copied.
+    for (src, dst) in (('copy', 'copy/'), ('copy', 'copy/sub'),
+                       ('copy/sub', 'copy')):
+      with self.assertRaises(Exception):
+        self.gs.move_prefix(src_bucket=self.bucket,
+                            src_prefix=self._remote_path(src),
+                            dst_bucket=self.bucket,
+                            dst_prefix=self._remote_path(dst))
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self._remote_path('copy/sub')),
+        ([], ['b']))
+
+  def test_move_prefix_if_new(self):
+    """Tests that move_prefix() with IF_NEW only deletes source files which
+    exist with the same contents at the destination."""
+    for (rel_path, contents) in (('src/same', 'same'), ('src/diff', 'old'),
+                                 ('src/new', 'new'), ('dst/same', 'same'),
+                                 ('dst/diff', 'different')):
+      self.gs.upload_from_buffer(source=contents, dest_bucket=self.bucket,
+                                 dest_path=self._remote_path(rel_path))
+    self.gs.move_prefix(src_bucket=self.bucket,
+                        src_prefix=self._remote_path('src'),
+                        dst_bucket=self.bucket,
+                        dst_prefix=self._remote_path('dst'),
+                        upload_if=self.gs.UploadIf.IF_NEW)
+    self.assertEquals(
+        self.gs.list_bucket_contents(bucket=self.bucket,
+                                     subdir=self._remote_path('src')),
+        ([], ['diff']))
+    self.assertEquals(
+        self.gs.download_to_buffer(source_bucket=self.bucket,
+                                   source_path=self._remote_path('dst/diff')),
+        'different')
+
+  def test_list_delimiter(self):
+    """Tests StorageBackend.list() with single- and multi-character
+    delimiters."""
+    for rel_path in ('plain', 'x--y/z', 'x--w', 'sub/file'):
+      self.gs.upload_from_buffer(source='contents', dest_bucket=self.bucket,
+                                 dest_path=self._remote_path(rel_path))
+    b = self.gs.backend.get_bucket(self.bucket)
+
+    def list_names(delimiter):
+      return [getattr(item, 'name', item) for item in self.gs.backend.list(
+          b=b, prefix=self._remote_path(''), delimiter=delimiter)]
+
+    self.assertEquals(list_names('/'), [
+        self._remote_path(p) for p in ('plain', 'sub/', 'x--w', 'x--y/')])
+    self.assertEquals(list_names('--'), [
+        self._remote_path(p) for p in ('plain', 'sub/file', 'x--')])
+
+  def test_acl(self):
+    """Tests set_acl() and get_acl()."""
+    if not self.ACL_ID:
+      self.skipTest('no ACL_ID to test with')
+    (id_type, id_value) = self.ACL_ID
+    remote_path = self._remote_path('acl')
+    self.gs.upload_from_buffer(source='contents', dest_bucket=self.bucket,
+                               dest_path=remote_path)
+    for permission in (self.gs.Permission.READ, self.gs.Permission.WRITE,
+                       self.gs.Permission.EMPTY):
+      self.gs.set_acl(bucket=self.bucket, path=remote_path, id_type=id_type,
+                      id_value=id_value, permission=permission)
+      self.assertEquals(
+          self.gs.get_acl(bucket=self.bucket, path=remote_path,
+                          id_type=id_type, id_value=id_value),
+          permission)
+
+
+class LocalBackendTest(BackendConformanceTest, unittest.TestCase):
+
+  def setUp(self):
+    BackendConformanceTest.setUp(self)
+    self.root_dir = tempfile.mkdtemp()
+    self.bucket = 'test-bucket'
+    backend = gs_utils.LocalBackend(root=self.root_dir)
+    backend.create_bucket(self.bucket)
+    self.gs = gs_utils.GSUtils(backend=backend)
+
+  def tearDown(self):
+    BackendConformanceTest.tearDown(self)
+    shutil.rmtree(self.root_dir)
+
+  def test_link_files(self):
+    """Tests that LocalBackend(link_files=True) links rather than copies."""
+    gs = gs_utils.GSUtils(backend=gs_utils.LocalBackend(root=self.root_dir,
+                                                        link_files=True))
+    source_path = self._write_local_file('source', 'contents')
+    dest_path = os.path.join(self.local_dir, 'dest')
+    remote_path = self._remote_path('file')
+    gs.upload_file(source_path=source_path, dest_bucket=self.bucket,
+                   dest_path=remote_path)
+    gs.download_file(source_bucket=self.bucket, source_path=remote_path,
+                     dest_path=dest_path)
+    self.assertTrue(os.path.samefile(source_path, dest_path))
+
+  def test_paths_stay_within_root(self):
+    """Tests that LocalBackend refuses paths it cannot store verbatim, rather
+    than normalizing them (or letting them lead outside a bucket)."""
+    for path in ('../other/file', 'sub/../../file', '../.acls/file',
+                 'sub/../file', './file', 'sub//file', '/file'):
+      with self.assertRaises(Exception):
+        self.gs.upload_from_buffer(source='contents', dest_bucket=self.bucket,
+                                   dest_path=path)
+    for bucket in ('..', '.acls', 'a/b'):
+      with self.assertRaises(Exception):
+        self.gs.list_bucket_contents(bucket=bucket)
+
+
+@unittest.skipUnless(os.environ.get('GS_UTILS_TEST_GS_BUCKET'),
+                     'GS_UTILS_TEST_GS_BUCKET is not set')
+class GSBackendTest(BackendConformanceTest, unittest.TestCase):
+
+  def setUp(self):
+    BackendConformanceTest.setUp(self)
+    self.bucket = os.environ['GS_UTILS_TEST_GS_BUCKET']
+    self.gs = gs_utils.GSUtils()
+
+
+@unittest.skipUnless(os.environ.get('GS_UTILS_TEST_S3_BUCKET'),
+                     'GS_UTILS_TEST_S3_BUCKET is not set')
+class S3BackendTest(BackendConformanceTest, unittest.TestCase):
+
+  # S3 cannot grant permissions to groups, and we don't know the ID of any
+  # particular S3 user.
+  ACL_ID = None
+
+  def setUp(self):
+    BackendConformanceTest.setUp(self)
+    self.bucket = os.environ['GS_UTILS_TEST_S3_BUCKET']
+    self.gs = gs_utils.GSUtils(backend=gs_utils.S3Backend(
+        host=os.environ.get('GS_UTILS_TEST_S3_HOST')))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+"""
+Copyright 2014 Google Inc.
+
+Use of this source code is governed by a BSD-style license that can be
+found in the LICENSE file.
+
+Measures how long it takes to import some of our modules, so that we notice if
+a change makes them (and every short-lived script that uses them) slower to
+start up.
+
+Usage:
+  python import_benchmark.py [module ...]
+
+Each module is imported in a fresh interpreter.  We also report the slowest
+imports it makes (directly or indirectly), timed by wrapping __import__.
+"""
+
+# System-level imports
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = ['gs_utils', 'git_utils']
+NUM_RUNS = 10
+NUM_SLOWEST_IMPORTS = 5
+
+# Modules that must not be imported as a side effect of importing the module
+# being measured.
+FORBIDDEN_PREFIXES = ['boto']
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _time_import(module_name):
+  """Returns the fastest of several wall-clock times for importing module_name
+  in a fresh interpreter, minus the time taken to start an empty interpreter.
+  """
+  def fastest_run(script):
+    best = None
+    for _ in range(NUM_RUNS):
+      t_0 = time.time()
+      subprocess.check_call([sys.executable, '-c', script], cwd=SCRIPT_DIR)
+      elapsed = time.time() - t_0
+      if best is None or elapsed < best:
+        best = elapsed
+    return best
+  return fastest_run('import %s' % module_name) - fastest_run('pass')
+
+
+def _forbidden_imports(module_name):
+  """Returns the names of any forbidden modules pulled in by module_name."""
+  script = ('import sys; import %s; '
+            'print("\\n".join(sorted(sys.modules)))' % module_name)
+  output = subprocess.check_output([sys.executable, '-c', script],
+                                   cwd=SCRIPT_DIR, universal_newlines=True)
+  return [m for m in output.split() if
+          [p for p in FORBIDDEN_PREFIXES if m == p or m.startswith(p + '.')]]
+
+
+# Run in a fresh interpreter: wraps __import__ to time (cumulatively) each
+# module the first time it is imported, then imports the module being measured
+# and prints the slowest imports.
+_SLOWEST_IMPORTS_SCRIPT = """
+import __builtin__, sys, time
+times = {}
+real_import = __builtin__.__import__
+def timed_import(name, *args, **kwargs):
+  if name in sys.modules:
+    return real_import(name, *args, **kwargs)
+  t_0 = time.time()
+  try:
+    return real_import(name, *args, **kwargs)
+  finally:
+    times.setdefault(name, time.time() - t_0)
+__builtin__.__import__ = timed_import
+import %s
+for (name, secs) in sorted(times.items(), key=lambda i: -i[1])[1:%d]:
+  print('%%8.1f ms  %%s' %% (secs * 1000, name))
+"""
+
+
+def _slowest_imports(module_name):
+  """Returns lines describing the slowest imports made (directly or
+  indirectly) while importing module_name, with their cumulative times."""
+  output = subprocess.check_output(
+      [sys.executable, '-c',
+       _SLOWEST_IMPORTS_SCRIPT % (module_name, NUM_SLOWEST_IMPORTS + 1)],
+      cwd=SCRIPT_DIR, universal_newlines=True)
+  return output.splitlines()
+
+
+def main(module_names):
+  failed = False
+  for module_name in module_names:
+    print('%s: %.1f ms' % (module_name, _time_import(module_name) * 1000))
+    for line in _slowest_imports(module_name):
+      print('  %s' % line)
+    forbidden = _forbidden_imports(module_name)
+    if forbidden:
+      print('  ERROR: importing %s also imports %s' % (
+          module_name, ', '.join(forbidden)))
+      failed = True
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:] or DEFAULT_MODULES))
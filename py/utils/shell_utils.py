@@ -5,12 +5,17 @@
 
 """ This module contains tools for running commands in a shell. """
 
-import datetime
+import binascii
+import collections
+import errno
 import os
 import Queue
+import re
 import select
+import signal
 import subprocess
 import sys
+import tempfile
 import threading
 import time
 
@@ -20,26 +25,68 @@ if 'nt' in os.name:
 
 DEFAULT_SECS_BETWEEN_ATTEMPTS = 10
 POLL_MILLIS = 250
+# How long, and how much, output may be held back before it is logged.
+LOG_FLUSH_SECS = 0.1
+LOG_FLUSH_BYTES = 64 * 1024
+# Longest line we will hold back waiting for its newline; output which goes on
+# longer than this without one is logged in pieces of (at least) this size.
+MAX_LOG_LINE_BYTES = 64 * 1024
+# How long a command we are stopping has to exit after SIGTERM, before SIGKILL.
+# A command which ignores SIGTERM may therefore time out up to this much later
+# than its timeout.
+KILL_GRACE_SECS = 5
 VERBOSE = True
+# Whether commands which echo their output also print their ResourceUsage
+# once they finish.
+PRINT_USAGE = False
+
+_SIGKILL = getattr(signal, 'SIGKILL', signal.SIGTERM)
+# getrusage() reports ru_maxrss in bytes on Mac, and in kilobytes elsewhere.
+_MAX_RSS_UNITS_PER_KB = 1024 if sys.platform == 'darwin' else 1
+
+# What running a command cost: elapsed time, CPU time in user and system mode
+# (in seconds), and the peak resident set size of the command or of any of its
+# child processes (in kilobytes).  Only wall_secs is known on Windows; the
+# others are None there.
+ResourceUsage = collections.namedtuple(
+    'ResourceUsage', ['wall_secs', 'user_secs', 'sys_secs', 'max_rss_kb'])
 
 
 class CommandFailedException(Exception):
   """Exception which gets raised when a command fails."""
 
-  def __init__(self, output, *args):
+  def __init__(self, output, *args, **kwargs):
     """Initialize the CommandFailedException.
 
     Args:
         output: string; output from the command.
+        log_path: optional keyword argument; path of a file containing the
+            full output from the command, if output is only the end of it.
+        usage: optional keyword argument; ResourceUsage of the command.
     """
     Exception.__init__(self, *args)
     self._output = output
+    self._log_path = kwargs.pop('log_path', None)
+    self._usage = kwargs.pop('usage', None)
+    if kwargs:
+      raise TypeError('unexpected keyword arguments: %s' % kwargs.keys())
 
   @property
   def output(self):
     """Output from the command."""
     return self._output
 
+  @property
+  def log_path(self):
+    """Path of a file containing the full output from the command, or None if
+    output contains all of it."""
+    return self._log_path
+
+  @property
+  def usage(self):
+    """ResourceUsage of the command, or None if unknown."""
+    return self._usage
+
 
 class TimeoutException(CommandFailedException):
   """CommandFailedException which gets raised when a subprocess exceeds its
@@ -47,9 +94,60 @@ class TimeoutException(CommandFailedException):
   pass
 
 
-def run_async(cmd, echo=None, shell=False):
+class CommandsFailedException(CommandFailedException):
+  """CommandFailedException which gets raised when one or more of the commands
+  passed to run_many() fail."""
+
+  def __init__(self, failures, *args):
+    """Initialize the CommandsFailedException.
+
+    Args:
+        failures: list of CommandResult objects for the commands which failed.
+    """
+    CommandFailedException.__init__(
+        self,
+        ''.join(['%s%s' % (f.prefix, line)
+                 for f in failures for line in f.output.splitlines(True)]),
+        *args)
+    self._failures = failures
+
+  @property
+  def failures(self):
+    """CommandResults for the commands which failed."""
+    return self._failures
+
+
+class CommandResult(object):
+  """The outcome of one of the commands passed to run_many()."""
+
+  def __init__(self, index, cmd, prefix):
+    self.index = index
+    self.cmd = cmd
+    self.prefix = prefix
+    self.returncode = None
+    self.output = ''
+    # CommandFailedException if the command failed (or timed out), else None.
+    self.exception = None
+    # ResourceUsage of the command, once it has exited.
+    self.usage = None
+
+
+def run_async(cmd, echo=None, shell=False, new_process_group=False, stdin=None,
+              discard_stderr=False):
   """ Run 'cmd' in a subprocess, returning a Popen class instance referring to
-  that process.  (Non-blocking) """
+  that process.  (Non-blocking)
+
+  Once the process has exited and been reaped by _reap(), its usage attribute
+  holds its ResourceUsage.
+
+  new_process_group: boolean indicating whether to start the subprocess in a
+      new process group, so that it and any processes it starts can be killed
+      together with _kill_process_group().  It keeps our controlling terminal,
+      but is not in its foreground process group, so it cannot prompt there
+      (e.g. for a password).
+  stdin: optional, passed on to Popen (e.g. subprocess.PIPE)
+  discard_stderr: boolean indicating whether to discard stderr, rather than
+      merging it into stdout """
   if echo is None:
     echo = VERBOSE
   if echo:
@@ -63,11 +161,693 @@ def run_async(cmd, echo=None, shell=False):
     SEM_NOGPFAULTERRORBOX = 0x0002
     ctypes.windll.kernel32.SetErrorMode(SEM_NOGPFAULTERRORBOX)
     flags = 0x8000000 # CREATE_NO_WINDOW
+    if new_process_group:
+      flags |= subprocess.CREATE_NEW_PROCESS_GROUP
+    preexec_fn = None
   else:
     flags = 0
-  return subprocess.Popen(cmd, shell=shell, stderr=subprocess.STDOUT,
-                          stdout=subprocess.PIPE, creationflags=flags,
-                          bufsize=1)
+    # Not os.setsid(), which would detach the subprocess from our terminal
+    # altogether.
+    preexec_fn = os.setpgrp if new_process_group else None
+  stderr = open(os.devnull, 'wb') if discard_stderr else subprocess.STDOUT
+  start_time = time.time()
+  try:
+    proc = subprocess.Popen(cmd, shell=shell, stderr=stderr,
+                            stdout=subprocess.PIPE, stdin=stdin,
+                            creationflags=flags, bufsize=1,
+                            preexec_fn=preexec_fn)
+  finally:
+    if discard_stderr:
+      stderr.close()
+  proc._start_time = start_time
+  proc._own_process_group = new_process_group
+  proc.usage = None
+  return proc
+
+
+def _reap(proc, block=True):
+  """ Return the exit code of proc, waiting for it to exit if block is True, or
+  return None if it is still running.
+
+  This is the only place which may reap a process started by run_async():
+  never call its wait() or poll().  On Posix we reap it with wait4(), which
+  tells us what it cost as well as its exit status, and set its returncode
+  and usage attributes (which Popen then leaves alone). """
+  if proc.returncode is not None:
+    return proc.returncode
+  if not hasattr(os, 'wait4'):
+    returncode = proc.wait() if block else proc.poll()
+    if returncode is not None:
+      proc.usage = ResourceUsage(wall_secs=_wall_secs(proc), user_secs=None,
+                                 sys_secs=None, max_rss_kb=None)
+    return returncode
+  while True:
+    try:
+      (pid, status, rusage) = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+      break
+    except OSError as e:
+      if e.errno != errno.EINTR:
+        raise
+  if pid != proc.pid:
+    return None
+  if os.WIFSIGNALED(status):
+    proc.returncode = -os.WTERMSIG(status)
+  else:
+    proc.returncode = os.WEXITSTATUS(status)
+  proc.usage = ResourceUsage(
+      wall_secs=_wall_secs(proc), user_secs=rusage.ru_utime,
+      sys_secs=rusage.ru_stime,
+      max_rss_kb=rusage.ru_maxrss / _MAX_RSS_UNITS_PER_KB)
+  return proc.returncode
+
+
+def _wall_secs(proc):
+  """ Return how long proc has been running, if it was started by
+  run_async(). """
+  start_time = getattr(proc, '_start_time', None)
+  return time.time() - start_time if start_time else None
+
+
+def _format_usage(usage):
+  """ Return a one-line description of a ResourceUsage. """
+  if usage.user_secs is None:
+    return 'Took %.2fs' % usage.wall_secs
+  return 'Took %.2fs (%.2fs user, %.2fs sys CPU; max RSS %.1f MB)' % (
+      usage.wall_secs, usage.user_secs, usage.sys_secs,
+      usage.max_rss_kb / 1024.0)
+
+
+def _kill_process_group(proc, sig=signal.SIGTERM):
+  """ Send signal sig to proc, and to every process in its process group if it
+  was started with new_process_group=True.  On Windows, just terminate proc. """
+  if 'nt' in os.name:
+    if _reap(proc, block=False) is None:
+      proc.terminate()
+    return
+  try:
+    if getattr(proc, '_own_process_group', False):
+      os.killpg(proc.pid, sig)
+    elif proc.returncode is None:
+      os.kill(proc.pid, sig)
+  except OSError as e:
+    # The process (group) no longer exists, or whatever is left of it is no
+    # longer ours to kill.
+    if e.errno not in (errno.ESRCH, errno.EPERM):
+      raise
+
+
+def _process_group_alive(proc):
+  """ Return True if proc, or any other process in its process group (if it
+  was started with new_process_group=True), is still running.  Reaps proc if
+  it has exited. """
+  if _reap(proc, block=False) is None:
+    return True
+  if 'nt' in os.name or not getattr(proc, '_own_process_group', False):
+    return False
+  try:
+    os.killpg(proc.pid, 0)
+  except OSError as e:
+    if e.errno == errno.ESRCH:
+      return False
+    if e.errno != errno.EPERM:
+      raise
+  return True
+
+
+def _terminate(proc):
+  """ Stop proc, and every process in its process group if it was started with
+  new_process_group=True: send them SIGTERM, and then SIGKILL any which are
+  still running after KILL_GRACE_SECS.  Return the exit code of proc. """
+  deadline = time.time() + KILL_GRACE_SECS
+  _kill_process_group(proc)
+  while _process_group_alive(proc):
+    if time.time() >= deadline:
+      _kill_process_group(proc, sig=_SIGKILL)
+      break
+    time.sleep(0.01)
+  return _reap(proc)
+
+
+class _OutputMultiplexer(object):
+  """ Reads from any number of pipes at once, waking up as soon as any of them
+  has output (or is closed), without polling on a fixed interval.
+
+  On platforms with select.poll(), this uses no extra threads.  Elsewhere
+  (i.e. Windows, where select() only works on sockets), each pipe gets a
+  helper thread which blocks on reading it. """
+
+  # How many bytes to read from a pipe at once.
+  READ_SIZE = 64 * 1024
+
+  def __init__(self):
+    self._keys_by_fd = {}
+    if hasattr(select, 'poll'):
+      self._poll = select.poll()
+      self._queue = None
+    else:
+      self._poll = None
+      self._queue = Queue.Queue()
+
+  def __len__(self):
+    """ Return the number of pipes which have not been closed yet. """
+    return len(self._keys_by_fd)
+
+  def register(self, key, file_obj):
+    """ Start reading from file_obj.  Data read from it will be returned by
+    read() along with key. """
+    fd = file_obj.fileno()
+    self._keys_by_fd[fd] = key
+    if self._poll:
+      self._poll.register(fd, select.POLLIN | select.POLLPRI)
+    else:
+      thread = threading.Thread(target=self._read_in_thread, args=(fd,))
+      thread.daemon = True
+      thread.start()
+
+  def _read_in_thread(self, fd):
+    while True:
+      try:
+        data = os.read(fd, self.READ_SIZE)
+      except OSError:
+        data = ''
+      self._queue.put((fd, data))
+      if not data:
+        return
+
+  def read(self, timeout=None):
+    """ Wait until at least one pipe has output or has been closed, or until
+    timeout seconds have passed.  Return a list of (key, data) tuples, where
+    data is '' if the pipe was closed; closed pipes are unregistered
+    automatically.  Return an empty list on timeout, or at once if there are
+    no pipes and no timeout. """
+    if not self._keys_by_fd:
+      if timeout:
+        time.sleep(timeout)
+      return []
+    if self._poll:
+      while True:
+        try:
+          events = self._poll.poll(
+              None if timeout is None else max(0, timeout * 1000))
+          break
+        except select.error as e:
+          # Retry if we were interrupted by a signal.
+          if e.args[0] != errno.EINTR:
+            raise
+      fd_data = []
+      for (fd, _) in events:
+        # POLLHUP and POLLERR are also reported here; os.read() will then
+        # return '' or raise.
+        try:
+          data = os.read(fd, self.READ_SIZE)
+        except OSError:
+          data = ''
+        fd_data.append((fd, data))
+    else:
+      try:
+        fd_data = [self._queue.get(timeout=timeout)]
+      except Queue.Empty:
+        return []
+      while True:
+        try:
+          fd_data.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+    results = []
+    for (fd, data) in fd_data:
+      key = self._keys_by_fd.get(fd)
+      if not data and key is not None:
+        self.unregister_fd(fd)
+      results.append((key, data))
+    return results
+
+  def read_pending(self, file_obj):
+    """ Return whatever output is waiting in file_obj's pipe right now, without
+    waiting for more (e.g. from a process which has exited, but left a child
+    process holding the pipe open).
+
+    Without select.poll(), the helper thread owns the pipe, so this returns
+    ''. """
+    if not self._poll:
+      return ''
+    poll = select.poll()
+    poll.register(file_obj.fileno(), select.POLLIN | select.POLLPRI)
+    chunks = []
+    while poll.poll(0):
+      try:
+        data = os.read(file_obj.fileno(), self.READ_SIZE)
+      except OSError:
+        break
+      if not data:
+        break
+      chunks.append(data)
+    return ''.join(chunks)
+
+  def is_registered(self, file_obj):
+    """ Return True iff we are still reading from file_obj. """
+    return file_obj.fileno() in self._keys_by_fd
+
+  def unregister_fd(self, fd):
+    """ Stop reading from the pipe with the given file descriptor. """
+    if self._keys_by_fd.pop(fd, None) is not None and self._poll:
+      self._poll.unregister(fd)
+
+  def close(self):
+    """ Stop reading from all pipes. """
+    for fd in list(self._keys_by_fd):
+      self.unregister_fd(fd)
+
+
+def _seconds_until(deadline, max_wait=None):
+  """ Return how many seconds remain until deadline (a time.time() value, or
+  None for no deadline), but no more than max_wait (if not None). """
+  if deadline is None:
+    return max_wait
+  remaining = max(0, deadline - time.time())
+  if max_wait is None:
+    return remaining
+  return min(remaining, max_wait)
+
+
+class OutputCapture(object):
+  """ Collects the output of a command, holding at most max_memory_bytes of it
+  in memory.
+
+  Once the output outgrows max_memory_bytes, all of it is written ("spilled")
+  to a temporary file, and only the most recent max_memory_bytes are kept in
+  memory.  The caller is responsible for calling delete() to remove the file
+  when it is no longer needed, e.g. by using this object as a context
+  manager:
+
+    with run(cmd, max_output_in_memory=1024 * 1024) as output:
+      for line in output:
+        ...
+  """
+
+  def __init__(self, max_memory_bytes=None, spill_dir=None):
+    """
+    max_memory_bytes: maximum number of bytes of output to hold in memory (at
+        least 1), or None to hold all of it in memory (and never spill)
+    spill_dir: directory in which to create the temporary file, or None for the
+        system default
+    """
+    if max_memory_bytes is not None and max_memory_bytes < 1:
+      raise ValueError('max_memory_bytes must be at least 1, not %r' %
+                       max_memory_bytes)
+    self._max_memory_bytes = max_memory_bytes
+    self._spill_dir = spill_dir
+    # The most recent output, in the order it arrived.
+    self._chunks = collections.deque()
+    self._memory_bytes = 0
+    self._total_bytes = 0
+    self._spill_file = None
+
+  @property
+  def bounded(self):
+    """ True iff this object holds a bounded amount of output in memory. """
+    return self._max_memory_bytes is not None
+
+  @property
+  def path(self):
+    """ Path of the file containing all of the output, or None if all of the
+    output is in memory. """
+    return self._spill_file.name if self._spill_file else None
+
+  def __len__(self):
+    """ Return the total number of bytes of output. """
+    return self._total_bytes
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.delete()
+
+  def write(self, data):
+    """ Append data to the output. """
+    if not data:
+      return
+    self._total_bytes += len(data)
+    if self._spill_file:
+      self._spill_file.write(data)
+    self._chunks.append(data)
+    self._memory_bytes += len(data)
+    if self.bounded and self._memory_bytes > self._max_memory_bytes:
+      if not self._spill_file:
+        self._spill_file = tempfile.NamedTemporaryFile(
+            prefix='shell_utils_output_', suffix='.log', dir=self._spill_dir,
+            delete=False)
+        for chunk in self._chunks:
+          self._spill_file.write(chunk)
+      # Discard whatever no longer fits.
+      while (self._memory_bytes - len(self._chunks[0]) >=
+             self._max_memory_bytes):
+        self._memory_bytes -= len(self._chunks.popleft())
+      excess = self._memory_bytes - self._max_memory_bytes
+      if excess > 0:
+        self._chunks[0] = self._chunks[0][excess:]
+        self._memory_bytes -= excess
+
+  def flush(self):
+    """ Make sure everything written so far is in the file at path. """
+    if self._spill_file and not self._spill_file.closed:
+      self._spill_file.flush()
+
+  def close(self):
+    """ Stop writing, and close (but keep) the file at path, so that we do
+    not hold a file descriptor for it.  The output can still be read. """
+    if self._spill_file:
+      self._spill_file.close()
+
+  def tail(self):
+    """ Return the output held in memory: all of it, if it has not been
+    spilled, or else the end of it (starting at a line boundary, if
+    possible). """
+    tail = ''.join(self._chunks)
+    if self._spill_file:
+      tail = tail[tail.find('\n') + 1:] or tail
+    return tail
+
+  def getvalue(self):
+    """ Return all of the output, reading it back from disk if needed. """
+    return ''.join(self.iter_chunks())
+
+  def iter_chunks(self, size=64 * 1024):
+    """ Yield all of the output, in chunks of up to size bytes. """
+    if not self._spill_file:
+      for chunk in list(self._chunks):
+        yield chunk
+      return
+    self.flush()
+    with open(self._spill_file.name, 'rb') as f:
+      while True:
+        data = f.read(size)
+        if not data:
+          return
+        yield data
+
+  def __iter__(self):
+    """ Yield all of the output, a line at a time. """
+    # Pieces of a line which has not ended yet, joined once it does.
+    partial_line = []
+    for data in self.iter_chunks():
+      end = data.rfind('\n') + 1
+      if end:
+        partial_line.append(data[:end])
+        for line in ''.join(partial_line).splitlines(True):
+          yield line
+        partial_line = []
+      if data[end:]:
+        partial_line.append(data[end:])
+    if partial_line:
+      yield ''.join(partial_line)
+
+  def delete(self):
+    """ Remove the file containing the output, if any.  Only the output still
+    in memory remains available after this. """
+    if self._spill_file:
+      self._spill_file.close()
+      os.remove(self._spill_file.name)
+      self._spill_file = None
+      self._total_bytes = self._memory_bytes
+
+  def make_exception(self, exception_class, *args, **kwargs):
+    """ Return an exception_class (a CommandFailedException subclass) carrying
+    the output held in memory, and the path of the full output (which whoever
+    handles the exception may remove).  kwargs are passed on to
+    exception_class. """
+    self.close()
+    return exception_class(self.tail(), *args, log_path=self.path, **kwargs)
+
+  def result(self):
+    """ Return what our callers return as the output of a command: this object,
+    if it is bounded, or else a string. """
+    self.close()
+    return self if self.bounded else self.getvalue()
+
+  def discard_on_error(self):
+    """ Return a context manager which deletes the file if the block it wraps
+    raises anything but an exception from make_exception() (which refers to
+    the file). """
+    return _DiscardOnError(self)
+
+
+class _DiscardOnError(object):
+  """ See OutputCapture.discard_on_error(). """
+
+  def __init__(self, capture):
+    self._capture = capture
+
+  def __enter__(self):
+    return self._capture
+
+  def __exit__(self, exc_type, _value, _traceback):
+    if exc_type and not issubclass(exc_type, CommandFailedException):
+      self._capture.delete()
+
+
+class _Timestamper(object):
+  """ Formats the current time like datetime.now().strftime('%H:%M:%S.%f'),
+  but only calls strftime() once per second. """
+
+  def __init__(self):
+    # (second, formatted second) for the last second we formatted; replaced
+    # as a whole, so that threads can share this object.
+    self._cached = (None, None)
+
+  def now(self):
+    t = time.time()
+    second = int(t)
+    cached = self._cached
+    if cached[0] != second:
+      cached = (second, time.strftime('%H:%M:%S', time.localtime(second)))
+      self._cached = cached
+    return '%s.%06d' % (cached[1], int((t - second) * 1000000))
+
+
+_timestamper = _Timestamper()
+
+
+class _LineLogger(object):
+  """ Logs output from a subprocess a line at a time, as it arrives in
+  arbitrary chunks.
+
+  To keep the cost per line down when a subprocess writes lots of output, we
+  collect the lines we log into batches, which we write out (and flush) once
+  they reach LOG_FLUSH_BYTES, or when they are LOG_FLUSH_SECS old.  Whoever
+  feeds us output must call flush_if_due() by flush_deadline(), and flush() or
+  finish() when done.
+
+  Output with no newline for more than MAX_LOG_LINE_BYTES is logged in pieces,
+  each on a line (and with a timestamp) of its own, so neither a partial line
+  nor a batch ever grows much beyond that. """
+
+  def __init__(self, echo, log_file=None, print_timestamps=True, prefix=''):
+    """
+    echo: boolean indicating whether to print the output to stdout
+    log_file: an open file for writing output, or None
+    print_timestamps: boolean indicating whether a formatted timestamp should be
+        prepended to each line of output
+    prefix: string to prepend to each line of output (after any timestamp)
+    """
+    self._echo = echo
+    self._log_file = log_file
+    self._print_timestamps = print_timestamps
+    self._prefix = prefix
+    # Pieces of output we have received that do not end in a newline yet, and
+    # their total size; joined only once the line is complete (or too long).
+    self._partial_line = []
+    self._partial_bytes = 0
+    # Formatted lines we have not written out yet.
+    self._batch = []
+    self._batch_bytes = 0
+    self._flush_deadline = None
+
+  def write(self, data):
+    """ Log any lines completed by data, and return them (as one string).
+
+    A line longer than MAX_LOG_LINE_BYTES is logged (and returned) in pieces
+    as it arrives, so that it costs neither quadratic time nor unbounded
+    memory; the last piece of what we return may then lack a newline. """
+    lines = ''
+    end = data.rfind('\n') + 1
+    if end:
+      self._partial_line.append(data[:end])
+      lines = self._take_partial_line()
+      data = data[end:]
+    if data:
+      self._partial_line.append(data)
+      self._partial_bytes += len(data)
+      if self._partial_bytes >= MAX_LOG_LINE_BYTES:
+        lines += self._take_partial_line()
+    if lines:
+      self._log(lines)
+    return lines
+
+  def _take_partial_line(self):
+    """ Return (and forget) the pieces of output held in _partial_line. """
+    line = ''.join(self._partial_line)
+    self._partial_line = []
+    self._partial_bytes = 0
+    return line
+
+  def finish(self):
+    """ Log any final line which does not end in a newline, write out
+    everything, and return that final line. """
+    line = self._take_partial_line()
+    if line:
+      self._log(line)
+    self.flush()
+    return line
+
+  def flush_deadline(self):
+    """ Return the time.time() by which flush_if_due() must be called, or None
+    if we have nothing to write out. """
+    return self._flush_deadline
+
+  def flush_if_due(self, now=None):
+    """ Write out the current batch, if it is old enough. """
+    if self._flush_deadline and (now or time.time()) >= self._flush_deadline:
+      self.flush()
+
+  def flush(self):
+    """ Write out the current batch, if any. """
+    if not self._batch:
+      return
+    data = ''.join(self._batch)
+    self._batch = []
+    self._batch_bytes = 0
+    self._flush_deadline = None
+    if self._echo:
+      sys.stdout.write(data)
+      sys.stdout.flush()
+    if self._log_file:
+      self._log_file.write(data)
+      self._log_file.flush()
+
+  def _log(self, lines):
+    if not (self._echo or self._log_file):
+      return
+    if not lines.endswith('\n'):
+      lines += '\n'
+    if self._print_timestamps:
+      prefix = '[%s] %s' % (_timestamper.now(), self._prefix)
+    else:
+      prefix = self._prefix
+    if prefix:
+      lines = prefix + lines[:-1].replace('\n', '\n' + prefix) + '\n'
+    self._batch.append(lines)
+    self._batch_bytes += len(lines)
+    now = time.time()
+    if self._flush_deadline is None:
+      self._flush_deadline = now + LOG_FLUSH_SECS
+    if self._batch_bytes >= LOG_FLUSH_BYTES or now >= self._flush_deadline:
+      self.flush()
+
+
+class OutputWatcher(object):
+  """ Watches the output of a command for any of many patterns at once.
+
+  The patterns are combined into as few regular expressions as possible (one
+  per distinct set of regex flags), which we use to find the lines of output
+  that match any pattern at all; only those lines are then searched for each
+  pattern.  So output matching nothing costs one scan per flag set, however
+  many patterns there are, and every match of every pattern is reported, even
+  where matches overlap.  We scan complete lines as they arrive, so a match is
+  found even if it spans two chunks of output; but no pattern may match a
+  newline. """
+
+  def __init__(self, patterns):
+    """
+    patterns: sequence of (pattern, action) tuples, in order of priority.
+        pattern: a literal string, or a compiled regular expression (which
+            must not use backreferences or group names used by another
+            pattern).
+        action: None to halt the command when pattern matches, or a callable
+            taking (pattern, matched string), called for each match, which
+            may return True to halt the command.
+    """
+    # (pattern, matched string) which halted the command, if any.
+    self.halted_by = None
+    # List of (regex, pattern, action), in order of priority.
+    self._entries = []
+    regexes_by_flags = collections.OrderedDict()
+    for (pattern, action) in patterns:
+      if isinstance(pattern, basestring):
+        regex = re.compile(re.escape(pattern))
+      else:
+        regex = pattern
+      self._entries.append((regex, pattern, action))
+      regexes_by_flags.setdefault(regex.flags, []).append(regex)
+    # Regexes matching any line which any of the patterns matches.
+    self._filters = [
+        re.compile('|'.join('(?:%s)' % regex.pattern for regex in regexes),
+                   flags | re.MULTILINE)
+        for (flags, regexes) in regexes_by_flags.iteritems()]
+
+  def reset(self):
+    """ Forget any previous halt, to start watching another command. """
+    self.halted_by = None
+
+  def _matching_lines(self, lines):
+    """ Return the (start, end) offsets of each line within lines which some
+    pattern matches, in order. """
+    spans = set()
+    for regex in self._filters:
+      pos = 0
+      while True:
+        match = regex.search(lines, pos)
+        if not match:
+          break
+        start = lines.rfind('\n', 0, match.start()) + 1
+        end = lines.find('\n', match.start())
+        if end < 0:
+          end = len(lines)
+        spans.add((start, end))
+        # We search the whole line for each pattern below, so skip the rest of
+        # it here.
+        pos = end + 1
+    return sorted(spans)
+
+  def feed(self, lines):
+    """ Look for the patterns in lines (one or more complete lines, or the
+    final line of output), calling their actions for each match, in order of
+    position within the output (and then of priority).  Return True iff we
+    should halt the command. """
+    for (start, end) in self._matching_lines(lines):
+      line = lines[start:end]
+      matches = []
+      for (priority, (regex, pattern, action)) in enumerate(self._entries):
+        for match in regex.finditer(line):
+          matches.append((match.start(), priority, match.group(0)))
+      for (_, priority, matched) in sorted(matches):
+        (_, pattern, action) = self._entries[priority]
+        if action is None or action(pattern, matched):
+          self.halted_by = (pattern, matched)
+          return True
+    return False
+
+
+def _make_watcher(watch_patterns, halt_on_output=None):
+  """ Return an OutputWatcher for watch_patterns (which may be one already)
+  and/or halt_on_output, or None if there is nothing to watch for.  An
+  OutputWatcher passed in is reset, as it is about to watch a new command. """
+  if isinstance(watch_patterns, OutputWatcher):
+    if halt_on_output:
+      raise ValueError('pass halt_on_output within watch_patterns')
+    watch_patterns.reset()
+    return watch_patterns
+  patterns = list(watch_patterns or [])
+  if halt_on_output:
+    patterns.append((halt_on_output, None))
+  return OutputWatcher(patterns) if patterns else None
+
+
+def _earliest(*times):
+  """ Return the earliest of the given time.time() values, ignoring any which
+  are None; or None if they all are. """
+  times = [t for t in times if t is not None]
+  return min(times) if times else None
 
 
 class EnqueueThread(threading.Thread):
@@ -102,64 +882,112 @@ class EnqueueThread(threading.Thread):
     self._stopped = True
 
 
+def _drain_process(proc, timeout, handle_output, capture, logger=None):
+  """ Read output from proc.stdout until proc exits, calling
+  handle_output(data) with each chunk as soon as it arrives, and reap proc.
+  Return True if we stopped early because handle_output returned True.
+
+  timeout: number of seconds allotted for the process to run, or None.  If
+      it is exceeded, terminates proc and raises a TimeoutException containing
+      the output in capture (the OutputCapture handle_output writes to).
+  logger: the _LineLogger handle_output writes to, if any, which we flush as
+      needed.
+  """
+  deadline = time.time() + timeout if timeout else None
+  multiplexer = _OutputMultiplexer()
+  multiplexer.register(proc.stdout, proc.stdout)
+  # When proc closed its stdout, if it has.
+  closed_at = None
+  try:
+    while True:
+      if multiplexer:
+        # We wake up as soon as proc writes output or exits (closing its
+        # stdout).  If proc has exited but left a child process which still
+        # holds its stdout open, we notice within POLL_MILLIS.
+        events = multiplexer.read(timeout=_seconds_until(
+            _earliest(deadline, logger and logger.flush_deadline()),
+            max_wait=POLL_MILLIS / 1000.0))
+        for (_, data) in events:
+          if data and handle_output(data):
+            return True
+        if logger:
+          logger.flush_if_due()
+        if not events and _reap(proc, block=False) is not None:
+          break
+      else:
+        # proc closed its stdout, but may still be running; keep checking
+        # (rather than blocking in _reap()) so that the timeout still applies.
+        # It usually exits right away, so check often at first.
+        if _reap(proc, block=False) is not None:
+          break
+        if closed_at is None:
+          closed_at = time.time()
+        time.sleep(_seconds_until(deadline, max_wait=min(
+            POLL_MILLIS / 1000.0, max(0.0001, time.time() - closed_at))))
+      if deadline and time.time() >= deadline and (
+          multiplexer or _reap(proc, block=False) is None):
+        _terminate(proc)
+        raise capture.make_exception(
+            TimeoutException,
+            'Subprocess exceeded timeout of %ds' % timeout, usage=proc.usage)
+  finally:
+    multiplexer.close()
+    if logger:
+      logger.flush()
+  return False
+
+
 def log_process_in_real_time(proc, echo=None, timeout=None, log_file=None,
-                             halt_on_output=None, print_timestamps=True):
+                             halt_on_output=None, print_timestamps=True,
+                             max_output_in_memory=None, watch_patterns=None):
   """ Log the output of proc in real time until it completes. Return a tuple
   containing the exit code of proc and the contents of stdout.
 
   proc: an instance of Popen referring to a running subprocess.
   echo: boolean indicating whether to print the output received from proc.stdout
   timeout: number of seconds allotted for the process to run. Raises a
-      TimeoutException if the run time exceeds the timeout.
+      TimeoutException if the run time exceeds the timeout (up to
+      KILL_GRACE_SECS later, if the process ignores SIGTERM).
   log_file: an open file for writing output
   halt_on_output: string; kill the process and return if this string is found
       in the output stream from the process.
   print_timestamps: boolean indicating whether a formatted timestamp should be
       prepended to each line of output.
+  max_output_in_memory: optional, maximum number of bytes of output to hold in
+      memory.  If set, the output is collected in an OutputCapture (which is
+      returned instead of a string), and any TimeoutException carries just the
+      end of the output plus the path to all of it.
+  watch_patterns: optional; an OutputWatcher, or a sequence of (pattern,
+      action) tuples as for OutputWatcher, to watch the output for.  If an
+      action halts the process, we kill it and return.
   """
   if echo is None:
     echo = VERBOSE
-  stdout_queue = Queue.Queue()
-  log_thread = EnqueueThread(proc.stdout, stdout_queue)
-  log_thread.start()
-  try:
-    all_output = []
-    t_0 = time.time()
-    while True:
-      code = proc.poll()
-      try:
-        output = stdout_queue.get_nowait()
-        all_output.append(output)
-        if output and print_timestamps:
-          timestamp = datetime.datetime.now().strftime('%H:%M:%S.%f')
-          output = ''.join(['[%s] %s\n' % (timestamp, line)
-                            for line in output.splitlines()])
-        if echo:
-          sys.stdout.write(output)
-          sys.stdout.flush()
-        if log_file:
-          log_file.write(output)
-          log_file.flush()
-        if halt_on_output and halt_on_output in output:
-          proc.terminate()
-          break
-      except Queue.Empty:
-        if code != None: # proc has finished running
-          break
-        time.sleep(0.5)
-      if timeout and time.time() - t_0 > timeout:
-        proc.terminate()
-        raise TimeoutException(
-            ''.join(all_output),
-            'Subprocess exceeded timeout of %ds' % timeout)
-  finally:
-    log_thread.stop()
-    log_thread.join()
-  return (code, ''.join(all_output))
+  watcher = _make_watcher(watch_patterns, halt_on_output=halt_on_output)
+  capture = OutputCapture(max_memory_bytes=max_output_in_memory)
+  logger = _LineLogger(echo=echo, log_file=log_file,
+                       print_timestamps=print_timestamps)
+
+  def handle_output(data):
+    """ Log any complete lines of output; return True iff we should halt. """
+    capture.write(data)
+    lines = logger.write(data)
+    return bool(watcher and lines and watcher.feed(lines))
+
+  with capture.discard_on_error():
+    halted = _drain_process(proc, timeout=timeout,
+                            handle_output=handle_output, capture=capture,
+                            logger=logger)
+  last_line = logger.finish()
+  if not halted and watcher and last_line and watcher.feed(last_line):
+    halted = True
+  if halted:
+    _terminate(proc)
+  return (_reap(proc), capture.result())
 
 
 def log_process_after_completion(proc, echo=None, timeout=None,
-                                 log_file=None):
+                                 log_file=None, max_output_in_memory=None):
   """ Wait for proc to complete and return a tuple containing the exit code of
   proc and the contents of stdout. Unlike log_process_in_real_time, does not
   attempt to read stdout from proc in real time.
@@ -167,34 +995,44 @@ def log_process_after_completion(proc, echo=None, timeout=None,
   proc: an instance of Popen referring to a running subprocess.
   echo: boolean indicating whether to print the output received from proc.stdout
   timeout: number of seconds allotted for the process to run. Raises a
-      TimeoutException if the run time exceeds the timeout.
+      TimeoutException if the run time exceeds the timeout (up to
+      KILL_GRACE_SECS later, if the process ignores SIGTERM).
   log_file: an open file for writing outout
+  max_output_in_memory: as in log_process_in_real_time
   """
   if echo is None:
     echo = VERBOSE
-  t_0 = time.time()
-  code = None
-  while code is None:
-    if timeout and time.time() - t_0 > timeout:
-      raise TimeoutException(
-          proc.communicate()[0],
-          'Subprocess exceeded timeout of %ds' % timeout)
-    time.sleep(0.5)
-    code = proc.poll()
-  output = proc.communicate()[0]
+  capture = OutputCapture(max_memory_bytes=max_output_in_memory)
+  # Read the output while the process runs, so that it cannot fill up the pipe
+  # and block.
+  with capture.discard_on_error():
+    _drain_process(proc, timeout=timeout, handle_output=capture.write,
+                   capture=capture)
+  for chunk in capture.iter_chunks():
+    if echo:
+      sys.stdout.write(chunk)
+    if log_file:
+      log_file.write(chunk)
   if echo:
-    print output
+    print
   if log_file:
-    log_file.write(output)
     log_file.flush()
-  return (code, output)
+  return (_reap(proc), capture.result())
 
 
 def run(cmd, echo=None, shell=False, timeout=None, print_timestamps=True,
-        log_in_real_time=True):
+        log_in_real_time=True, max_output_in_memory=None, watch_patterns=None):
   """ Run 'cmd' in a shell and return the combined contents of stdout and
   stderr (Blocking).  Throws an exception if the command exits non-zero.
 
+  If timeout is set, the command runs in its own process group, so that if it
+  times out (or we are interrupted), any processes it started are stopped
+  along with it; it cannot then prompt on the terminal.  Without a timeout it
+  shares our process group, so it can prompt (e.g. ssh for a password), and
+  Ctrl-C reaches it as usual.  If echo and PRINT_USAGE are True, we print what
+  the command cost (see ResourceUsage) once it exits; the
+  CommandFailedException carries that too.
+
   cmd: list of strings (or single string, iff shell==True) indicating the
       command to run
   echo: boolean indicating whether we should print the command and log output
@@ -202,35 +1040,62 @@ def run(cmd, echo=None, shell=False, timeout=None, print_timestamps=True,
       only when absolutely necessary, since this allows a lot more freedom which
       could be exploited by malicious code. See the warning here:
       http://docs.python.org/library/subprocess.html#popen-constructor
-  timeout: optional, integer indicating the maximum elapsed time in seconds
+  timeout: optional, integer indicating the maximum elapsed time in seconds.
+      Once it passes, the command's process group gets SIGTERM, and then
+      SIGKILL after KILL_GRACE_SECS if it is still running; so the
+      TimeoutException may come up to KILL_GRACE_SECS late.
   print_timestamps: boolean indicating whether a formatted timestamp should be
       prepended to each line of output. Unused if echo or log_in_real_time is
       False.
   log_in_real_time: boolean indicating whether to read stdout from the
       subprocess in real time instead of when the process finishes. If echo is
       False, we never log in real time, even if log_in_real_time is True.
+  max_output_in_memory: optional, maximum number of bytes of output to hold in
+      memory.  If set, return an OutputCapture instead of a string, and if the
+      command fails, the CommandFailedException carries just the end of the
+      output plus the path to all of it (see OutputCapture).
+  watch_patterns: optional; an OutputWatcher, or a sequence of (pattern,
+      action) tuples as for OutputWatcher, to watch the output for.  If an
+      action halts the command, we kill it and return its output so far
+      without raising an exception; check the OutputWatcher's halted_by to
+      tell whether this happened.
   """
   if echo is None:
     echo = VERBOSE
-  proc = run_async(cmd, echo=echo, shell=shell)
-  # If we're not printing the output, we don't care if the output shows up in
-  # real time, so don't bother.
-  if log_in_real_time and echo:
-    (returncode, output) = log_process_in_real_time(proc, echo=echo,
-        timeout=timeout, print_timestamps=print_timestamps)
-  else:
-    (returncode, output) = log_process_after_completion(proc, echo=echo,
-                                                        timeout=timeout)
-  if returncode != 0:
-    raise CommandFailedException(
-        output,
-        'Command failed with code %d: %s' % (returncode, cmd))
+  watcher = _make_watcher(watch_patterns)
+  proc = run_async(cmd, echo=echo, shell=shell,
+                   new_process_group=bool(timeout))
+  try:
+    # If we're not printing the output, we don't care if the output shows up
+    # in real time, so don't bother (unless we need to watch it).
+    if (log_in_real_time and echo) or watcher:
+      (returncode, output) = log_process_in_real_time(proc, echo=echo,
+          timeout=timeout, print_timestamps=print_timestamps,
+          max_output_in_memory=max_output_in_memory, watch_patterns=watcher)
+    else:
+      (returncode, output) = log_process_after_completion(proc, echo=echo,
+          timeout=timeout, max_output_in_memory=max_output_in_memory)
+  except BaseException:
+    # Don't leave anything running if the command timed out, or if we were
+    # interrupted.
+    _terminate(proc)
+    raise
+  finally:
+    proc.stdout.close()
+  if echo and PRINT_USAGE:
+    print _format_usage(proc.usage)
+  if returncode != 0 and not (watcher and watcher.halted_by):
+    message = 'Command failed with code %d: %s' % (returncode, cmd)
+    if isinstance(output, OutputCapture):
+      raise output.make_exception(CommandFailedException, message,
+                                  usage=proc.usage)
+    raise CommandFailedException(output, message, usage=proc.usage)
   return output
 
 
 def run_retry(cmd, echo=None, shell=False, attempts=1,
               secs_between_attempts=DEFAULT_SECS_BETWEEN_ATTEMPTS,
-              timeout=None, print_timestamps=True):
+              timeout=None, print_timestamps=True, max_output_in_memory=None):
   """ Wrapper for run() which makes multiple attempts until either the command
   succeeds or the maximum number of attempts is reached. """
   if echo is None:
@@ -239,10 +1104,777 @@ def run_retry(cmd, echo=None, shell=False, attempts=1,
   while True:
     try:
       return run(cmd, echo=echo, shell=shell, timeout=timeout,
-                 print_timestamps=print_timestamps)
-    except CommandFailedException:
+                 print_timestamps=print_timestamps,
+                 max_output_in_memory=max_output_in_memory)
+    except CommandFailedException as e:
       if attempt >= attempts:
         raise
+      # Nobody will see the full output of this attempt.
+      if e.log_path:
+        os.remove(e.log_path)
     print 'Command failed. Retrying in %d seconds...' % secs_between_attempts
     time.sleep(secs_between_attempts)
     attempt += 1
+
+
+class RunCache(object):
+  """ Memoizes run() for read-only commands which we would otherwise run over
+  and over (like 'git rev-parse HEAD' or 'adb devices'), saving a process each
+  time.
+
+  Results are keyed by the command, the current working directory and the
+  values of the chosen environment variables; and, optionally, by the
+  modification times of chosen files, so that e.g. 'git rev-parse HEAD' is run
+  again once .git/HEAD changes.  Only successful results are cached.  hits and
+  misses count how many calls were answered from the cache, and how many ran
+  the command. """
+
+  def __init__(self, ttl_secs=None, env_vars=(), watch_files=()):
+    """
+    ttl_secs: optional, number of seconds for which a result stays valid
+    env_vars: names of environment variables which affect the results
+    watch_files: paths of files (relative to the current working directory)
+        which affect the results: if any of them is modified, created or
+        deleted, results cached before that are no longer valid
+    """
+    self._ttl_secs = ttl_secs
+    self._env_vars = tuple(env_vars)
+    self._watch_files = tuple(watch_files)
+    self._lock = threading.Lock()
+    # Maps each key to (output, time.time() at which it expires or None,
+    # stamps of the watched files).
+    self._entries = {}
+    self.hits = 0
+    self.misses = 0
+
+  def _key(self, cmd, shell):
+    return (tuple(cmd) if isinstance(cmd, list) else cmd, shell, os.getcwd(),
+            tuple(os.environ.get(name) for name in self._env_vars))
+
+  def _file_stamps(self, watch_files):
+    stamps = []
+    for path in watch_files:
+      try:
+        st = os.stat(path)
+        stamps.append((st.st_mtime, st.st_size))
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        stamps.append(None)
+    return tuple(stamps)
+
+  def run(self, cmd, shell=False, ttl_secs=None, watch_files=None, **kwargs):
+    """ Return the output of run(cmd, shell=shell, **kwargs), running the
+    command only if we have no valid cached output for it.  Throws an exception
+    if the command exits non-zero, like run().
+
+    ttl_secs, watch_files: optional, override those given to the constructor
+        for this command
+    kwargs: passed on to run(); they do not affect the key.  Pass echo=False to
+        keep cached commands quiet (a cache hit never prints anything).
+    """
+    if ttl_secs is None:
+      ttl_secs = self._ttl_secs
+    watch_files = self._watch_files + tuple(watch_files or ())
+    key = self._key(cmd, shell)
+    stamps = self._file_stamps(watch_files)
+    with self._lock:
+      entry = self._entries.get(key)
+      if (entry and (entry[1] is None or time.time() < entry[1]) and
+          entry[2] == stamps):
+        self.hits += 1
+        return entry[0]
+      self.misses += 1
+    output = run(cmd, shell=shell, **kwargs)
+    with self._lock:
+      self._entries[key] = (output, time.time() + ttl_secs if ttl_secs else None,
+                            stamps)
+    return output
+
+  def invalidate(self, cmd=None, shell=False):
+    """ Forget the cached output of cmd (in the current working directory and
+    environment), or of every command if cmd is None. """
+    with self._lock:
+      if cmd is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(self._key(cmd, shell), None)
+
+
+class Coprocess(object):
+  """ A long-lived subprocess (like 'git cat-file --batch') which we send
+  requests to on its stdin, and read the replies to from its stdout, saving the
+  cost of starting a process for each request.
+
+  The subprocess is started when first needed, and restarted automatically
+  for the next request if it exits or fails.  Like run(), each request can
+  have a timeout; if it is exceeded, the subprocess (and its process group)
+  is stopped and a TimeoutException raised.  stderr is merged into stdout,
+  unless discarded.
+
+  Subclasses define the protocol; see ShellSession. """
+
+  def __init__(self, cmd, echo=None, shell=False, discard_stderr=False):
+    """
+    cmd, echo, shell: as in run()
+    discard_stderr: boolean indicating whether to discard the subprocess's
+        stderr, so that (e.g.) warnings cannot be mistaken for replies
+    """
+    if echo is None:
+      echo = VERBOSE
+    self.cmd = cmd
+    self._echo = echo
+    self._shell = shell
+    self._discard_stderr = discard_stderr
+    self._proc = None
+    self._multiplexer = None
+    # Output which we have read, but not yet consumed.
+    self._buffer = bytearray()
+    # How many times we have had to restart the subprocess.
+    self.restarts = 0
+    self._started = False
+
+  def _start(self):
+    if self._started:
+      self.restarts += 1
+    self._started = True
+    self._proc = run_async(self.cmd, echo=self._echo, shell=self._shell,
+                           new_process_group=True, stdin=subprocess.PIPE,
+                           discard_stderr=self._discard_stderr)
+    self._multiplexer = _OutputMultiplexer()
+    self._multiplexer.register(self, self._proc.stdout)
+    self._buffer = bytearray()
+
+  def close(self):
+    """ Stop the subprocess, if it is running.  (The next request will start
+    it again.) """
+    proc = self._proc
+    if not proc:
+      return
+    self._proc = None
+    self._multiplexer.close()
+    try:
+      proc.stdin.close()
+    except IOError:
+      pass
+    _terminate(proc)
+    proc.stdout.close()
+
+  def _fail(self, exception_class, message):
+    """ Stop the subprocess, and return an exception_class to raise, carrying
+    whatever output of the current request we have read. """
+    output = str(self._buffer)
+    self.close()
+    return exception_class(output, '%s: %s' % (message, self.cmd))
+
+  def _read_more(self, deadline):
+    """ Read more output into self._buffer, waiting until deadline at most. """
+    while True:
+      events = self._multiplexer.read(timeout=_seconds_until(deadline))
+      for (_, data) in events:
+        if not data:
+          raise self._fail(CommandFailedException, 'Coprocess exited')
+        self._buffer += data
+      if events:
+        return
+      if deadline and time.time() >= deadline:
+        raise self._fail(TimeoutException, 'Coprocess exceeded timeout')
+
+  def read_until(self, marker, deadline):
+    """ Return all the output up to and including marker, reading more as
+    needed.  For use by subclasses' reply parsers. """
+    start = 0
+    while True:
+      index = self._buffer.find(marker, start)
+      if index >= 0:
+        end = index + len(marker)
+        data = str(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+      start = max(0, len(self._buffer) - len(marker) + 1)
+      self._read_more(deadline)
+
+  def read_bytes(self, size, deadline):
+    """ Return the next size bytes of output, reading more as needed.  For use
+    by subclasses' reply parsers. """
+    while len(self._buffer) < size:
+      self._read_more(deadline)
+    data = str(self._buffer[:size])
+    del self._buffer[:size]
+    return data
+
+  def request(self, data, read_reply, timeout=None):
+    """ Write data to the subprocess's stdin, and return read_reply(deadline),
+    which should parse the reply using read_until() and read_bytes().  Throws
+    a CommandFailedException if the subprocess exits before replying, or a
+    TimeoutException if it takes more than timeout seconds.  If read_reply()
+    raises anything, the next request restarts the subprocess, so that it
+    cannot read what is left of this reply as its own. """
+    deadline = time.time() + timeout if timeout else None
+    for attempt in (1, 2):
+      if self._proc and _reap(self._proc, block=False) is not None:
+        self.close()
+      if not self._proc:
+        self._start()
+      try:
+        self._proc.stdin.write(data)
+        self._proc.stdin.flush()
+        break
+      except IOError as e:
+        # The subprocess exited before it could have seen this request, so it
+        # is safe to retry it once.
+        if e.errno != errno.EPIPE or attempt == 2:
+          raise
+        self.close()
+    try:
+      return read_reply(deadline)
+    except BaseException:
+      self.close()
+      raise
+
+
+class ShellSession(Coprocess):
+  """ A persistent shell (by default 'sh'; but e.g. 'adb shell' works too),
+  which runs one command line at a time.  State such as the working directory
+  carries over from one command line to the next, but is lost if the shell has
+  to be restarted.
+
+  Each command line is run with "command eval", with stdin redirected from
+  /dev/null, so the shell must be POSIX-compatible.  That way a command line
+  with a syntax error (e.g. an unterminated quote) just fails, and one that
+  reads stdin gets EOF, instead of either swallowing the unique sentinel (and
+  exit code) which we have the shell print after it. """
+
+  def __init__(self, cmd=None, echo=None):
+    """
+    cmd: command which starts the shell; defaults to ['sh']
+    echo: as in run()
+    """
+    Coprocess.__init__(self, cmd or ['sh'], echo=echo)
+    self._sentinel = 'SHELL_UTILS_%s' % binascii.hexlify(os.urandom(16))
+
+  def run(self, command_line, timeout=None, print_timestamps=True):
+    """ Run command_line in the shell, and return its output (Blocking).
+    Throws an exception if it exits non-zero, like run(). """
+    if self._echo:
+      print command_line
+    # The sentinel always starts a line of its own, so that we can find it
+    # even if the output does not end in a newline.
+    marker = '\n%s ' % self._sentinel
+
+    def read_reply(deadline):
+      output = self.read_until(marker, deadline)[:-len(marker)]
+      returncode = int(self.read_until('\n', deadline))
+      return (returncode, output)
+
+    # Quote command_line so that the shell parses all of it on its own.
+    quoted = "'%s'" % command_line.replace("'", "'\\''")
+    (returncode, output) = self.request(
+        "command eval %s </dev/null\nprintf '\\n%s %%d\\n' $?\n" % (
+            quoted, self._sentinel),
+        read_reply, timeout=timeout)
+    if self._echo:
+      logger = _LineLogger(echo=True, print_timestamps=print_timestamps)
+      logger.write(output)
+      logger.finish()
+    if returncode != 0:
+      raise CommandFailedException(
+          output, 'Command failed with code %d: %s' % (returncode,
+                                                       command_line))
+    return output
+
+
+def run_many(cmds, max_parallel=None, timeout=None, echo=None, shell=False,
+             print_timestamps=True, fail_fast=False, as_completed=False,
+             prefixes=None):
+  """ Run each of 'cmds' in a subprocess, up to max_parallel at once, and
+  return a list of CommandResults in the same order as cmds (Blocking).
+  Throws a CommandsFailedException if any of the commands exits non-zero or
+  times out.
+
+  All the commands are supervised from this thread, which wakes up whenever any
+  of them produces output or exits; output is logged a line at a time, with
+  each line prefixed to show which command it came from.
+
+  cmds: list of commands, each as would be passed to run()
+  max_parallel: maximum number of commands to run at once; defaults to the
+      number of CPUs
+  timeout: optional, number of seconds allotted for each command to run
+      (which, as in run(), may overrun by up to KILL_GRACE_SECS)
+  echo: boolean indicating whether we should print the commands and log output
+  shell: as in run()
+  print_timestamps: boolean indicating whether a formatted timestamp should be
+      prepended to each line of output
+  fail_fast: if True, as soon as any command fails, kill all the others and
+      throw a CommandsFailedException for that one.  Otherwise, run all the
+      commands and then throw a CommandsFailedException listing all those which
+      failed.
+  as_completed: if True, instead of a list, return an iterator which yields
+      each CommandResult as soon as its command completes.  Commands only run
+      while the iterator is being consumed, and the CommandsFailedException is
+      thrown by the iterator.
+  prefixes: optional list of strings (one per command) to prefix each line of
+      output with, instead of '[<index of command>] '
+  """
+  if echo is None:
+    echo = VERBOSE
+  if not max_parallel:
+    # Imported here, since it is slow to import and rarely needed.
+    import multiprocessing
+    max_parallel = multiprocessing.cpu_count()
+  results = _run_many_as_completed(
+      cmds=cmds, max_parallel=max_parallel,
+      timeout=timeout, echo=echo, shell=shell,
+      print_timestamps=print_timestamps, fail_fast=fail_fast,
+      prefixes=prefixes)
+  if as_completed:
+    return results
+  return sorted(results, key=lambda result: result.index)
+
+
+def _run_many_as_completed(cmds, max_parallel, timeout, echo, shell,
+                           print_timestamps, fail_fast, prefixes):
+  """ Implements run_many(); yields each CommandResult as it completes. """
+  pending = [CommandResult(index=i, cmd=cmd,
+                           prefix=prefixes[i] if prefixes else '[%d] ' % i)
+             for (i, cmd) in enumerate(cmds)]
+  pending.reverse()
+  # Maps each running CommandResult to (proc, deadline, list of output
+  # chunks, _LineLogger).
+  running = {}
+  # Maps each running CommandResult whose command has closed its output to
+  # when that happened.  We can't block waiting for such a command to exit, so
+  # we check on it often at first, then every POLL_MILLIS.
+  output_closed_at = {}
+  failures = []
+  multiplexer = _OutputMultiplexer()
+
+  def finish(result, timed_out=False):
+    """ Clean up after a command which has exited (or timed out). """
+    (proc, _, chunks, logger) = running.pop(result)
+    output_closed_at.pop(result, None)
+    if multiplexer.is_registered(proc.stdout):
+      data = multiplexer.read_pending(proc.stdout)
+      if data:
+        chunks.append(data)
+        logger.write(data)
+      multiplexer.unregister_fd(proc.stdout.fileno())
+    logger.finish()
+    if timed_out:
+      result.returncode = _terminate(proc)
+    else:
+      result.returncode = _reap(proc)
+    proc.stdout.close()
+    result.output = ''.join(chunks)
+    result.usage = proc.usage
+    if echo and PRINT_USAGE:
+      print '%s%s' % (result.prefix, _format_usage(result.usage))
+    if timed_out:
+      result.exception = TimeoutException(
+          result.output, 'Subprocess exceeded timeout of %ds: %s' % (
+              timeout, result.cmd), usage=result.usage)
+    elif result.returncode != 0:
+      result.exception = CommandFailedException(
+          result.output, 'Command failed with code %d: %s' % (
+              result.returncode, result.cmd), usage=result.usage)
+    if result.exception:
+      failures.append(result)
+
+  try:
+    while pending or running:
+      while pending and len(running) < max_parallel:
+        result = pending.pop()
+        if echo:
+          print '%s%s' % (result.prefix, ' '.join(result.cmd)
+                          if isinstance(result.cmd, list) else result.cmd)
+        proc = run_async(result.cmd, echo=False, shell=shell,
+                         new_process_group=True)
+        running[result] = (proc, time.time() + timeout if timeout else None,
+                           [], _LineLogger(echo=echo,
+                                           print_timestamps=print_timestamps,
+                                           prefix=result.prefix))
+        multiplexer.register(result, proc.stdout)
+
+      # Wake up as soon as any command writes output or exits, or when the
+      # next deadline passes.  If a command has exited but left a child process
+      # which still holds its stdout open, we notice within POLL_MILLIS (or
+      # once that child stops writing), however busy the other commands are.
+      wakeups = []
+      for (_, deadline, _, logger) in running.itervalues():
+        wakeups.extend([deadline, logger.flush_deadline()])
+      max_wait = POLL_MILLIS / 1000.0
+      for closed_at in output_closed_at.itervalues():
+        max_wait = min(max_wait, max(0.001, time.time() - closed_at))
+      events = multiplexer.read(timeout=_seconds_until(
+          _earliest(*wakeups), max_wait=max_wait))
+      # Maps each command which has completed to whether it timed out.
+      completed = collections.OrderedDict()
+      had_output = set()
+      for (result, data) in events:
+        if data:
+          (_, _, chunks, logger) = running[result]
+          chunks.append(data)
+          logger.write(data)
+          had_output.add(result)
+        elif result in running:
+          # The command has closed its output, but may still be running.
+          output_closed_at[result] = time.time()
+      now = time.time()
+      for (result, (proc, deadline, _, logger)) in running.items():
+        logger.flush_if_due(now)
+        if result in completed:
+          continue
+        if (result not in had_output and
+            _reap(proc, block=False) is not None):
+          completed[result] = False
+        elif deadline and now >= deadline:
+          completed[result] = True
+
+      for (result, timed_out) in completed.iteritems():
+        finish(result, timed_out=timed_out)
+        if result.exception and fail_fast:
+          raise CommandsFailedException(
+              [result], '%d command(s) failed' % len(failures))
+        yield result
+    if failures:
+      raise CommandsFailedException(
+          failures, '%d command(s) failed' % len(failures))
+  finally:
+    # If we stopped early, don't leave any commands running.
+    for (proc, _, _, logger) in running.itervalues():
+      logger.flush()
+      _kill_process_group(proc, sig=_SIGKILL)
+      _reap(proc)
+      proc.stdout.close()
+    multiplexer.close()
+
+
+class AsyncCommand(object):
+  """ A command started by run_async_io(), which runs while its CommandLoop
+  runs.
+
+  Iterating over an AsyncCommand yields each line of its output (including
+  the trailing newline, if any) as it arrives, running the CommandLoop (and so
+  every other command in it) while waiting. """
+
+  def __init__(self, loop, cmd, echo, shell, timeout, log_file, watch_patterns,
+               print_timestamps, attempts, secs_between_attempts):
+    self.cmd = cmd
+    self._loop = loop
+    self._echo = echo
+    self._shell = shell
+    self._timeout = timeout
+    self._log_file = log_file
+    self._watcher = _make_watcher(watch_patterns)
+    self._print_timestamps = print_timestamps
+    self._attempts = attempts
+    self._secs_between_attempts = secs_between_attempts
+    self._attempt = 0
+    self._proc = None
+    self._deadline = None
+    self._restart_at = None
+    # Once we have sent SIGTERM to the command, when to send SIGKILL.
+    self._kill_at = None
+    # When the command closed its output, if it has.
+    self._output_closed_at = None
+    self._halted = False
+    self._timed_out = False
+    self._chunks = []
+    self._logger = None
+    # Complete lines of output which lines() has not yielded yet.
+    self._unread_lines = collections.deque()
+    self.done = False
+    self.returncode = None
+    # CommandFailedException if the command failed, else None.
+    self.exception = None
+    # ResourceUsage of the command (of its latest attempt, if retried), once
+    # it has exited.
+    self.usage = None
+
+  @property
+  def output(self):
+    """ Output of the command so far (of its latest attempt, if retried). """
+    return ''.join(self._chunks)
+
+  def _launch(self):
+    self._attempt += 1
+    self._restart_at = None
+    self._kill_at = None
+    self._output_closed_at = None
+    self._chunks = []
+    self._halted = False
+    self._timed_out = False
+    if self._watcher:
+      self._watcher.reset()
+    self._logger = _LineLogger(echo=self._echo, log_file=self._log_file,
+                               print_timestamps=self._print_timestamps)
+    self._proc = run_async(self.cmd, echo=self._echo, shell=self._shell,
+                           new_process_group=True)
+    self._deadline = time.time() + self._timeout if self._timeout else None
+    self._loop._multiplexer.register(self, self._proc.stdout)
+
+  def _next_wakeup(self):
+    """ Return the time at which the loop must next check on us, or None. """
+    if self._proc:
+      if self._kill_at:
+        # We are waiting for the command to exit after SIGTERM; once we have
+        # sent SIGKILL too, we check on it every POLL_MILLIS.
+        return _earliest(self._kill_at if self._kill_at > time.time() else None,
+                         self._logger.flush_deadline())
+      wakeup = _earliest(self._deadline, self._logger.flush_deadline())
+      if self._output_closed_at:
+        # We can't block waiting for the command to exit, so check on it often
+        # at first, then every POLL_MILLIS.
+        now = time.time()
+        wakeup = _earliest(
+            wakeup, now + max(0.001, now - self._output_closed_at))
+      return wakeup
+    return self._restart_at
+
+  def _handle_output(self, data):
+    self._chunks.append(data)
+    lines = self._logger.write(data)
+    if lines:
+      self._unread_lines.extend(lines.splitlines(True))
+      if self._watcher and not self._halted and self._watcher.feed(lines):
+        self._halted = True
+
+  def _check(self, now, had_output):
+    """ Handle anything that has happened to us.
+
+    now: current time.time()
+    had_output: True if the loop saw output from us this time around
+    """
+    if self._restart_at:
+      if now >= self._restart_at:
+        self._launch()
+      return
+    proc = self._proc
+    self._logger.flush_if_due(now)
+    if not self._kill_at and (self._halted or (self._deadline and
+                                               now >= self._deadline)):
+      # Stop the command and everything it started; anything still running
+      # after KILL_GRACE_SECS gets SIGKILL.
+      self._timed_out = not self._halted
+      self._kill_at = now + KILL_GRACE_SECS
+      _kill_process_group(proc)
+    if self._kill_at:
+      if _process_group_alive(proc):
+        if now < self._kill_at:
+          return
+        # As in _terminate(), once we have sent SIGKILL we only wait for the
+        # command itself.
+        _kill_process_group(proc, sig=_SIGKILL)
+        if _reap(proc, block=False) is None:
+          return
+    elif had_output or _reap(proc, block=False) is None:
+      # Still running, even if it has closed its output.  (If the command has
+      # exited, but left a child process which still holds its stdout open, we
+      # notice once that child is not writing, whatever the other commands are
+      # doing.)
+      return
+    self._finish()
+
+  def _finish(self):
+    proc = self._proc
+    self._proc = None
+    multiplexer = self._loop._multiplexer
+    if multiplexer.is_registered(proc.stdout):
+      data = multiplexer.read_pending(proc.stdout)
+      if data:
+        self._handle_output(data)
+      multiplexer.unregister_fd(proc.stdout.fileno())
+    last_line = self._logger.finish()
+    if last_line:
+      self._unread_lines.append(last_line)
+      if self._watcher and not self._halted and self._watcher.feed(last_line):
+        self._halted = True
+    self.returncode = _reap(proc)
+    proc.stdout.close()
+    self.usage = proc.usage
+    if self._echo and PRINT_USAGE:
+      print _format_usage(self.usage)
+    if self._timed_out:
+      self.exception = TimeoutException(
+          self.output,
+          'Subprocess exceeded timeout of %ds: %s' % (self._timeout, self.cmd),
+          usage=self.usage)
+    elif self.returncode != 0:
+      self.exception = CommandFailedException(
+          self.output,
+          'Command failed with code %d: %s' % (self.returncode, self.cmd),
+          usage=self.usage)
+    else:
+      self.exception = None
+    # Like run_retry(), retry after any failure (but not if we deliberately
+    # halted the command).
+    if (self.exception and not self._halted and
+        self._attempt < self._attempts):
+      print 'Command failed. Retrying in %d seconds...' % (
+          self._secs_between_attempts)
+      self._restart_at = time.time() + self._secs_between_attempts
+      return
+    self.done = True
+    self._loop._commands.discard(self)
+
+  def cancel(self):
+    """ Stop the command, killing its whole process group; wait() will then
+    raise a CommandFailedException. """
+    if self.done:
+      return
+    if self._proc:
+      _kill_process_group(self._proc, sig=_SIGKILL)
+      self._attempts = self._attempt
+      self._finish()
+    self.done = True
+    self._loop._commands.discard(self)
+    self.exception = CommandFailedException(
+        self.output, 'Command was cancelled: %s' % (self.cmd,),
+        usage=self.usage)
+
+  def lines(self):
+    """ Yield each line of output as it arrives, until the command is done. """
+    while True:
+      while self._unread_lines:
+        yield self._unread_lines.popleft()
+      if self.done:
+        return
+      self._loop.run_once()
+
+  def __iter__(self):
+    return self.lines()
+
+  def wait(self):
+    """ Run the CommandLoop until this command is done.  Return the output of
+    the command, like run(), or raise its CommandFailedException. """
+    while not self.done:
+      self._loop.run_once()
+    if self.exception:
+      raise self.exception
+    return self.output
+
+
+class CommandLoop(object):
+  """ Supervises any number of subprocesses from a single thread, without
+  blocking on any one of them.
+
+  Example Code:
+    loop = shell_utils.CommandLoop()
+    commands = [shell_utils.run_async_io(['make', target], loop=loop,
+                                         timeout=600)
+                for target in targets]
+    for line in commands[0]:
+      # Meanwhile, the other commands run too.
+      print 'first target:', line,
+    loop.run_until_complete()
+    outputs = [command.wait() for command in commands]
+  """
+
+  def __init__(self):
+    self._multiplexer = _OutputMultiplexer()
+    # AsyncCommands which are not done yet.
+    self._commands = set()
+
+  def start(self, cmd, **kwargs):
+    """ Start running cmd, returning an AsyncCommand.  kwargs are as for
+    run_async_io(). """
+    command = AsyncCommand(loop=self, cmd=cmd, **kwargs)
+    command._launch()
+    self._commands.add(command)
+    return command
+
+  def run_once(self):
+    """ Wait until something happens (output from a command, a command
+    exiting, a timeout, or a retry coming due), and handle it. """
+    if not self._commands:
+      return
+    wait = _seconds_until(
+        _earliest(*[c._next_wakeup() for c in self._commands]),
+        max_wait=POLL_MILLIS / 1000.0)
+    if self._multiplexer:
+      events = self._multiplexer.read(timeout=wait)
+    else:
+      # Every command is waiting to be retried.
+      time.sleep(wait)
+      events = []
+    had_output = set()
+    for (command, data) in events:
+      if data:
+        command._handle_output(data)
+        had_output.add(command)
+      else:
+        command._output_closed_at = time.time()
+    now = time.time()
+    for command in list(self._commands):
+      command._check(now=now, had_output=command in had_output)
+
+  def run_until_complete(self, commands=None):
+    """ Run until all the given AsyncCommands (or all our commands, if None)
+    are done. """
+    if commands is None:
+      commands = list(self._commands)
+    while [c for c in commands if not c.done]:
+      self.run_once()
+
+  def cancel_all(self):
+    """ Cancel every command which is not done yet. """
+    for command in list(self._commands):
+      command.cancel()
+
+
+_thread_local = threading.local()
+
+
+def get_command_loop():
+  """ Return this thread's default CommandLoop, creating it if needed. """
+  loop = getattr(_thread_local, 'command_loop', None)
+  if not loop:
+    loop = _thread_local.command_loop = CommandLoop()
+  return loop
+
+
+def run_async_io(cmd, loop=None, echo=None, shell=False, timeout=None,
+                 log_file=None, halt_on_output=None, print_timestamps=True,
+                 watch_patterns=None):
+  """ Start running 'cmd' in its own process group, returning an AsyncCommand
+  (Non-blocking).  The command runs whenever its CommandLoop runs: iterate over
+  the AsyncCommand to get its output a line at a time, or call its wait() to
+  get all of its output (or the CommandFailedException), like run().
+
+  Python 2 has no asyncio, so this is the nearest equivalent: one thread can
+  supervise hundreds of commands this way.
+
+  cmd, echo, shell, print_timestamps: as in run()
+  loop: the CommandLoop to run in; defaults to get_command_loop()
+  timeout: optional, number of seconds allotted for the command to run; if it
+      is exceeded, the command's whole process group is killed (with SIGKILL
+      after KILL_GRACE_SECS, if need be, so it may finish that much later)
+  log_file: an open file for writing output
+  halt_on_output: string; kill the command's process group, and finish, if
+      this string is found in its output
+  watch_patterns: optional; a sequence of (pattern, action) tuples as for
+      OutputWatcher; if an action halts the command, kill its process group,
+      and finish, as for halt_on_output
+  """
+  if echo is None:
+    echo = VERBOSE
+  return (loop or get_command_loop()).start(
+      cmd, echo=echo, shell=shell, timeout=timeout, log_file=log_file,
+      watch_patterns=_make_watcher(watch_patterns,
+                                   halt_on_output=halt_on_output),
+      print_timestamps=print_timestamps,
+      attempts=1, secs_between_attempts=0)
+
+
+def run_retry_async_io(cmd, loop=None, echo=None, shell=False, attempts=1,
+                       secs_between_attempts=DEFAULT_SECS_BETWEEN_ATTEMPTS,
+                       timeout=None, print_timestamps=True):
+  """ Like run_async_io(), but makes multiple attempts until either the command
+  succeeds or the maximum number of attempts is reached, like run_retry().
+  Iterating over the AsyncCommand yields the output of every attempt. """
+  if echo is None:
+    echo = VERBOSE
+  return (loop or get_command_loop()).start(
+      cmd, echo=echo, shell=shell, timeout=timeout, log_file=None,
+      watch_patterns=None, print_timestamps=print_timestamps,
+      attempts=attempts, secs_between_attempts=secs_between_attempts)
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+"""
+Copyright 2014 Google Inc.
+
+Use of this source code is governed by a BSD-style license that can be
+found in the LICENSE file.
+
+Measures the overhead shell_utils.run() adds to running a trivial command, and
+how many lines per second it can log from a command which writes lots of
+output, so that we notice if a change makes every command we run slower.
+
+Usage:
+  python shell_utils_benchmark.py [--revision REV] [--runs N] [--lines N]
+
+With --revision, we also measure the shell_utils.py from that git revision
+(e.g. HEAD~1), for a before/after comparison.
+"""
+
+# System-level imports
+import imp
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+# Imports from within Skia
+import shell_utils
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CMD = ['true']
+
+
+def _chatty_cmd(lines):
+  """Returns a command which writes the given number of short lines, one
+  write() at a time, like a compiler or test runner."""
+  return ['sh', '-c', 'i=0; while [ $i -lt %d ]; do echo line $i; '
+          'i=$((i+1)); done' % lines]
+
+
+def _load_revision(revision):
+  """Returns the shell_utils module as it was at a given git revision."""
+  source = subprocess.check_output(
+      ['git', 'show', '%s:./shell_utils.py' % revision], cwd=SCRIPT_DIR)
+  module = imp.new_module('shell_utils_%s' % revision)
+  exec source in module.__dict__
+  return module
+
+
+def _time_per_call(func, runs):
+  """Returns the mean wall-clock time of func(), in seconds."""
+  t_0 = time.time()
+  for _ in range(runs):
+    func()
+  return (time.time() - t_0) / runs
+
+
+def _benchmark(name, module, runs, lines):
+  """Prints the per-call time of module.run(CMD), with and without echo, and
+  how fast module.run() logs lines of output."""
+  print('%s:' % name)
+  with open(os.devnull, 'w') as devnull:
+    stdout = sys.stdout
+    results = []
+    for echo in (False, True):
+      # Discard the echoed command and output.
+      sys.stdout = devnull
+      try:
+        results.append((echo, _time_per_call(
+            lambda: module.run(CMD, echo=echo), runs)))
+      finally:
+        sys.stdout = stdout
+    sys.stdout = devnull
+    try:
+      throughput = lines / _time_per_call(
+          lambda: module.run(_chatty_cmd(lines), echo=True), 1)
+    finally:
+      sys.stdout = stdout
+  for (echo, seconds) in results:
+    print('  run(%s, echo=%s): %8.2f ms' % (CMD, echo, seconds * 1000))
+  print('  run(<%d lines>, echo=True): %8.0f lines/sec' % (lines, throughput))
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--revision',
+                    help='also measure shell_utils.py from this git revision')
+  parser.add_option('--runs', type='int', default=20,
+                    help='how many times to run the command')
+  parser.add_option('--lines', type='int', default=100000,
+                    help='how many lines of output to log')
+  (options, _) = parser.parse_args()
+
+  print('subprocess.call(%s): %8.2f ms' % (CMD, _time_per_call(
+      lambda: subprocess.call(CMD), options.runs) * 1000))
+  if options.revision:
+    _benchmark(name='shell_utils at %s' % options.revision,
+               module=_load_revision(options.revision), runs=options.runs,
+               lines=options.lines)
+  _benchmark(name='shell_utils', module=shell_utils, runs=options.runs,
+             lines=options.lines)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,506 @@
+#!/usr/bin/python
+
+"""
+Copyright 2014 Google Inc.
+
+Use of this source code is governed by a BSD-style license that can be
+found in the LICENSE file.
+
+Test shell_utils.py
+
+These tests run small shell commands, so they only run on Posix systems.
+"""
+
+# System-level imports
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+# Imports from within Skia
+import shell_utils
+
+
+@unittest.skipIf(os.name == 'nt', 'requires a Posix shell')
+class ShellUtilsTest(unittest.TestCase):
+
+  def test_real_time_output(self):
+    """Tests that log_process_in_real_time() returns all output, including a
+    final line without a newline, as soon as the process exits."""
+    t_0 = time.time()
+    proc = shell_utils.run_async(['sh', '-c', 'echo a; echo b; printf c'],
+                                 echo=False)
+    self.assertEquals(
+        shell_utils.log_process_in_real_time(proc, echo=False),
+        (0, 'a\nb\nc'))
+    self.assertLess(time.time() - t_0, 0.4)
+
+  def test_real_time_timeout(self):
+    """Tests that log_process_in_real_time() enforces its timeout promptly."""
+    t_0 = time.time()
+    proc = shell_utils.run_async(['sh', '-c', 'echo a; sleep 10'], echo=False)
+    with self.assertRaises(shell_utils.TimeoutException) as cm:
+      shell_utils.log_process_in_real_time(proc, echo=False, timeout=0.2)
+    self.assertEquals(cm.exception.output, 'a\n')
+    self.assertLess(time.time() - t_0, 1)
+    proc.wait()
+
+  def test_timeout_after_output_closed(self):
+    """Tests that the timeout still applies once a command has closed its
+    output but keeps running."""
+    cmd = ['sh', '-c', 'echo a; exec >/dev/null 2>&1; sleep 10']
+    grace_secs = shell_utils.KILL_GRACE_SECS
+    shell_utils.KILL_GRACE_SECS = 0.2
+    try:
+      for log_in_real_time in (True, False):
+        t_0 = time.time()
+        with self.assertRaises(shell_utils.TimeoutException) as cm:
+          shell_utils.run(cmd, echo=False, timeout=0.3, watch_patterns=(
+              [('never', 'halt')] if log_in_real_time else None))
+        self.assertEquals(cm.exception.output, 'a\n')
+        self.assertLess(time.time() - t_0, 1.5)
+    finally:
+      shell_utils.KILL_GRACE_SECS = grace_secs
+
+  def test_halt_on_output(self):
+    """Tests that log_process_in_real_time() stops the process when it sees
+    halt_on_output."""
+    proc = shell_utils.run_async(['sh', '-c', 'echo a; echo STOP; sleep 10'],
+                                 echo=False)
+    (code, output) = shell_utils.log_process_in_real_time(
+        proc, echo=False, halt_on_output='STOP')
+    self.assertNotEquals(code, 0)
+    self.assertEquals(output, 'a\nSTOP\n')
+
+  def test_timeout_kills_process_group(self):
+    """Tests that when run() times out, it stops the command's child processes
+    too, with SIGKILL if they ignore SIGTERM."""
+    tempdir = tempfile.mkdtemp()
+    grace_secs = shell_utils.KILL_GRACE_SECS
+    shell_utils.KILL_GRACE_SECS = 0.2
+    try:
+      marker = os.path.join(tempdir, 'marker')
+      t_0 = time.time()
+      with self.assertRaises(shell_utils.TimeoutException) as cm:
+        shell_utils.run(
+            ['sh', '-c', '(trap "" TERM; sleep 1; touch %s) & wait' % marker],
+            echo=False, timeout=0.2)
+      self.assertLess(time.time() - t_0, 1)
+      self.assertGreater(cm.exception.usage.wall_secs, 0.2)
+      time.sleep(1.5)
+      self.assertFalse(os.path.exists(marker))
+    finally:
+      shell_utils.KILL_GRACE_SECS = grace_secs
+      shutil.rmtree(tempdir)
+
+  def test_process_groups(self):
+    """Tests that run() gives a command its own process group (but not its own
+    session) only if it has a timeout."""
+    cmd = ['sh', '-c', 'ps -o pgid= -o sid= -p $$']
+    (pgid, sid) = shell_utils.run(cmd, echo=False).split()
+    self.assertEquals((int(pgid), int(sid)), (os.getpgrp(), os.getsid(0)))
+    (pgid, sid) = shell_utils.run(cmd, echo=False, timeout=10).split()
+    self.assertNotEquals(int(pgid), os.getpgrp())
+    self.assertEquals(int(sid), os.getsid(0))
+
+  def test_resource_usage(self):
+    """Tests that run_many() reports what each command cost."""
+    (result,) = shell_utils.run_many(
+        [['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done']],
+        max_parallel=1, echo=False)
+    self.assertGreater(result.usage.wall_secs, 0)
+    self.assertGreater(result.usage.user_secs + result.usage.sys_secs, 0)
+    self.assertGreater(result.usage.max_rss_kb, 0)
+
+    # Exit codes are decoded as Popen would: negative for a signal.
+    for (cmd, returncode) in (('exit 3', 3), ('kill -9 $$', -9)):
+      proc = shell_utils.run_async(['sh', '-c', cmd], echo=False)
+      self.assertEquals(shell_utils._reap(proc), returncode)
+      self.assertEquals(proc.poll(), returncode)
+      self.assertNotEquals(proc.usage, None)
+      proc.stdout.close()
+
+  def test_watch_patterns(self):
+    """Tests that run(watch_patterns=...) calls each pattern's action, finds
+    matches which span chunks of output, and halts the command when asked."""
+    seen = []
+    watcher = shell_utils.OutputWatcher([
+        (re.compile(r'err(or|no) \d+'), lambda p, m: seen.append(m)),
+        ('SEGV', lambda p, m: seen.append(m)),
+        ('READY', None),
+    ])
+    t_0 = time.time()
+    output = shell_utils.run(
+        ['sh', '-c', 'echo error 1; printf "SE"; sleep 0.1; echo GV; '
+         'echo errno 2; echo READY; sleep 10'],
+        echo=False, watch_patterns=watcher)
+    self.assertLess(time.time() - t_0, 5)
+    self.assertEquals(seen, ['error 1', 'SEGV', 'errno 2'])
+    self.assertEquals(watcher.halted_by, ('READY', 'READY'))
+    self.assertTrue(output.endswith('READY\n'))
+
+    # A watcher that halted one command does not hide a later failure.
+    with self.assertRaises(shell_utils.CommandFailedException):
+      shell_utils.run(['sh', '-c', 'echo error 3; exit 1'], echo=False,
+                      watch_patterns=watcher)
+    self.assertEquals(watcher.halted_by, None)
+
+  def test_watch_overlapping_patterns(self):
+    """Tests that OutputWatcher reports every match of every pattern, even
+    where they overlap."""
+    seen = []
+    watcher = shell_utils.OutputWatcher([
+        ('Segmentation fault', lambda p, m: seen.append(m)),
+        ('fault', lambda p, m: seen.append(m)),
+        (re.compile(r'^core', re.I), lambda p, m: seen.append(m)),
+    ])
+    self.assertFalse(watcher.feed('ok\nSegmentation fault\nnothing\n'
+                                  'Core dumped (fault)'))
+    self.assertEquals(seen, ['Segmentation fault', 'fault', 'Core', 'fault'])
+
+  def test_run_cache(self):
+    """Tests that RunCache runs each command only until its output is cached,
+    and again after invalidation, expiry or a change to a watched file."""
+    tempdir = tempfile.mkdtemp()
+    try:
+      watched = os.path.join(tempdir, 'HEAD')
+      counter = os.path.join(tempdir, 'counter')
+      cmd = ['sh', '-c', 'echo x >> %s; wc -l < %s' % (counter, counter)]
+      cache = shell_utils.RunCache(watch_files=[watched])
+      outputs = [cache.run(cmd, echo=False) for _ in range(3)]
+      self.assertEquals([o.strip() for o in outputs], ['1', '1', '1'])
+      self.assertEquals((cache.hits, cache.misses), (2, 1))
+
+      cache.invalidate(cmd)
+      self.assertEquals(cache.run(cmd, echo=False).strip(), '2')
+      with open(watched, 'w') as f:
+        f.write('changed')
+      self.assertEquals(cache.run(cmd, echo=False).strip(), '3')
+      self.assertEquals(cache.run(cmd, echo=False).strip(), '3')
+
+      cache.invalidate()
+      self.assertEquals(cache.run(cmd, echo=False, ttl_secs=0.1).strip(), '4')
+      time.sleep(0.2)
+      self.assertEquals(cache.run(cmd, echo=False, ttl_secs=0.1).strip(), '5')
+      self.assertEquals((cache.hits, cache.misses), (3, 5))
+    finally:
+      shutil.rmtree(tempdir)
+
+  def test_shell_session(self):
+    """Tests that ShellSession runs command lines in one shell, and restarts it
+    when it exits or times out."""
+    session = shell_utils.ShellSession(echo=False)
+    try:
+      self.assertEquals(session.run('echo a; printf b'), 'a\nb')
+      session.run('cd /; X=1')
+      self.assertEquals(session.run('echo $X; pwd'), '1\n/\n')
+      with self.assertRaises(shell_utils.CommandFailedException) as cm:
+        session.run('echo oops; false')
+      self.assertEquals(cm.exception.output, 'oops\n')
+      # Neither a syntax error nor a read from stdin can eat the sentinel.
+      with self.assertRaises(shell_utils.CommandFailedException):
+        session.run('echo "unterminated')
+      self.assertTrue(session.run('cat <<EOF\nheredoc').startswith('heredoc'))
+      self.assertEquals(session.run('cat'), '')
+      self.assertEquals(session.run("echo 'quoted' \"it's\""),
+                        "quoted it's\n")
+      self.assertEquals(session.restarts, 0)
+
+      with self.assertRaises(shell_utils.CommandFailedException):
+        session.run('exit 3')
+      self.assertEquals(session.run('echo $X'), '\n')
+      with self.assertRaises(shell_utils.TimeoutException):
+        session.run('echo slow; sleep 10', timeout=0.2)
+      self.assertEquals(session.run('echo ok'), 'ok\n')
+      self.assertEquals(session.restarts, 2)
+    finally:
+      session.close()
+
+  def test_coprocess(self):
+    """Tests that a Coprocess can discard stderr, and restarts if a reply
+    parser fails partway through a reply."""
+    coprocess = shell_utils.Coprocess(['sh', '-c', 'echo warning >&2; cat'],
+                                      echo=False, discard_stderr=True)
+    try:
+      read_line = lambda deadline: coprocess.read_until('\n', deadline)
+      self.assertEquals(coprocess.request('a\n', read_line), 'a\n')
+
+      def fail(deadline):
+        coprocess.read_bytes(1, deadline)
+        raise ValueError()
+      with self.assertRaises(ValueError):
+        coprocess.request('bc\n', fail)
+      self.assertEquals(coprocess.request('d\n', read_line), 'd\n')
+      self.assertEquals(coprocess.restarts, 1)
+    finally:
+      coprocess.close()
+
+  def test_line_logger_batches_writes(self):
+    """Tests that _LineLogger timestamps each line, and holds lines back until
+    LOG_FLUSH_SECS have passed or it is finished."""
+    log_file = tempfile.TemporaryFile()
+    try:
+      logger = shell_utils._LineLogger(echo=False, log_file=log_file)
+      self.assertEquals(logger.write('a\nb'), 'a\n')
+      self.assertNotEquals(logger.flush_deadline(), None)
+      log_file.seek(0)
+      self.assertEquals(log_file.read(), '')
+      logger.flush_if_due(now=logger.flush_deadline())
+      self.assertEquals(logger.flush_deadline(), None)
+      self.assertEquals(logger.finish(), 'b')
+      log_file.seek(0)
+      lines = log_file.read().splitlines()
+      self.assertEquals([line.split('] ', 1)[1] for line in lines], ['a', 'b'])
+      self.assertRegexpMatches(lines[0], r'^\[\d\d:\d\d:\d\d\.\d{6}\] ')
+    finally:
+      log_file.close()
+
+  def test_line_logger_long_lines(self):
+    """Tests that _LineLogger returns a line with no newline in pieces once it
+    reaches MAX_LOG_LINE_BYTES, in time linear in its length."""
+    logger = shell_utils._LineLogger(echo=False)
+    chunk = 'x' * 1000
+    t_0 = time.time()
+    pieces = [logger.write(chunk) for _ in range(30000)]
+    self.assertLess(time.time() - t_0, 2)
+    pieces = [piece for piece in pieces if piece]
+    self.assertTrue(pieces)
+    self.assertTrue(all(
+        shell_utils.MAX_LOG_LINE_BYTES <= len(piece) <
+        shell_utils.MAX_LOG_LINE_BYTES + len(chunk) for piece in pieces))
+    self.assertEquals(logger.write('y\nz'), (
+        30000 * len(chunk) - sum(len(piece) for piece in pieces)) * 'x' + 'y\n')
+    self.assertEquals(logger.finish(), 'z')
+
+  def test_line_logger_batches_long_lines(self):
+    """Tests that _LineLogger writes out a long line with no newline in
+    timestamped pieces as it arrives, rather than holding it all back."""
+    log_file = tempfile.TemporaryFile()
+    try:
+      logger = shell_utils._LineLogger(echo=False, log_file=log_file)
+      for _ in range(200):
+        logger.write('x' * 1000)
+      log_file.seek(0)
+      logged = log_file.read().splitlines()
+      self.assertTrue(logged)
+      self.assertLess(200 * 1000 - sum(line.count('x') for line in logged),
+                      shell_utils.MAX_LOG_LINE_BYTES)
+      logger.finish()
+      log_file.seek(0)
+      logged = log_file.read().splitlines()
+      for line in logged:
+        self.assertRegexpMatches(line, r'^\[\d\d:\d\d:\d\d\.\d{6}\] x+$')
+      self.assertEquals(''.join(line.split('] ', 1)[1] for line in logged),
+                        'x' * 200 * 1000)
+    finally:
+      log_file.close()
+
+  def test_after_completion_large_output(self):
+    """Tests that log_process_after_completion() reads more output than fits
+    in a pipe buffer without deadlocking, and returns promptly."""
+    t_0 = time.time()
+    proc = shell_utils.run_async(
+        ['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do echo line$i; '
+         'i=$((i+1)); done'], echo=False)
+    (code, output) = shell_utils.log_process_after_completion(proc,
+                                                              echo=False)
+    self.assertEquals(code, 0)
+    self.assertEquals(len(output.splitlines()), 20000)
+    self.assertLess(time.time() - t_0, 5)
+
+  def test_run_many(self):
+    """Tests that run_many() runs commands in parallel, and returns their
+    results in order."""
+    t_0 = time.time()
+    results = shell_utils.run_many(
+        [['sh', '-c', 'sleep 0.5; echo %d' % i] for i in range(4)],
+        max_parallel=4, echo=False)
+    self.assertLess(time.time() - t_0, 1.5)
+    self.assertEquals([(r.index, r.returncode, r.output) for r in results],
+                      [(i, 0, '%d\n' % i) for i in range(4)])
+
+  def test_run_many_as_completed(self):
+    """Tests that run_many(as_completed=True) yields results as they
+    complete."""
+    results = shell_utils.run_many(
+        [['sh', '-c', 'sleep 0.3; echo slow'], ['echo', 'fast']],
+        max_parallel=2, echo=False, as_completed=True)
+    self.assertEquals([r.output for r in results], ['fast\n', 'slow\n'])
+
+  def test_run_many_orphaned_stdout(self):
+    """Tests that run_many() notices a command has exited, even though its
+    child still holds its stdout open, while another command is busy writing
+    output."""
+    t_0 = time.time()
+    results = shell_utils.run_many(
+        [['sh', '-c', 'echo parent; sleep 3 & exit 0'],
+         ['sh', '-c', 'i=0; while [ $i -lt 200 ]; do echo busy; sleep 0.01; '
+          'i=$((i+1)); done']],
+        max_parallel=2, echo=False, as_completed=True)
+    first = next(results)
+    self.assertEquals(first.output, 'parent\n')
+    self.assertLess(time.time() - t_0, 1)
+    self.assertEquals(len(next(results).output.splitlines()), 200)
+
+  def test_run_many_output_closed(self):
+    """Tests that a command which closes its output but keeps running neither
+    holds up the others nor escapes its timeout."""
+    grace_secs = shell_utils.KILL_GRACE_SECS
+    shell_utils.KILL_GRACE_SECS = 0.2
+    try:
+      t_0 = time.time()
+      results = shell_utils.run_many(
+          [['sh', '-c', 'exec >/dev/null 2>&1; sleep 10'],
+           ['sh', '-c', 'sleep 0.2; echo done']],
+          max_parallel=2, timeout=0.6, echo=False, as_completed=True)
+      self.assertEquals(next(results).output, 'done\n')
+      self.assertLess(time.time() - t_0, 0.5)
+      with self.assertRaises(shell_utils.CommandsFailedException) as cm:
+        list(results)
+      self.assertEquals(
+          [(f.index, type(f.exception)) for f in cm.exception.failures],
+          [(0, shell_utils.TimeoutException)])
+      self.assertLess(time.time() - t_0, 1.5)
+    finally:
+      shell_utils.KILL_GRACE_SECS = grace_secs
+
+  def test_run_many_failures(self):
+    """Tests that run_many() reports all failures, or just the first if
+    fail_fast is True."""
+    cmds = [['sh', '-c', 'echo bad; exit 3'], ['true'], ['sleep', '10']]
+    with self.assertRaises(shell_utils.CommandsFailedException) as cm:
+      shell_utils.run_many(cmds, max_parallel=3, timeout=0.3, echo=False)
+    self.assertEquals(
+        [(f.index, type(f.exception)) for f in cm.exception.failures],
+        [(0, shell_utils.CommandFailedException),
+         (2, shell_utils.TimeoutException)])
+    self.assertEquals(cm.exception.output, '[0] bad\n')
+
+    t_0 = time.time()
+    with self.assertRaises(shell_utils.CommandsFailedException) as cm:
+      shell_utils.run_many(cmds, max_parallel=3, echo=False, fail_fast=True)
+    self.assertEquals([f.index for f in cm.exception.failures], [0])
+    self.assertLess(time.time() - t_0, 5)
+
+  def test_run_async_io(self):
+    """Tests that one CommandLoop runs many commands concurrently, and yields
+    their output a line at a time."""
+    loop = shell_utils.CommandLoop()
+    t_0 = time.time()
+    commands = [shell_utils.run_async_io(['sh', '-c', 'sleep 0.5; echo %d' % i],
+                                         loop=loop, echo=False)
+                for i in range(50)]
+    streamed = shell_utils.run_async_io(['sh', '-c', 'echo a; printf b'],
+                                        loop=loop, echo=False)
+    self.assertEquals(list(streamed), ['a\n', 'b'])
+    loop.run_until_complete()
+    self.assertLess(time.time() - t_0, 5)
+    self.assertEquals([c.wait() for c in commands],
+                      ['%d\n' % i for i in range(50)])
+
+  def test_run_async_io_timeout_kills_process_group(self):
+    """Tests that when a command times out, its child processes are killed
+    too."""
+    tempdir = tempfile.mkdtemp()
+    try:
+      marker = os.path.join(tempdir, 'marker')
+      command = shell_utils.run_async_io(
+          ['sh', '-c', '(sleep 1; touch %s) & wait' % marker], echo=False,
+          timeout=0.2)
+      with self.assertRaises(shell_utils.TimeoutException):
+        command.wait()
+      time.sleep(1.5)
+      self.assertFalse(os.path.exists(marker))
+    finally:
+      shutil.rmtree(tempdir)
+
+  def test_run_async_io_output_closed(self):
+    """Tests that a command which closes its output but keeps running neither
+    freezes the CommandLoop nor escapes its timeout."""
+    grace_secs = shell_utils.KILL_GRACE_SECS
+    shell_utils.KILL_GRACE_SECS = 0.2
+    try:
+      loop = shell_utils.CommandLoop()
+      t_0 = time.time()
+      closed = shell_utils.run_async_io(
+          ['sh', '-c', 'exec >/dev/null 2>&1; sleep 10'], loop=loop,
+          echo=False, timeout=0.6)
+      other = shell_utils.run_async_io(['sh', '-c', 'sleep 0.2; echo done'],
+                                       loop=loop, echo=False)
+      self.assertEquals(other.wait(), 'done\n')
+      self.assertLess(time.time() - t_0, 0.5)
+      with self.assertRaises(shell_utils.TimeoutException):
+        closed.wait()
+      self.assertLess(time.time() - t_0, 1.5)
+    finally:
+      shell_utils.KILL_GRACE_SECS = grace_secs
+
+  def test_run_retry_async_io(self):
+    """Tests that run_retry_async_io() retries failed commands."""
+    command = shell_utils.run_retry_async_io(
+        ['sh', '-c', 'echo attempt; exit 1'], echo=False, attempts=3,
+        secs_between_attempts=0)
+    self.assertEquals(list(command), ['attempt\n'] * 3)
+    with self.assertRaises(shell_utils.CommandFailedException):
+      command.wait()
+
+  def test_output_capture(self):
+    """Tests that OutputCapture holds only the end of the output in memory,
+    and spills all of it to disk."""
+    capture = shell_utils.OutputCapture(max_memory_bytes=10)
+    try:
+      capture.write('first\n')
+      self.assertEquals(capture.path, None)
+      for i in range(100):
+        capture.write('line %d\n' % i)
+      self.assertEquals(capture.tail(), 'line 99\n')
+      self.assertEquals(len(capture), len(capture.getvalue()))
+      self.assertEquals(list(capture)[:2], ['first\n', 'line 0\n'])
+      with open(capture.path) as f:
+        self.assertEquals(f.read(), capture.getvalue())
+    finally:
+      capture.delete()
+    with self.assertRaises(ValueError):
+      shell_utils.OutputCapture(max_memory_bytes=0)
+    with self.assertRaises(ValueError):
+      shell_utils.run(['echo', 'hi'], echo=False, max_output_in_memory=0)
+
+  def test_output_capture_cleanup(self):
+    """Tests that OutputCapture deletes its file when used as a context
+    manager, and that failed attempts of run_retry() leave neither files nor
+    file descriptors behind."""
+    with shell_utils.OutputCapture(max_memory_bytes=10) as capture:
+      capture.write('more than ten bytes\n')
+      path = capture.path
+      self.assertTrue(os.path.exists(path))
+    self.assertFalse(os.path.exists(path))
+
+    fd_dir = '/proc/self/fd'
+    if os.path.isdir(fd_dir):
+      num_fds = len(os.listdir(fd_dir))
+      with self.assertRaises(shell_utils.CommandFailedException) as cm:
+        shell_utils.run_retry(['sh', '-c', 'seq 100; exit 1'], echo=False,
+                              attempts=3, secs_between_attempts=0,
+                              max_output_in_memory=10)
+      os.remove(cm.exception.log_path)
+      self.assertEquals(len(os.listdir(fd_dir)), num_fds)
+
+  def test_run_bounded_output(self):
+    """Tests that run(max_output_in_memory=...) puts just the end of the
+    output in its exception, plus the path to all of it."""
+    with self.assertRaises(shell_utils.CommandFailedException) as cm:
+      shell_utils.run(['sh', '-c', 'seq 1 10000; exit 1'], echo=False,
+                      max_output_in_memory=100)
+    try:
+      self.assertTrue(cm.exception.output.endswith('9999\n10000\n'))
+      self.assertLessEqual(len(cm.exception.output), 100)
+      with open(cm.exception.log_path) as f:
+        self.assertEquals(len(f.read().splitlines()), 10000)
+    finally:
+      os.remove(cm.exception.log_path)
+
+
+if __name__ == '__main__':
+  unittest.main()